@@ -1,229 +1,1087 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import (Flask, Blueprint, Response, current_app, render_template, request, jsonify, send_file,
+                   stream_with_context)
 import tempfile
 import os
 import re
-from difflib import SequenceMatcher
+import shutil
+import secrets
+import codecs
+import hashlib
 import json
+import sqlite3
+import zlib
+import math
+import time
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager, ExitStack
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from werkzeug.utils import secure_filename
+from bibdedup_core import (
+    DEFAULT_BLOCKING, IDENTIFIER_SOURCE_FIELDS, SCORE_FLOOR, MemoryProfiler, build_candidate_graph,
+    check_identical_entries, cluster_candidate_graph, configure_blocking, extract_entry_info,
+    find_identifier_groups, get_stage, group_key_map, normalize_identifiers, parse_bib_text,
+    parse_resolution_policies, query_library_index, resolve_group, title_author_fields
+)
 
-app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Default settings - override them with BIBDEDUP_* environment variables
+# (e.g. BIBDEDUP_ANALYSIS_WORKERS=4) or the config passed to create_app()
+DEFAULT_CONFIG = {
+    'MAX_CONTENT_LENGTH': 16 * 1024 * 1024,  # 16MB max file size
+    # Analysis runs in a pool of this many worker processes, separate from the
+    # request threads; 0 runs it in the request thread (serverless platforms
+    # such as Vercel cannot start process pools)
+    'ANALYSIS_WORKERS': 0 if os.environ.get('VERCEL') else (os.cpu_count() or 1),
+    # Admission control: estimated working memory allowed for concurrent
+    # analyses, requests allowed to wait for it, and how long they may wait
+    'ANALYSIS_MEMORY_BUDGET': 512 * 1024 * 1024,
+    'ANALYSIS_QUEUE_LENGTH': 16,
+    'ANALYSIS_QUEUE_TIMEOUT': 30,
+    # Memory for the scored analyses of recent uploads, so a file uploaded
+    # again is only re-clustered (0 disables the cache)
+    'ANALYSIS_CACHE_SIZE': 128 * 1024 * 1024,
+    # Debug: profile each /analyze run's memory by pipeline stage and return
+    # the report with the results (slows analysis down several times)
+    'PROFILE_MEMORY': False,
+    # Library index built with `bib_deduplicator.py --query` for /check lookups
+    'LIBRARY_INDEX': None,
+    # Resumable chunked uploads for files beyond MAX_CONTENT_LENGTH: where the
+    # chunks are kept, the chunk size, the largest file accepted, and how long
+    # an unfinished upload is kept for resuming (seconds)
+    'UPLOAD_FOLDER': os.path.join(tempfile.gettempdir(), 'bibdedup-uploads'),
+    'UPLOAD_CHUNK_SIZE': 4 * 1024 * 1024,
+    'UPLOAD_MAX_SIZE': 256 * 1024 * 1024,
+    'UPLOAD_EXPIRY': 24 * 60 * 60,
+    # Review sessions: the page sends an analysis once, then its decisions in
+    # batches; where sessions are kept and how long an idle one is kept (seconds)
+    'REVIEW_FOLDER': os.path.join(tempfile.gettempdir(), 'bibdedup-reviews'),
+    'REVIEW_EXPIRY': 24 * 60 * 60,
+}
 
-# Your existing BibTeX processing functions (copy from original)
-def parse_bib_entries(content):
-    """Parse BibTeX content and extract individual entries."""
-    entry_pattern = r'@(.*?)((?=@)|$)'
-    entries = re.finditer(entry_pattern, content, re.DOTALL)
+# Rough working memory of an analysis: the decoded upload and parsed copies,
+# plus the extracted info, candidate graph and JSON response for each entry
+ANALYSIS_COST_PER_BYTE = 4
+ANALYSIS_COST_PER_ENTRY = 8 * 1024
+
+# Rough memory of a cached analysis: the extracted entries hold about eight
+# times the upload's size, plus each scored edge of the candidate graph
+ANALYSIS_CACHE_COST_PER_BYTE = 8
+ANALYSIS_CACHE_COST_PER_EDGE = 200
+
+routes = Blueprint('deduplicator', __name__)
+
+def resolved_key_map(entries_info, manual_groups, identical_groups, resolved_groups):
+    """Old key -> kept key map for every group settled to a single entry."""
+    key_map = {}
+    for group_info in identical_groups:
+        key_map.update(group_key_map(entries_info, group_info['group'], group_info['best_idx']))
+    for group_idx_str, resolution in resolved_groups.items():
+        if resolution['action'] == 'keep_selected':
+            group = [entry['index'] for entry in manual_groups[int(group_idx_str)]]
+            key_map.update(group_key_map(entries_info, group, resolution['entry']['index']))
+    return dict(sorted(key_map.items()))
+
+def run_analysis(content, threshold, stages, blocking, policies):
+    """Parse, score and cluster an uploaded file - runs in the analysis pool."""
+    entries = parse_bib_text(content)
+    entries_info = [extract_entry_info(entry) for entry in entries]
     
-    parsed_entries = []
-    for entry in entries:
-        entry_text = entry.group(0).strip()
-        if entry_text:
-            parsed_entries.append(entry_text)
+    # Score candidate pairs once so threshold changes only re-cluster
+    candidate_graph = build_candidate_graph(
+        entries_info, min(SCORE_FLOOR, threshold), stages, blocking, verbose=False)
     
-    return parsed_entries
+    return build_analysis_response(entries_info, candidate_graph, threshold, policies)
+
+def run_profiled_analysis(content, threshold, stages, blocking, policies):
+    """
+    run_analysis with a memory profile of each stage, added to the result as
+    'memory_profile'. The serialize stage encodes the response as /analyze
+    does, in the worker.
+    """
+    profiler = MemoryProfiler()
+    with profiler.stage('parse'):
+        entries = parse_bib_text(content)
+    with profiler.stage('extract'):
+        entries_info = [extract_entry_info(entry) for entry in entries]
+    with profiler.stage('match'):
+        candidate_graph = build_candidate_graph(
+        entries_info, min(SCORE_FLOOR, threshold), stages, blocking, verbose=False)
+    with profiler.stage('response'):
+        result = build_analysis_response(entries_info, candidate_graph, threshold, policies)
+    with profiler.stage('serialize'):
+        response_bytes = len(json.dumps(result))
+    
+    result['memory_profile'] = profiler.report(
+        input_bytes=len(content.encode('utf-8')), entries=len(entries), response_bytes=response_bytes,
+        threshold=threshold, blocking=blocking['method'])
+    return result
+
+def run_entries_analysis(entries_info, threshold, stages, blocking, policies):
+    """Score and cluster entries that are already extracted - runs in the analysis pool."""
+    candidate_graph = build_candidate_graph(
+        entries_info, min(SCORE_FLOOR, threshold), stages, blocking, verbose=False)
+    return build_analysis_response(entries_info, candidate_graph, threshold, policies)
+
+# Streaming analysis (/analyze_stream): year blocks are scored as separate pool
+# tasks and the groups of each block are sent as soon as it is done
+STREAM_TASK_PAIRS = 2000  # Candidate pairs batched into one pool task
 
-def extract_entry_info(entry):
-    """Extract key information from a BibTeX entry."""
-    match = re.match(r'@(\w+)\s*{\s*([^,]+)', entry)
-    if not match:
+def extract_entries(content):
+    """Parse an uploaded file into entry info - runs in the analysis pool."""
+    return [extract_entry_info(entry) for entry in parse_bib_text(content)]
+
+def independent_year_blocks(entries_info, stages, blocking, exclude):
+    """
+    Entry indices by year, for stages that only pair entries of the same year,
+    so each block's groups are final once it is scored. Returns None for year
+    windows, missing years matching any year, and sorted-neighborhood blocking.
+    """
+    year_stage = get_stage(stages, 'year_window')
+    if blocking['method'] != 'year' or year_stage is None or year_stage['window'] or year_stage['allow_missing']:
         return None
     
-    entry_type = match.group(1).lower()
-    citation_key = match.group(2)
+    blocks = {}
+    for i, entry in enumerate(entries_info):
+        if entry is not None and i not in exclude:
+            blocks.setdefault(entry['year'], []).append(i)
+    return [block for block in blocks.values() if len(block) > 1]
+
+def batch_year_blocks(blocks):
+    """Batch blocks into tasks of about STREAM_TASK_PAIRS pairs, smallest first so groups arrive early."""
+    tasks = []
+    task = []
+    task_pairs = 0
+    for block in sorted(blocks, key=len):
+        task.append(block)
+        task_pairs += len(block) * (len(block) - 1) // 2
+        if task_pairs >= STREAM_TASK_PAIRS:
+            tasks.append(task)
+            task = []
+            task_pairs = 0
+    if task:
+        tasks.append(task)
+    return tasks
+
+def score_year_blocks(blocks_info, score_floor, stages):
+    """Score the pairs within each block of entries - runs in the analysis pool. Returns a graph per block."""
+    return [build_candidate_graph(block_info, score_floor, stages, verbose=False) for block_info in blocks_info]
+
+def iter_analysis_stream(entries_info, threshold, stages, blocking, policies, pool, graph=None):
+    """
+    Yield the records of a streamed analysis: the entries, then each duplicate
+    group as soon as it is final - identifier groups first, then the groups
+    of each scored year block - with progress records in between, and last a
+    summary with the whole candidate graph. A cached graph is re-clustered.
+    Groups arrive block by block rather than in file order.
+    """
+    valid_entries = sum(1 for entry in entries_info if entry is not None)
+    yield {'type': 'entries', 'total_entries': len(entries_info), 'valid_entries': valid_entries,
+           'entries_info': entries_info, 'threshold': threshold}
     
-    # Extract title
-    title_match = re.search(r'title\s*=\s*[{"](.+?)[}"]', entry, re.IGNORECASE | re.DOTALL)
-    title = title_match.group(1).lower().replace('\n', ' ').replace('\t', ' ') if title_match else ""
-    title = re.sub(r'\s+', ' ', title).strip()
+    counts = {'identical': 0, 'manual': 0}
     
-    # Extract authors
-    author_match = re.search(r'author\s*=\s*[{"](.+?)[}"]', entry, re.IGNORECASE | re.DOTALL)
-    authors = author_match.group(1) if author_match else ""
+    def group_records(groups):
+        for group in groups:
+            kind, group_info = classify_duplicate_group(entries_info, group, policies)
+            counts[kind] += 1
+            yield {'type': f'{kind}_group', 'group': group_info}
     
-    # Extract year
-    year_match = re.search(r'year\s*=\s*[{"]?(\d{4})[}"]?', entry, re.IGNORECASE)
-    year = year_match.group(1) if year_match else ""
+    score_floor = min(SCORE_FLOOR, threshold)
+    identifier_groups = graph['identifier_groups'] if graph else find_identifier_groups(entries_info)
+    identified = {i for group in identifier_groups for i in group}
+    yield from group_records(identifier_groups)
+    blocks = independent_year_blocks(entries_info, stages, blocking, identified) if graph is None else None
     
-    # Extract DOI
-    doi_match = re.search(r'doi\s*=\s*[{"](.+?)[}"]', entry, re.IGNORECASE)
-    doi = doi_match.group(1) if doi_match else ""
+    if graph is not None:
+        groups = cluster_candidate_graph(entries_info, graph, threshold)
+        yield from group_records([group for group in groups if group[0] not in identified])
+    elif blocks is None:
+        # Groups can depend on any pair, so they are only final once everything is scored
+        yield {'type': 'progress', 'percent': 10, 'candidate_pairs': 0}
+        if pool is None:
+            graph = build_candidate_graph(entries_info, score_floor, stages, blocking, verbose=False)
+        else:
+            graph = pool.submit(build_candidate_graph, entries_info, score_floor, stages, blocking).result()
+        groups = cluster_candidate_graph(entries_info, graph, threshold)
+        yield from group_records([group for group in groups if group[0] not in identified])
+    else:
+        stage_stats = [{'stage': stage['stage'], 'evaluated': 0, 'rejected': 0, 'accepted': 0} for stage in stages]
+        edges = []
+        candidate_pairs = 0
+        total_pairs = sum(len(block) * (len(block) - 1) // 2 for block in blocks)
+        tasks = batch_year_blocks(blocks)
+        
+        def blocks_info(task):
+            return [[entries_info[i] for i in block] for block in task]
+        
+        futures = {}
+        try:
+            if pool is None:
+                completed = ((task, score_year_blocks(blocks_info(task), score_floor, stages)) for task in tasks)
+            else:
+                futures = {pool.submit(score_year_blocks, blocks_info(task), score_floor, stages): task
+                           for task in tasks}
+                completed = ((futures[future], future.result()) for future in as_completed(futures))
+            
+            for task, block_graphs in completed:
+                for block, block_graph in zip(task, block_graphs):
+                    block_edges = [(block[i], block[j], forward, backward)
+                                   for i, j, forward, backward in block_graph['edges']]
+                    edges.extend(block_edges)
+                    candidate_pairs += block_graph['candidate_pairs']
+                    for stats, block_stats in zip(stage_stats, block_graph['stage_stats']):
+                        for counter in ('evaluated', 'rejected', 'accepted'):
+                            stats[counter] += block_stats[counter]
+                    
+                    # A block's groups do not depend on any other block
+                    local_groups = cluster_candidate_graph(
+                        [entries_info[i] for i in block],
+                        {'edges': block_graph['edges'], 'identifier_groups': []}, threshold)
+                    yield from group_records([[block[i] for i in group] for group in local_groups])
+                
+                yield {'type': 'progress', 'percent': round(10 + 90 * candidate_pairs / max(total_pairs, 1)),
+                       'candidate_pairs': candidate_pairs}
+        finally:
+            # The client went away: drop the blocks not started yet
+            for future in futures:
+                future.cancel()
+        
+        edges.sort()
+        graph = {
+            'size': len(entries_info),
+            'score_floor': score_floor,
+            'identifier_groups': identifier_groups,
+            'edges': edges,
+            'candidate_pairs': candidate_pairs,
+            'pruned_pairs': valid_entries * (valid_entries - 1) // 2 - candidate_pairs,
+            'stage_stats': stage_stats
+        }
     
+    yield {
+        'type': 'done',
+        'duplicate_groups': counts['identical'] + counts['manual'],
+        'auto_resolved': counts['identical'],
+        'manual_resolution_needed': counts['manual'],
+        'candidate_graph': graph,
+        'threshold': threshold,
+        'policy': ','.join(policies or [])
+    }
+
+def entry_info_from_fingerprint(fingerprint):
+    """
+    Build entry info from a fingerprint parsed in the browser.
+    Titles, authors and identifiers arrive as raw field values and are normalized here;
+    the entry text stays in the browser, so full_entry is None.
+    """
+    if fingerprint is None:
+        return None
+    entry_type = str(fingerprint['type']).lower()
+    raw_identifiers = fingerprint.get('identifiers') or {}
+    identifiers = normalize_identifiers(
+        entry_type, str(fingerprint['doi']),
+        {name: str(raw_identifiers.get(name, '')) for name in IDENTIFIER_SOURCE_FIELDS})
     return {
         'type': entry_type,
-        'citation_key': citation_key,
-        'title': title,
-        'authors': authors,
-        'year': year,
-        'doi': doi,
-        'full_entry': entry
+        'citation_key': str(fingerprint['citation_key']),
+        **title_author_fields(str(fingerprint['title']), str(fingerprint['authors'])),
+        'year': str(fingerprint['year']),
+        **identifiers,
+        'full_entry': None,
+        'filled_fields': int(fingerprint['filled_fields']),
+        'preprint': bool(fingerprint['preprint'])
     }
 
-def find_duplicates(entries_info, similarity_threshold=0.8):
-    """Find potential duplicate entries based on similarity."""
-    duplicates = []
-    processed = set()
+def parse_analysis_options(options):
+    """Read threshold, blocking and policy options; returns (threshold, stages, blocking, policies)."""
+    threshold = float(options.get('threshold', 0.8))
+    blocking_method = options.get('blocking', 'year')
+    if blocking_method not in ('year', 'sorted_neighborhood'):
+        raise ValueError('Unknown blocking method')
+    window = int(options.get('window', DEFAULT_BLOCKING['window']))
+    year_tolerance = options.get('year_tolerance')
+    stages, blocking = configure_blocking(
+        None, blocking_method, window,
+        int(year_tolerance) if year_tolerance is not None else None)
+    policies = parse_resolution_policies(options.get('policy', ''))
+    return threshold, stages, blocking, policies
+
+def classify_duplicate_group(entries_info, group, policies=None):
+    """
+    Return ('identical', info) for a group that is identical or settled by the
+    policies, or ('manual', entries) for one the user has to resolve.
+    """
+    identical, best_idx = check_identical_entries(entries_info, group)
+    if identical:
+        return 'identical', {
+            'group': group,
+            'best_idx': best_idx,
+            'citation_key': entries_info[best_idx]['citation_key']
+        }
     
-    # Ensure threshold is a float
-    threshold = float(similarity_threshold)
+    resolution = resolve_group(entries_info, group, policies) if policies else None
+    if resolution:
+        # Settled by the resolution policies, possibly as a merged record
+        return 'identical', {
+            'group': group,
+            'best_idx': resolution['index'],
+            'citation_key': entries_info[resolution['index']]['citation_key'],
+            'full_entry': resolution['entry'],
+            'policy': resolution['policy']
+        }
     
-    for i, entry1 in enumerate(entries_info):
-        if i in processed or entry1 is None:
-            continue
-            
-        group = [i]
+    # Prepare group info for manual resolution
+    group_info = []
+    for idx in group:
+        entry = entries_info[idx]
+        if entry:
+            group_info.append({
+                'index': idx,
+                'citation_key': entry['citation_key'],
+                'title': entry['title'],
+                'authors': entry['authors'],
+                'year': entry['year'],
+                'doi': entry['doi'],
+                'type': entry['type'],
+                'full_entry': entry['full_entry']
+            })
+    return 'manual', group_info
+
+def build_analysis_response(entries_info, candidate_graph, threshold, policies=None):
+    """Cluster the candidate graph and split groups into auto-resolved and manual."""
+    valid_entries = [e for e in entries_info if e is not None]
+    
+    # Find duplicates
+    duplicates = cluster_candidate_graph(entries_info, candidate_graph, threshold)
+    
+    # Process duplicates - separate identical from non-identical
+    identical_groups = []
+    manual_groups = []
+    for group in duplicates:
+        kind, group_info = classify_duplicate_group(entries_info, group, policies)
+        (identical_groups if kind == 'identical' else manual_groups).append(group_info)
+    
+    return {
+        'total_entries': len(entries_info),
+        'valid_entries': len(valid_entries),
+        'duplicate_groups': len(duplicates),
+        'auto_resolved': len(identical_groups),
+        'manual_resolution_needed': len(manual_groups),
+        'manual_groups': manual_groups,
+        'identical_groups': identical_groups,
+        'entries_info': entries_info,  # Store for later processing
+        'candidate_graph': candidate_graph,  # Re-clustered when the threshold changes
+        'threshold': threshold,
+        'policy': ','.join(policies or [])
+    }
+
+def estimate_analysis_cost(content):
+    """Estimate the working memory (bytes) needed to analyze an upload."""
+    entry_count = len(re.findall(r'^\s*@', content, re.MULTILINE))
+    return len(content) * ANALYSIS_COST_PER_BYTE + entry_count * ANALYSIS_COST_PER_ENTRY
+
+class AnalysisRejected(Exception):
+    """Raised when the analysis queue is full or a request waited too long."""
+    
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AnalysisQueue:
+    """
+    Bounded FIFO admission queue for analyses.
+    Analyses run while their estimated cost fits the memory budget; an analysis
+    larger than the whole budget still runs, but only on its own.
+    """
+    
+    def __init__(self, budget, max_waiting, timeout):
+        self.budget = budget
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.waiting = deque()
+        self.running = 0
+        self.in_use = 0
         
-        # DOI matching first
-        if entry1['doi']:
-            for j, entry2 in enumerate(entries_info):
-                if i == j or j in processed or entry2 is None:
-                    continue
-                if entry1['doi'] == entry2['doi']:
-                    group.append(j)
-        
-        # Similarity matching for entries without DOI matches
-        if len(group) == 1:
-            same_year_indices = [j for j, entry2 in enumerate(entries_info) 
-                               if entry2 is not None and j != i and j not in processed 
-                               and entry2['year'] == entry1['year']]
+        # Metrics
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.average_duration = 1.0  # Moving average of analysis time in seconds
+    
+    def check_capacity(self):
+        """Reject a request up front if no more requests may wait."""
+        with self.condition:
+            if len(self.waiting) >= self.max_waiting:
+                self.rejected += 1
+                raise AnalysisRejected('Server is busy, please try again shortly', self.retry_after())
+    
+    def retry_after(self):
+        """Seconds a client should wait before retrying, from the recent analysis time."""
+        backlog = len(self.waiting) + 1
+        return max(1, math.ceil(self.average_duration * backlog / max(1, self.running)))
+    
+    def _fits(self, cost):
+        return self.running == 0 or self.in_use + cost <= self.budget
+    
+    @contextmanager
+    def admit(self, cost):
+        """Wait for capacity to run an analysis of the given cost."""
+        with self.condition:
+            self.check_capacity()
             
-            for j in same_year_indices:
-                entry2 = entries_info[j]
-                
-                if entry1['title'] and entry2['title']:
-                    if abs(len(entry1['title']) - len(entry2['title'])) / max(len(entry1['title']), 1) < 0.3:
-                        title_similarity = SequenceMatcher(None, entry1['title'], entry2['title']).ratio()
-                        if title_similarity > threshold:
-                            group.append(j)
-                            continue
-                
-                if j not in group and entry1['authors'] and entry2['authors']:
-                    if abs(len(entry1['authors']) - len(entry2['authors'])) / max(len(entry1['authors']), 1) < 0.3:
-                        authors_similarity = SequenceMatcher(None, entry1['authors'], entry2['authors']).ratio()
-                        if authors_similarity > threshold:
-                            group.append(j)
-        
-        if len(group) > 1:
-            duplicates.append(group)
-            processed.update(group)
-    
-    return duplicates
-
-def check_identical_entries(entries_info, group):
-    """Check if entries in a group are identical."""
-    if not group or len(group) <= 1:
-        return False, None
-    
-    primary_idx = group[0]
-    primary_entry = entries_info[primary_idx]
-    
-    primary_content = {
-        'title': primary_entry['title'].lower() if primary_entry['title'] else '',
-        'authors': primary_entry['authors'].lower() if primary_entry['authors'] else '',
-        'year': primary_entry['year'],
-        'doi': primary_entry['doi'].lower() if primary_entry['doi'] else '',
-        'type': primary_entry['type'].lower() if primary_entry['type'] else ''
-    }
+            ticket = object()
+            self.waiting.append(ticket)
+            start = time.monotonic()
+            try:
+                # Only the head of the queue may start, so large analyses are not starved
+                while self.waiting[0] is not ticket or not self._fits(cost):
+                    remaining = start + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise AnalysisRejected('Server is busy, please try again shortly', self.retry_after())
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+            
+            wait = time.monotonic() - start
+            self.admitted += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.running += 1
+            self.in_use += cost
+        
+        started = time.monotonic()
+        try:
+            yield wait
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.in_use -= cost
+                self.completed += 1
+                self.average_duration = 0.8 * self.average_duration + 0.2 * (time.monotonic() - started)
+                self.condition.notify_all()
     
-    for idx in group[1:]:
-        entry = entries_info[idx]
-        entry_content = {
-            'title': entry['title'].lower() if entry['title'] else '',
-            'authors': entry['authors'].lower() if entry['authors'] else '',
-            'year': entry['year'],
-            'doi': entry['doi'].lower() if entry['doi'] else '',
-            'type': entry['type'].lower() if entry['type'] else ''
-        }
+    def metrics(self):
+        with self.condition:
+            return {
+                'queue_depth': len(self.waiting),
+                'queue_limit': self.max_waiting,
+                'running': self.running,
+                'memory_in_use': self.in_use,
+                'memory_budget': self.budget,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'average_wait_seconds': round(self.total_wait / self.admitted, 3) if self.admitted else 0.0,
+                'max_wait_seconds': round(self.max_wait, 3),
+                'average_analysis_seconds': round(self.average_duration, 3)
+            }
+
+UPLOAD_ID = re.compile(r'[0-9a-f]{32}')
+
+def analysis_cache_key(raw_content, stages, blocking):
+    """Cache key of an upload: a hash of its bytes and of the matching parameters that shape the graph."""
+    digest = hashlib.sha256(raw_content)
+    digest.update(json.dumps([stages, blocking], sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+class AnalysisCache:
+    """
+    LRU cache of scored analyses - extracted entries and candidate graph - by
+    analysis_cache_key, within a memory budget. The graph is scored down to
+    its score floor, so a hit can be re-clustered at any threshold above it
+    and with any resolution policy.
+    """
+    
+    def __init__(self, budget):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.analyses = OrderedDict()  # key -> (entries_info, candidate_graph, size)
+        self.size = 0
         
-        if primary_content != entry_content:
-            return False, None
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key, threshold):
+        """Return (entries_info, candidate_graph) if cached and scored down to threshold, else None."""
+        with self.lock:
+            cached = self.analyses.get(key)
+            if cached is None or threshold < cached[1]['score_floor']:
+                self.misses += 1
+                return None
+            self.analyses.move_to_end(key)
+            self.hits += 1
+            return cached[0], cached[1]
     
-    # Choose entry with shortest citation key
-    best_idx = min(group, key=lambda idx: len(entries_info[idx]['citation_key']))
-    return True, best_idx
+    def put(self, key, entries_info, candidate_graph, size):
+        """Cache an analysis, evicting the least recently used ones to stay within the budget."""
+        if size > self.budget:
+            return
+        with self.lock:
+            if key in self.analyses:
+                self.size -= self.analyses.pop(key)[2]
+            self.analyses[key] = (entries_info, candidate_graph, size)
+            self.size += size
+            while self.size > self.budget:
+                _, (_, _, evicted_size) = self.analyses.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+    
+    def metrics(self):
+        with self.lock:
+            return {
+                'cache_entries': len(self.analyses),
+                'cache_memory': self.size,
+                'cache_budget': self.budget,
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_evictions': self.evictions
+            }
 
-@app.route('/')
+class ChunkedUpload:
+    """
+    Parser for a resumable upload whose chunks are stored as separate files.
+    Chunks may arrive in any order and at any server process; each process
+    parses the contiguous prefix it can see as it grows, so most entries are
+    extracted before the upload is finalized.
+    """
+    
+    def __init__(self, folder, size, chunk_size):
+        self.folder = folder
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunk_count = max(1, math.ceil(size / chunk_size))
+        self.lock = threading.Lock()
+        self.parsed_chunks = 0
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.pending = None  # Text after the last '@' parsed so far
+        self.entries_info = []
+    
+    def chunk_path(self, index):
+        return os.path.join(self.folder, f"{index}.chunk")
+    
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+    
+    def received_chunks(self):
+        return sorted(int(name.split('.')[0]) for name in os.listdir(self.folder) if name.endswith('.chunk'))
+    
+    def write_chunk(self, index, data):
+        """Store a verified chunk; a half-written chunk never becomes visible."""
+        partial_path = self.chunk_path(index) + f".{secrets.token_hex(4)}.partial"
+        with open(partial_path, 'wb') as f:
+            f.write(data)
+        os.replace(partial_path, self.chunk_path(index))
+    
+    def parse_available(self):
+        """Parse the chunks that extend the contiguous prefix."""
+        with self.lock:
+            while self.parsed_chunks < self.chunk_count and os.path.exists(self.chunk_path(self.parsed_chunks)):
+                with open(self.chunk_path(self.parsed_chunks), 'rb') as f:
+                    data = f.read()
+                final = self.parsed_chunks == self.chunk_count - 1
+                self._feed(self.decoder.decode(data, final=final))
+                self.parsed_chunks += 1
+    
+    def _feed(self, text):
+        # Same split as parse_bib_text: each entry runs from an '@' to the next
+        parts = text.split('@')
+        if self.pending is None:
+            parts = parts[1:]  # Drop the text before the first entry
+        else:
+            parts[0] = self.pending + parts[0]
+        if not parts:
+            return
+        for part in parts[:-1]:
+            self.entries_info.append(extract_entry_info(('@' + part).strip()))
+        self.pending = parts[-1]
+    
+    def finish(self):
+        """Return the extracted entries once every chunk has been parsed."""
+        self.parse_available()
+        with self.lock:
+            if self.parsed_chunks < self.chunk_count:
+                raise ValueError('The upload is missing chunks')
+            if self.pending is not None:
+                self.entries_info.append(extract_entry_info(('@' + self.pending).strip()))
+                self.pending = None
+            return self.entries_info
+
+def create_app(config=None):
+    """
+    Create the web application.
+    For production, run it under a WSGI server, e.g. gunicorn 'app:create_app()'.
+    """
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.from_prefixed_env('BIBDEDUP')
+    if config:
+        app.config.update(config)
+    
+    app.extensions['analysis_queue'] = AnalysisQueue(
+        app.config['ANALYSIS_MEMORY_BUDGET'],
+        app.config['ANALYSIS_QUEUE_LENGTH'],
+        app.config['ANALYSIS_QUEUE_TIMEOUT']
+    )
+    app.extensions['analysis_cache'] = AnalysisCache(app.config['ANALYSIS_CACHE_SIZE'])
+    app.extensions['chunked_uploads'] = {}
+    app.extensions['chunked_uploads_lock'] = threading.Lock()
+    app.register_blueprint(routes)
+    return app
+
+_analysis_pool_lock = threading.Lock()
+
+def get_analysis_pool(app):
+    """Return the app's analysis process pool, created lazily in each server process."""
+    workers = app.config['ANALYSIS_WORKERS']
+    if not workers:
+        return None
+    
+    with _analysis_pool_lock:
+        # A pool inherited from a parent process (e.g. gunicorn --preload) is not usable
+        pid, pool = app.extensions.get('analysis_pool', (None, None))
+        if pool is None or pid != os.getpid():
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            app.extensions['analysis_pool'] = (os.getpid(), pool)
+        return pool
+
+def run_in_analysis_pool(function, *args):
+    """Run CPU-bound work in the analysis pool, or inline if the pool is disabled."""
+    pool = get_analysis_pool(current_app)
+    if pool is None:
+        return function(*args)
+    
+    try:
+        return pool.submit(function, *args).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory) - start a fresh pool next time
+        with _analysis_pool_lock:
+            current_app.extensions.pop('analysis_pool', None)
+        raise
+
+@routes.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/analyze', methods=['POST'])
+def uploaded_bib_file():
+    """The .bib file uploaded with the request; raises ValueError if there is none."""
+    if 'file' not in request.files:
+        raise ValueError('No file uploaded')
+    
+    file = request.files['file']
+    if file.filename == '':
+        raise ValueError('No file selected')
+    
+    if not file.filename.endswith('.bib'):
+        raise ValueError('Please upload a .bib file')
+    return file
+
+@routes.route('/analyze', methods=['POST'])
 def analyze_file():
     """Analyze uploaded BibTeX file for duplicates."""
+    queue = current_app.extensions['analysis_queue']
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file uploaded'}), 400
+        # Turn requests away before receiving the upload if the queue is already full
+        queue.check_capacity()
         
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
+        # Get the file and the similarity threshold, blocking and policy options from form
+        try:
+            file = uploaded_bib_file()
+            threshold, stages, blocking, policies = parse_analysis_options(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        if not file.filename.endswith('.bib'):
+        # Read file content
+        raw_content = file.read()
+        content = raw_content.decode('utf-8')
+        
+        # Debug: profile every stage of the analysis instead of using the cache
+        if current_app.config['PROFILE_MEMORY']:
+            with queue.admit(estimate_analysis_cost(content)):
+                result = run_in_analysis_pool(run_profiled_analysis, content, threshold, stages, blocking, policies)
+            return jsonify(result)
+        
+        # A file analyzed before is only re-clustered at this threshold and policy
+        cache = current_app.extensions['analysis_cache']
+        cache_key = analysis_cache_key(raw_content, stages, blocking)
+        cached = cache.get(cache_key, threshold)
+        if cached is not None:
+            entries_info, candidate_graph = cached
+            return jsonify(build_analysis_response(entries_info, candidate_graph, threshold, policies))
+        
+        # Process the file off the request thread once there is capacity for it
+        with queue.admit(estimate_analysis_cost(content)):
+            result = run_in_analysis_pool(run_analysis, content, threshold, stages, blocking, policies)
+        
+        candidate_graph = result['candidate_graph']
+        cache.put(cache_key, result['entries_info'], candidate_graph,
+                  len(raw_content) * ANALYSIS_CACHE_COST_PER_BYTE +
+                  len(candidate_graph['edges']) * ANALYSIS_CACHE_COST_PER_EDGE)
+        return jsonify(result)
+        
+    except AnalysisRejected as e:
+        return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@routes.route('/analyze_stream', methods=['POST'])
+def analyze_file_stream():
+    """
+    Analyze an uploaded file like /analyze, streaming the results as
+    newline-delimited JSON records so review can start before matching ends.
+    """
+    queue = current_app.extensions['analysis_queue']
+    admission = ExitStack()
+    try:
+        queue.check_capacity()
+        try:
+            file = uploaded_bib_file()
+            threshold, stages, blocking, policies = parse_analysis_options(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        raw_content = file.read()
+        content = raw_content.decode('utf-8')
+        
+        # Held until the stream is closed
+        admission.enter_context(queue.admit(estimate_analysis_cost(content)))
+        cache = current_app.extensions['analysis_cache']
+        cache_key = analysis_cache_key(raw_content, stages, blocking)
+        cached = cache.get(cache_key, threshold)
+        if cached is not None:
+            entries_info, graph = cached
+        else:
+            entries_info = run_in_analysis_pool(extract_entries, content)
+            graph = None
+        pool = get_analysis_pool(current_app)
+    except AnalysisRejected as e:
+        return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        admission.close()
+        return jsonify({'error': str(e)}), 500
+    
+    def generate():
+        try:
+            for record in iter_analysis_stream(entries_info, threshold, stages, blocking, policies, pool, graph):
+                if record['type'] == 'done' and graph is None:
+                    candidate_graph = record['candidate_graph']
+                    cache.put(cache_key, entries_info, candidate_graph,
+                              len(raw_content) * ANALYSIS_CACHE_COST_PER_BYTE +
+                              len(candidate_graph['edges']) * ANALYSIS_CACHE_COST_PER_EDGE)
+                yield json.dumps(record) + '\n'
+        except Exception as e:
+            yield json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.call_on_close(admission.close)
+    return response
+
+@routes.route('/analyze_fingerprints', methods=['POST'])
+def analyze_fingerprints():
+    """Analyze entry fingerprints parsed in the browser - the entry text stays on the client."""
+    queue = current_app.extensions['analysis_queue']
+    try:
+        queue.check_capacity()
+        
+        data = request.get_json()
+        fingerprints = (data or {}).get('fingerprints')
+        if not fingerprints:
+            return jsonify({'error': 'No entries uploaded'}), 400
+        
+        try:
+            threshold, stages, blocking, policies = parse_analysis_options(data)
+            if 'merge' in policies:
+                raise ValueError("The merge policy needs the full entries, please upload the file instead")
+            entries_info = [entry_info_from_fingerprint(fingerprint) for fingerprint in fingerprints]
+        except (ValueError, TypeError, KeyError) as e:
+            return jsonify({'error': f"Invalid fingerprint upload: {str(e)}"}), 400
+        
+        cost = request.content_length * ANALYSIS_COST_PER_BYTE + len(entries_info) * ANALYSIS_COST_PER_ENTRY
+        with queue.admit(cost):
+            result = run_in_analysis_pool(run_entries_analysis, entries_info, threshold, stages, blocking, policies)
+        return jsonify(result)
+        
+    except AnalysisRejected as e:
+        return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def get_chunked_upload(upload_id):
+    """Return this process's parser for an upload, or None if there is no such upload."""
+    if not UPLOAD_ID.fullmatch(upload_id):
+        return None
+    folder = os.path.join(current_app.config['UPLOAD_FOLDER'], upload_id)
+    
+    uploads = current_app.extensions['chunked_uploads']
+    with current_app.extensions['chunked_uploads_lock']:
+        if not os.path.isdir(folder):
+            # Finalized or expired, possibly by another server process
+            uploads.pop(upload_id, None)
+            return None
+        upload = uploads.get(upload_id)
+        if upload is None:
+            # Started by another server process, or before a restart
+            try:
+                with open(os.path.join(folder, 'upload.json')) as f:
+                    metadata = json.load(f)
+            except FileNotFoundError:
+                return None
+            upload = uploads[upload_id] = ChunkedUpload(folder, metadata['size'], metadata['chunk_size'])
+        return upload
+
+def discard_chunked_upload(upload_id):
+    """Delete an upload's chunks and drop its parser."""
+    with current_app.extensions['chunked_uploads_lock']:
+        current_app.extensions['chunked_uploads'].pop(upload_id, None)
+    shutil.rmtree(os.path.join(current_app.config['UPLOAD_FOLDER'], upload_id), ignore_errors=True)
+
+def remove_expired_uploads():
+    """Delete unfinished uploads nobody has added a chunk to for UPLOAD_EXPIRY seconds."""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    expiry = time.time() - current_app.config['UPLOAD_EXPIRY']
+    for upload_id in os.listdir(upload_folder):
+        if not UPLOAD_ID.fullmatch(upload_id):
+            continue
+        folder = os.path.join(upload_folder, upload_id)
+        try:
+            modified = os.path.getmtime(folder)
+        except FileNotFoundError:
+            continue  # Finished or removed by another request since listdir
+        if modified < expiry:
+            discard_chunked_upload(upload_id)
+
+def describe_chunked_upload(upload_id, upload):
+    return {
+        'upload_id': upload_id,
+        'size': upload.size,
+        'chunk_size': upload.chunk_size,
+        'chunk_count': upload.chunk_count,
+        'received_chunks': upload.received_chunks()
+    }
+
+@routes.route('/uploads', methods=['POST'])
+def start_chunked_upload():
+    """Start a resumable upload: {filename, size} -> upload id and chunk size."""
+    try:
+        data = request.get_json() or {}
+        filename = data.get('filename', '')
+        if not filename.endswith('.bib'):
             return jsonify({'error': 'Please upload a .bib file'}), 400
         
-        # Get similarity threshold from form
-        threshold = float(request.form.get('threshold', 0.8))
+        size = int(data.get('size', 0))
+        if size <= 0:
+            return jsonify({'error': 'The file is empty'}), 400
+        if size > current_app.config['UPLOAD_MAX_SIZE']:
+            return jsonify({'error': f"The file is larger than {current_app.config['UPLOAD_MAX_SIZE'] // (1024 * 1024)}MB"}), 413
         
-        # Read file content
-        content = file.read().decode('utf-8')
+        os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
+        remove_expired_uploads()
         
-        # Process the file
-        entries = parse_bib_entries(content)
-        entries_info = [extract_entry_info(entry) for entry in entries]
-        valid_entries = [e for e in entries_info if e is not None]
-        
-        # Find duplicates
-        duplicates = find_duplicates(entries_info, threshold)
-        
-        # Process duplicates - separate identical from non-identical
-        identical_groups = []
-        manual_groups = []
-        auto_resolved = 0
-        
-        for group in duplicates:
-            identical, best_idx = check_identical_entries(entries_info, group)
-            if identical:
-                auto_resolved += 1
-                identical_groups.append({
-                    'group': group,
-                    'best_idx': best_idx,
-                    'citation_key': entries_info[best_idx]['citation_key']
-                })
-            else:
-                # Prepare group info for manual resolution
-                group_info = []
-                for idx in group:
-                    entry = entries_info[idx]
-                    if entry:
-                        group_info.append({
-                            'index': idx,
-                            'citation_key': entry['citation_key'],
-                            'title': entry['title'],
-                            'authors': entry['authors'],
-                            'year': entry['year'],
-                            'doi': entry['doi'],
-                            'type': entry['type'],
-                            'full_entry': entry['full_entry']
-                        })
-                manual_groups.append(group_info)
+        upload_id = secrets.token_hex(16)
+        folder = os.path.join(current_app.config['UPLOAD_FOLDER'], upload_id)
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'upload.json'), 'w') as f:
+            json.dump({'filename': secure_filename(filename), 'size': size,
+                       'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE']}, f)
         
-        return jsonify({
-            'total_entries': len(entries),
-            'valid_entries': len(valid_entries),
-            'duplicate_groups': len(duplicates),
-            'auto_resolved': auto_resolved,
-            'manual_resolution_needed': len(manual_groups),
-            'manual_groups': manual_groups,
-            'identical_groups': identical_groups,
-            'entries_info': entries_info,  # Store for later processing
-            'threshold': threshold
-        })
+        return jsonify(describe_chunked_upload(upload_id, get_chunked_upload(upload_id)))
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@routes.route('/uploads/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    """Report which chunks have arrived, so an interrupted upload can resume."""
+    upload = get_chunked_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Unknown or expired upload'}), 404
+    return jsonify(describe_chunked_upload(upload_id, upload))
+
+@routes.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    """Store one chunk, checked against its X-Chunk-CRC32 header, and parse what is ready."""
+    try:
+        upload = get_chunked_upload(upload_id)
+        if upload is None:
+            return jsonify({'error': 'Unknown or expired upload'}), 404
+        if index >= upload.chunk_count:
+            return jsonify({'error': 'Chunk index out of range'}), 400
+        
+        data = request.get_data(cache=False)
+        if len(data) != upload.chunk_length(index):
+            return jsonify({'error': f"Chunk {index} should be {upload.chunk_length(index)} bytes"}), 400
+        checksum = request.headers.get('X-Chunk-CRC32', '')
+        if not checksum or int(checksum, 16) != zlib.crc32(data):
+            return jsonify({'error': f"Checksum mismatch for chunk {index}, please send it again"}), 422
+        
+        upload.write_chunk(index, data)
+        upload.parse_available()
+        return jsonify({'index': index, 'parsed_entries': len(upload.entries_info)})
         
+    except UnicodeDecodeError:
+        return jsonify({'error': 'The file is not valid UTF-8'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/resolve', methods=['POST'])
+@routes.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_chunked_upload(upload_id):
+    """Analyze a completed upload with the same options as /analyze."""
+    queue = current_app.extensions['analysis_queue']
+    try:
+        queue.check_capacity()
+        
+        upload = get_chunked_upload(upload_id)
+        if upload is None:
+            return jsonify({'error': 'Unknown or expired upload'}), 404
+        
+        received = upload.received_chunks()
+        if len(received) < upload.chunk_count:
+            missing = sorted(set(range(upload.chunk_count)) - set(received))
+            return jsonify({'error': 'The upload is missing chunks', 'missing_chunks': missing}), 409
+        
+        try:
+            threshold, stages, blocking, policies = parse_analysis_options(request.get_json() or {})
+            entries_info = upload.finish()
+        except UnicodeDecodeError:
+            return jsonify({'error': 'The file is not valid UTF-8'}), 400
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        cost = upload.size * ANALYSIS_COST_PER_BYTE + len(entries_info) * ANALYSIS_COST_PER_ENTRY
+        with queue.admit(cost):
+            result = run_in_analysis_pool(run_entries_analysis, entries_info, threshold, stages, blocking, policies)
+        discard_chunked_upload(upload_id)
+        return jsonify(result)
+        
+    except AnalysisRejected as e:
+        return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@routes.route('/recluster', methods=['POST'])
+def recluster_file():
+    """Re-cluster a previous analysis at a new threshold without rescoring."""
+    try:
+        data = request.get_json()
+        entries_info = data.get('entries_info')
+        candidate_graph = data.get('candidate_graph')
+        threshold = float(data.get('threshold', 0.8))
+        
+        if not entries_info or not candidate_graph:
+            return jsonify({'error': 'No previous analysis to re-cluster'}), 400
+        
+        if threshold < candidate_graph['score_floor']:
+            return jsonify({'error': 'Threshold is below the scored floor, please re-analyze'}), 400
+        
+        try:
+            policies = parse_resolution_policies(data.get('policy', ''))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return jsonify(build_analysis_response(entries_info, candidate_graph, threshold, policies))
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def group_resolution(group, action, selected_entry_index=0):
+    """The resolved_groups record of a decision on a manual group, or None if it records nothing."""
+    if action == 'keep_selected':
+        if 0 <= selected_entry_index < len(group):
+            return {'action': 'keep_selected', 'entry': group[selected_entry_index]}
+    elif action == 'keep_all':
+        return {'action': 'keep_all', 'entries': group}
+    elif action == 'skip':
+        return {'action': 'skip'}
+    return None
+
+def undecided_groups(manual_groups, resolved_groups):
+    """Indices of the manual groups resolved_groups has no decision for."""
+    return [i for i in range(len(manual_groups)) if str(i) not in resolved_groups]
+
+def assemble_resolved_output(entries_info, manual_groups, identical_groups, resolved_groups):
+    """
+    Write the entries kept after review to a download file and describe the result.
+    A manual group without a decision keeps all its entries, as if kept with keep_all.
+    """
+    entries_to_keep = []
+    
+    # Add entries that aren't in any duplicate group
+    all_duplicate_indices = set()
+    
+    # Collect all indices from manual groups
+    for group in manual_groups:
+        for entry in group:
+            all_duplicate_indices.add(entry['index'])
+    
+    # Collect all indices from identical groups
+    for group_info in identical_groups:
+        for idx in group_info['group']:
+            all_duplicate_indices.add(idx)
+    
+    # Add non-duplicate entries
+    for i, entry in enumerate(entries_info):
+        if entry is None:
+            continue
+        if i not in all_duplicate_indices:
+            entries_to_keep.append(entry['full_entry'])
+    
+    # Add auto-resolved identical and policy-settled entries
+    for group_info in identical_groups:
+        best_idx = group_info['best_idx']
+        entries_to_keep.append(group_info.get('full_entry') or entries_info[best_idx]['full_entry'])
+    
+    # Add manually resolved entries
+    for group_idx_str, resolution in resolved_groups.items():
+        if resolution['action'] == 'keep_selected':
+            entries_to_keep.append(resolution['entry']['full_entry'])
+        elif resolution['action'] == 'keep_all':
+            for entry in resolution['entries']:
+                entries_to_keep.append(entry['full_entry'])
+        # skip action adds nothing
+    
+    # Undecided groups lose nothing
+    for group_idx in undecided_groups(manual_groups, resolved_groups):
+        for entry in manual_groups[group_idx]:
+            entries_to_keep.append(entry['full_entry'])
+    
+    # Generate output file
+    output_content = '\n\n'.join(entries_to_keep)
+    
+    # Create temporary file for download
+    temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.bib', delete=False)
+    temp_file.write(output_content)
+    temp_file.close()
+    
+    return {
+        'status': 'complete',
+        'message': f'Deduplication complete! Kept {len(entries_to_keep)} entries.',
+        'download_url': f'/download/{os.path.basename(temp_file.name)}',
+        'original_entries': len([e for e in entries_info if e is not None]),
+        'final_entries': len(entries_to_keep),
+        'key_map': resolved_key_map(entries_info, manual_groups, identical_groups, resolved_groups)
+    }
+
+@routes.route('/resolve', methods=['POST'])
 def resolve_duplicates():
-    """Process a single duplicate group resolution."""
+    """
+    Process a single duplicate group resolution, or with action 'finish' write
+    the output from resolution_state's resolved_groups, which must decide every
+    manual group.
+    """
     try:
         data = request.get_json()
         action = data.get('action')
@@ -240,7 +1098,7 @@ def resolve_duplicates():
             'current_group': 0
         })
         
-        current_group = int(resolution_state['current_group'])
+        current_group = int(resolution_state.get('current_group', 0))
         resolved_groups = resolution_state.get('resolved_groups', {})
         
         # Handle auto_complete action (when no manual resolution needed)
@@ -255,7 +1113,7 @@ def resolve_duplicates():
                 for idx in group_info['group']:
                     all_duplicate_indices.add(idx)
                 best_idx = group_info['best_idx']
-                entries_to_keep.append(entries_info[best_idx]['full_entry'])
+                entries_to_keep.append(group_info.get('full_entry') or entries_info[best_idx]['full_entry'])
             
             # Add non-duplicate entries
             for i, entry in enumerate(entries_info):
@@ -276,88 +1134,30 @@ def resolve_duplicates():
                 'message': f'Deduplication complete! Kept {len(entries_to_keep)} entries.',
                 'download_url': f'/download/{os.path.basename(temp_file.name)}',
                 'original_entries': len([e for e in entries_info if e is not None]),
-                'final_entries': len(entries_to_keep)
+                'final_entries': len(entries_to_keep),
+                'key_map': resolved_key_map(entries_info, [], identical_groups, {})
             })
         
-        # Process the current group based on action
-        if action == 'keep_selected' and current_group < len(manual_groups):
-            group = manual_groups[current_group]
-            if 0 <= selected_entry_index < len(group):
-                selected_entry = group[selected_entry_index]
-                resolved_groups[str(current_group)] = {  # Use string key
-                    'action': 'keep_selected',
-                    'entry': selected_entry
-                }
+        # Finish with every decision made elsewhere (e.g. a review that expired)
+        if action == 'finish':
+            undecided = undecided_groups(manual_groups, resolved_groups)
+            if undecided:
+                return jsonify({'error': f'{len(undecided)} groups have no decision',
+                                'undecided_groups': undecided}), 409
+            return jsonify(assemble_resolved_output(entries_info, manual_groups, identical_groups, resolved_groups))
         
-        elif action == 'keep_all' and current_group < len(manual_groups):
-            group = manual_groups[current_group]
-            resolved_groups[str(current_group)] = {  # Use string key
-                'action': 'keep_all',
-                'entries': group
-            }
-        
-        elif action == 'skip' and current_group < len(manual_groups):
-            resolved_groups[str(current_group)] = {  # Use string key
-                'action': 'skip'
-            }
+        # Process the current group based on action
+        if current_group < len(manual_groups):
+            resolution = group_resolution(manual_groups[current_group], action, selected_entry_index)
+            if resolution:
+                resolved_groups[str(current_group)] = resolution  # Use string key
         
         # Move to next group
         current_group += 1
         
         # Check if we're done with all groups
         if current_group >= len(manual_groups):
-            # Generate final output
-            entries_to_keep = []
-            
-            # Add entries that aren't in any duplicate group
-            all_duplicate_indices = set()
-            
-            # Collect all indices from manual groups
-            for group in manual_groups:
-                for entry in group:
-                    all_duplicate_indices.add(entry['index'])
-            
-            # Collect all indices from identical groups
-            for group_info in identical_groups:
-                for idx in group_info['group']:
-                    all_duplicate_indices.add(idx)
-            
-            # Add non-duplicate entries
-            for i, entry in enumerate(entries_info):
-                if entry is None:
-                    continue
-                if i not in all_duplicate_indices:
-                    entries_to_keep.append(entry['full_entry'])
-            
-            # Add auto-resolved identical entries
-            for group_info in identical_groups:
-                best_idx = group_info['best_idx']
-                entries_to_keep.append(entries_info[best_idx]['full_entry'])
-            
-            # Add manually resolved entries
-            for group_idx_str, resolution in resolved_groups.items():
-                if resolution['action'] == 'keep_selected':
-                    entries_to_keep.append(resolution['entry']['full_entry'])
-                elif resolution['action'] == 'keep_all':
-                    for entry in resolution['entries']:
-                        entries_to_keep.append(entry['full_entry'])
-                # skip action adds nothing
-            
-            # Generate output file
-            output_content = '\n\n'.join(entries_to_keep)
-            
-            # Create temporary file for download
-            temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.bib', delete=False)
-            temp_file.write(output_content)
-            temp_file.close()
-            
-            return jsonify({
-                'status': 'complete',
-                'message': f'Deduplication complete! Kept {len(entries_to_keep)} entries.',
-                'download_url': f'/download/{os.path.basename(temp_file.name)}',
-                'original_entries': len([e for e in entries_info if e is not None]),
-                'final_entries': len(entries_to_keep)
-            })
+            return jsonify(assemble_resolved_output(entries_info, manual_groups, identical_groups, resolved_groups))
         
         else:
             # Return next group to resolve
@@ -379,7 +1179,229 @@ def resolve_duplicates():
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
-@app.route('/download/<filename>')
+# Review sessions: the analysis is stored once per review, so decisions can be
+# sent in small batches instead of one /resolve round trip per group
+REVIEW_ACTIONS = ('keep_selected', 'keep_all', 'skip')
+
+def get_review_folder(review_id):
+    """Return a review's folder, or None if there is no such review."""
+    if not UPLOAD_ID.fullmatch(review_id):
+        return None
+    folder = os.path.join(current_app.config['REVIEW_FOLDER'], review_id)
+    if not os.path.exists(os.path.join(folder, 'review.json')):
+        # Finished or expired, possibly by another server process
+        return None
+    return folder
+
+def remove_expired_reviews():
+    """Delete reviews nobody has sent decisions to for REVIEW_EXPIRY seconds."""
+    review_folder = current_app.config['REVIEW_FOLDER']
+    expiry = time.time() - current_app.config['REVIEW_EXPIRY']
+    for review_id in os.listdir(review_folder):
+        if not UPLOAD_ID.fullmatch(review_id):
+            continue
+        folder = os.path.join(review_folder, review_id)
+        try:
+            modified = os.path.getmtime(folder)
+        except FileNotFoundError:
+            continue  # Finished or removed by another request since listdir
+        if modified < expiry:
+            shutil.rmtree(folder, ignore_errors=True)
+
+def parse_review_decisions(decisions, group_sizes):
+    """Validate a batch of {group_index, action, selected_entry_index} decisions."""
+    if not isinstance(decisions, list):
+        raise ValueError('decisions must be a list')
+    parsed = []
+    for decision in decisions:
+        if not isinstance(decision, dict):
+            raise ValueError('Each decision must be an object')
+        group_index = int(decision.get('group_index', -1))
+        action = decision.get('action')
+        selected_entry_index = int(decision.get('selected_entry_index', 0))
+        if not 0 <= group_index < len(group_sizes):
+            raise ValueError(f"Group {group_index} is out of range")
+        if action not in REVIEW_ACTIONS:
+            raise ValueError(f"Unknown action: {action} (choose from {', '.join(REVIEW_ACTIONS)})")
+        if action == 'keep_selected' and not 0 <= selected_entry_index < group_sizes[group_index]:
+            raise ValueError(f"Group {group_index} has no entry {selected_entry_index}")
+        parsed.append([group_index, action, selected_entry_index])
+    return parsed
+
+def record_review_decisions(folder, decisions):
+    """Append a batch of decisions; later decisions on a group replace earlier ones."""
+    if decisions:
+        with open(os.path.join(folder, 'decisions.jsonl'), 'a') as f:
+            f.write(json.dumps(decisions) + '\n')
+    os.utime(folder)  # Keeps the review from expiring
+
+def load_review_decisions(folder):
+    """The latest decision on each group, as group index -> (action, selected entry)."""
+    decided = {}
+    try:
+        with open(os.path.join(folder, 'decisions.jsonl')) as f:
+            for line in f:
+                for group_index, action, selected_entry_index in json.loads(line):
+                    decided[group_index] = (action, selected_entry_index)
+    except FileNotFoundError:
+        pass
+    return decided
+
+def load_review_metadata(folder):
+    with open(os.path.join(folder, 'metadata.json')) as f:
+        return json.load(f)
+
+@routes.route('/reviews', methods=['POST'])
+def start_review():
+    """Start a review session from /resolve's entries_info, manual_groups and identical_groups."""
+    try:
+        data = request.get_json() or {}
+        entries_info = data.get('entries_info')
+        manual_groups = data.get('manual_groups')
+        identical_groups = data.get('identical_groups', [])
+        if not isinstance(entries_info, list) or not isinstance(manual_groups, list):
+            return jsonify({'error': 'entries_info and manual_groups are required'}), 400
+        
+        os.makedirs(current_app.config['REVIEW_FOLDER'], exist_ok=True)
+        remove_expired_reviews()
+        
+        review_id = secrets.token_hex(16)
+        folder = os.path.join(current_app.config['REVIEW_FOLDER'], review_id)
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'metadata.json'), 'w') as f:
+            json.dump({'group_sizes': [len(group) for group in manual_groups]}, f)
+        # Written last and moved into place: a review exists once it is complete
+        partial_path = os.path.join(folder, 'review.json.partial')
+        with open(partial_path, 'w') as f:
+            json.dump({'entries_info': entries_info, 'manual_groups': manual_groups,
+                       'identical_groups': identical_groups}, f)
+        os.replace(partial_path, os.path.join(folder, 'review.json'))
+        
+        return jsonify({'review_id': review_id, 'total_groups': len(manual_groups)})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@routes.route('/reviews/<review_id>/decisions', methods=['POST'])
+def record_decisions(review_id):
+    """Record a batch of decisions: {decisions: [{group_index, action, selected_entry_index}, ...]}."""
+    try:
+        folder = get_review_folder(review_id)
+        if folder is None:
+            return jsonify({'error': 'Unknown or expired review'}), 404
+        
+        group_sizes = load_review_metadata(folder)['group_sizes']
+        try:
+            decisions = parse_review_decisions((request.get_json() or {}).get('decisions', []), group_sizes)
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        record_review_decisions(folder, decisions)
+        return jsonify({
+            'review_id': review_id,
+            'recorded': len(decisions),
+            'decided_groups': len(load_review_decisions(folder)),
+            'total_groups': len(group_sizes)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@routes.route('/reviews/<review_id>/finish', methods=['POST'])
+def finish_review(review_id):
+    """
+    Record any last decisions and write the output, as /resolve does for its last
+    group. While groups are undecided the review is kept and 409 lists them.
+    """
+    try:
+        folder = get_review_folder(review_id)
+        if folder is None:
+            return jsonify({'error': 'Unknown or expired review'}), 404
+        
+        group_sizes = load_review_metadata(folder)['group_sizes']
+        try:
+            decisions = parse_review_decisions((request.get_json() or {}).get('decisions', []), group_sizes)
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': str(e)}), 400
+        record_review_decisions(folder, decisions)
+        
+        with open(os.path.join(folder, 'review.json')) as f:
+            review = json.load(f)
+        manual_groups = review['manual_groups']
+        resolved_groups = {}
+        for group_index, (action, selected_entry_index) in sorted(load_review_decisions(folder).items()):
+            resolution = group_resolution(manual_groups[group_index], action, selected_entry_index)
+            if resolution:
+                resolved_groups[str(group_index)] = resolution
+        undecided = undecided_groups(manual_groups, resolved_groups)
+        if undecided:
+            return jsonify({'error': f'{len(undecided)} groups have no decision',
+                            'undecided_groups': undecided}), 409
+        
+        result = assemble_resolved_output(review['entries_info'], manual_groups, review['identical_groups'],
+                                          resolved_groups)
+        shutil.rmtree(folder, ignore_errors=True)
+        return jsonify(result)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+_library_connections = threading.local()
+
+def get_library_index():
+    """Return this thread's connection to the configured library index, or None."""
+    index_path = current_app.config['LIBRARY_INDEX']
+    if not index_path or not os.path.exists(index_path):
+        return None
+    
+    connections = getattr(_library_connections, 'connections', None)
+    if connections is None:
+        connections = _library_connections.connections = {}
+    if index_path not in connections:
+        connections[index_path] = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+    return connections[index_path]
+
+@routes.route('/check', methods=['POST'])
+def check_citation():
+    """Check one citation against the library index and return the top candidate matches."""
+    try:
+        conn = get_library_index()
+        if conn is None:
+            return jsonify({'error': 'No library index is configured'}), 404
+        
+        data = request.get_json()
+        query = (data or {}).get('entry', '')
+        if not query.strip():
+            return jsonify({'error': 'No citation to check'}), 400
+        
+        start_time = time.perf_counter()
+        try:
+            matches = query_library_index(
+                conn, query,
+                limit=int(data.get('limit', 5)),
+                similarity_threshold=float(data.get('threshold', 0.8))
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return jsonify({
+            'matches': matches,
+            'duplicate': any(match['duplicate'] for match in matches),
+            'milliseconds': round((time.perf_counter() - start_time) * 1000, 3)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@routes.route('/metrics')
+def analysis_metrics():
+    """Report analysis queue depth, capacity and wait times, and result cache use."""
+    metrics = current_app.extensions['analysis_queue'].metrics()
+    metrics.update(current_app.extensions['analysis_cache'].metrics())
+    metrics['analysis_workers'] = current_app.config['ANALYSIS_WORKERS']
+    return jsonify(metrics)
+
+@routes.route('/download/<filename>')
 def download_file(filename):
     """Download the deduplicated file."""
     try:
@@ -399,5 +1421,8 @@ def download_file(filename):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Module-level app for Vercel and `flask run`
+app = create_app()
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
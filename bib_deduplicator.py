@@ -13,8 +13,33 @@ import tkinter as tk
 from tkinter import ttk, filedialog, scrolledtext, messagebox
 from difflib import SequenceMatcher
 import threading
+import json
+import string
+import time
+import glob
+import io
+import contextlib
+import random
+import sqlite3
+import zlib
+import struct
+import tempfile
+import multiprocessing
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from queue import Queue
 import argparse  # Added missing import for command line mode
+from bibdedup_core import (
+    DEFAULT_BLOCKING, MATCHING_KEYS, RESOLUTION_POLICIES, SCORE_FLOOR, MemoryProfiler, add_to_candidate_graph,
+    bib_field_value, blocking_key, build_candidate_graph, build_library_index, check_identical_entries,
+    cluster_candidate_graph,
+    configure_blocking, extract_entry_info, find_duplicates, find_identifier_groups, finish_candidate_graph,
+    format_memory_profile, format_stage_stats, get_stage, group_key_map, identifier_keys, iter_bib_entries,
+    iter_candidate_pairs, iter_new_candidate_pairs, library_index_is_current, load_matching_stages,
+    match_title_containment, parse_bib_entries, parse_resolution_policies, profile_stage, query_library_index,
+    resolve_group, resolve_matching_stages, run_matching_cascade, start_candidate_graph, union_identifier_keys
+)
 
 class BibDedupGUI:
     def __init__(self, root):
@@ -32,13 +57,33 @@ class BibDedupGUI:
         self.entries_info = []
         self.duplicates = []
         self.entries_to_keep = []
+        self.key_map = {}  # Dropped citation key -> kept key
         self.current_duplicate_idx = 0
         self.selected_entry = tk.IntVar(value=0)
         self.stop_requested = False
         
+        # Process parsing and scoring the current file (see analysis_process_main)
+        self.analysis_process = None
+        
+        # Review list rows (group positions) and rendered text cached by entry index
+        self.group_rows = []
+        self.row_label_cache = {}
+        self.entry_view_cache = {}
+        
+        # Scored candidate graph of the loaded file, re-clustered on threshold changes
+        self.candidate_graph = None
+        self.graph_source = None
+        
+        # Matching cascade stages (None uses the defaults)
+        self.matching_stages = None
+        
         # Configuration options
         self.similarity_threshold = tk.DoubleVar(value=0.8)
         self.threshold_label = tk.StringVar(value="0.80")  # Fixed: Added a separate StringVar for the label
+        self.blocking_method = tk.StringVar(value="year")
+        self.neighborhood_window = tk.IntVar(value=DEFAULT_BLOCKING['window'])
+        self.year_tolerance = tk.IntVar(value=0)
+        self.resolution_policy = tk.StringVar(value="manual")
         
         # Message queue for thread communication
         self.queue = Queue()
@@ -58,10 +103,25 @@ class BibDedupGUI:
         
         # Setup threshold update callback
         self.similarity_threshold.trace_add("write", self._update_threshold_label)
+        
+        # Offer to save an unfinished review when the window is closed
+        self.root.protocol("WM_DELETE_WINDOW", self._close)
     
     def _update_threshold_label(self, *args):
         """Update the threshold label when the slider changes."""
-        self.threshold_label.set(f"{self.similarity_threshold.get():.2f}")
+        threshold = self.similarity_threshold.get()
+        
+        # Preview the group count live once a scored graph is cached
+        if self.candidate_graph is not None and self.candidate_graph['score_floor'] <= threshold:
+            groups = cluster_candidate_graph(self.entries_info, self.candidate_graph, threshold)
+            self.threshold_label.set(f"{threshold:.2f} ({len(groups)} groups)")
+        else:
+            self.threshold_label.set(f"{threshold:.2f}")
+    
+    def _graph_source(self, path, blocking_settings):
+        """Identify a file version and blocking settings for the candidate graph cache."""
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime, stat.st_size, blocking_settings)
     
     def _create_ui(self):
         """Create the user interface."""
@@ -117,6 +177,31 @@ class BibDedupGUI:
         # Fixed: Use the separate StringVar for the threshold label
         ttk.Label(settings_frame, textvariable=self.threshold_label).grid(row=0, column=2, padx=5)
         
+        ttk.Label(settings_frame, text="Candidate Blocking:").grid(row=1, column=0, sticky=tk.W, pady=5)
+        ttk.Combobox(
+            settings_frame,
+            textvariable=self.blocking_method,
+            values=["year", "sorted_neighborhood"],
+            state="readonly",
+            width=20
+        ).grid(row=1, column=1, sticky=tk.W, padx=5, pady=5)
+        
+        ttk.Label(settings_frame, text="Neighborhood Window:").grid(row=2, column=0, sticky=tk.W, pady=5)
+        ttk.Spinbox(settings_frame, from_=2, to=500, textvariable=self.neighborhood_window, width=8).grid(row=2, column=1, sticky=tk.W, padx=5, pady=5)
+        
+        ttk.Label(settings_frame, text="Year Tolerance (±years):").grid(row=3, column=0, sticky=tk.W, pady=5)
+        ttk.Spinbox(settings_frame, from_=0, to=10, textvariable=self.year_tolerance, width=8).grid(row=3, column=1, sticky=tk.W, padx=5, pady=5)
+        
+        # Groups a policy settles are resolved without asking
+        ttk.Label(settings_frame, text="Automatic Resolution:").grid(row=4, column=0, sticky=tk.W, pady=5)
+        ttk.Combobox(
+            settings_frame,
+            textvariable=self.resolution_policy,
+            values=["manual", "prefer_doi,prefer_journal,most_complete", "most_complete",
+                    "prefer_doi", "prefer_journal", "merge", "first"],
+            width=40
+        ).grid(row=4, column=1, columnspan=2, sticky=tk.W, padx=5, pady=5)
+        
         # Main interface in tab 1
         
         # File selection frame
@@ -136,6 +221,7 @@ class BibDedupGUI:
         
         ttk.Button(button_frame, text="Start Analysis", command=self._start_analysis).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="Stop Processing", command=self._stop_processing).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Open Session...", command=self._open_session).pack(side=tk.LEFT, padx=5)
         
         # Progress frame
         progress_frame = ttk.Frame(main_tab, padding="5")
@@ -154,9 +240,24 @@ class BibDedupGUI:
         self.group_label = ttk.Label(self.dup_frame, text="Group 0 of 0")
         self.group_label.grid(row=1, column=0, sticky=tk.W, pady=5)
         
-        # Radio button frame for selection
-        self.radio_frame = ttk.Frame(self.dup_frame)
-        self.radio_frame.grid(row=2, column=0, columnspan=2, sticky=tk.EW, pady=5)
+        # Entry list for selection - a listbox only draws its visible rows,
+        # so large groups stay fast
+        list_frame = ttk.Frame(self.dup_frame)
+        list_frame.grid(row=2, column=0, columnspan=2, sticky=tk.EW, pady=5)
+        
+        ttk.Label(
+            list_frame,
+            text="These entries are similar but not identical:",
+            style="Header.TLabel"
+        ).pack(anchor=tk.W, pady=(0, 10))
+        
+        self.entry_list = tk.Listbox(list_frame, height=8, selectmode=tk.BROWSE,
+                                     exportselection=False, activestyle=tk.NONE)
+        list_scrollbar = ttk.Scrollbar(list_frame, orient=tk.VERTICAL, command=self.entry_list.yview)
+        self.entry_list.configure(yscrollcommand=list_scrollbar.set)
+        self.entry_list.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        list_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.entry_list.bind("<<ListboxSelect>>", self._select_list_entry)
         
         # Comparison frame - two text widgets side by side
         compare_frame = ttk.Frame(self.dup_frame)
@@ -176,6 +277,7 @@ class BibDedupGUI:
         ttk.Button(button_frame, text="Keep Selected", command=self._keep_selected).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="Keep All in Group", command=self._keep_all).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="Skip Group", command=self._next_duplicate).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Save Session...", command=self._save_session).pack(side=tk.RIGHT, padx=5)
         
         # Set weight for resizing
         self.root.columnconfigure(0, weight=1)
@@ -202,10 +304,17 @@ class BibDedupGUI:
         self.stdout_original.flush()
         
     def _stop_processing(self):
-        """Request to stop current processing."""
+        """Stop the current analysis by ending its process."""
+        process = self.analysis_process
+        if process is None or not process.is_alive():
+            self.status.set("No analysis running")
+            return
+        
         self.stop_requested = True
-        self.status.set("Stop requested - finishing current task...")
-        print("Stop requested by user. Waiting for current task to complete...")
+        process.terminate()
+        self.progress_value.set(0)
+        self.status.set("Analysis stopped")
+        print("Analysis stopped by user.")
     
     def _browse_input(self):
         """Browse for input BibTeX file."""
@@ -230,7 +339,7 @@ class BibDedupGUI:
             self.output_file.set(filename)
     
     def _start_analysis(self):
-        """Start the analysis process in a separate thread."""
+        """Start the analysis in a separate process, or re-cluster a cached graph in a thread."""
         input_file = self.input_file.get()
         output_file = self.output_file.get()
         
@@ -246,52 +355,111 @@ class BibDedupGUI:
             messagebox.showerror("Error", f"File '{input_file}' not found.")
             return
         
+        if self.resolution_policy.get() != "manual":
+            try:
+                parse_resolution_policies(self.resolution_policy.get())
+            except ValueError as e:
+                messagebox.showerror("Error", str(e))
+                return
+        
+        # Reuse the scored graph if the same file is analyzed again
+        threshold = self.similarity_threshold.get()
+        blocking_settings = (self.blocking_method.get(), self.neighborhood_window.get(), self.year_tolerance.get())
+        graph_source = self._graph_source(input_file, blocking_settings)
+        reuse_graph = (
+            self.candidate_graph is not None
+            and self.graph_source == graph_source
+            and self.candidate_graph['score_floor'] <= threshold
+        )
+        
         # Reset state
-        self.entries = []
-        self.entries_info = []
+        if not reuse_graph:
+            self.entries = []
+            self.entries_info = []
+            self.candidate_graph = None
+            self.graph_source = None
         self.duplicates = []
         self.entries_to_keep = []
+        self.key_map = {}
         self.current_duplicate_idx = 0
         self.stop_requested = False
         
-        # Start worker thread
+        if reuse_graph:
+            threading.Thread(target=self._analysis_worker, args=(output_file, threshold), daemon=True).start()
+            return
+        
+        # Parse and score in a separate process, which keeps the GIL away from
+        # the Tk main loop and can be killed at once by Stop
+        if self.analysis_process is not None and self.analysis_process.is_alive():
+            self.analysis_process.terminate()
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+        self.analysis_process = context.Process(
+            target=analysis_process_main,
+            args=(sender, input_file, threshold, self.matching_stages, blocking_settings),
+            daemon=True
+        )
+        self.analysis_process.start()
+        sender.close()
+        
         threading.Thread(
-            target=self._analysis_worker,
-            args=(input_file, output_file),
+            target=self._read_analysis_process,
+            args=(receiver, self.analysis_process, output_file, threshold, graph_source),
             daemon=True
         ).start()
     
-    def _analysis_worker(self, input_file, output_file):
-        """Worker thread for analysis to avoid freezing UI."""
+    def _analysis_worker(self, output_file, threshold):
+        """Worker thread re-clustering the cached candidate graph at a new threshold."""
         try:
-            # Update status
-            self.queue.put(("status", "Parsing BibTeX file..."))
-            self.queue.put(("progress", 0))
-            
-            # Parse entries
-            self.entries = parse_bib_entries(input_file)
-            self.queue.put(("status", f"Found {len(self.entries)} entries."))
-            self.queue.put(("progress", 10))
-            
-            # Extract entry info
-            self.queue.put(("status", "Extracting information from entries..."))
-            total_entries = len(self.entries)
-            self.entries_info = []
-            
-            for i, entry in enumerate(self.entries):
-                self.entries_info.append(extract_entry_info(entry))
-                progress = 10 + (i / total_entries) * 30
-                self.queue.put(("progress", progress))
-            
-            valid_entries = sum(1 for e in self.entries_info if e is not None)
-            self.queue.put(("status", f"Successfully parsed {valid_entries} entries."))
-            self.queue.put(("progress", 40))
-            
-            # Find duplicates
-            self.queue.put(("status", "Finding duplicate entries..."))
-            # Pass the similarity threshold from the GUI
-            self.duplicates = find_duplicates(self.entries_info, self.similarity_threshold.get())
+            self.queue.put(("status", "Re-clustering cached candidate graph..."))
+            self.duplicates = cluster_candidate_graph(self.entries_info, self.candidate_graph, threshold)
             self.queue.put(("status", f"Found {len(self.duplicates)} potential duplicate groups."))
+            self._finish_analysis(output_file)
+        except Exception as e:
+            self.queue.put(("error", str(e)))
+    
+    def _read_analysis_process(self, receiver, process, output_file, threshold, graph_source):
+        """Relay the analysis process's events to the GUI queue and take over its result."""
+        try:
+            while True:
+                try:
+                    message, data = receiver.recv()
+                except EOFError:
+                    # Stopped, replaced by a newer analysis, or died without a result
+                    process.join()
+                    if process is self.analysis_process and not self.stop_requested:
+                        self.queue.put(("error", f"The analysis process exited unexpectedly "
+                                                 f"(exit code {process.exitcode})."))
+                    return
+                
+                if process is not self.analysis_process or self.stop_requested:
+                    continue
+                if message != "result":
+                    self.queue.put((message, data))
+                    if message == "error":
+                        return
+                    continue
+                
+                entries_info, unparsed, self.candidate_graph = data
+                self.entries_info = entries_info
+                self.entries = [unparsed[i] if entry is None else entry['full_entry']
+                                for i, entry in enumerate(entries_info)]
+                self.graph_source = graph_source
+                self.queue.put(("progress", 75))
+                
+                # Find duplicates at the threshold from the GUI
+                self.queue.put(("status", "Finding duplicate entries..."))
+                self.duplicates = cluster_candidate_graph(self.entries_info, self.candidate_graph, threshold)
+                self.queue.put(("status", f"Found {len(self.duplicates)} potential duplicate groups."))
+                self._finish_analysis(output_file)
+        except Exception as e:
+            self.queue.put(("error", str(e)))
+        finally:
+            receiver.close()
+    
+    def _finish_analysis(self, output_file):
+        """Write the output or hand over to duplicate resolution."""
+        try:
             self.queue.put(("progress", 80))
             
             if not self.duplicates:
@@ -305,6 +473,7 @@ class BibDedupGUI:
                         entries_to_keep.append(entry)
                 
                 write_output_file(entries_to_keep, output_file)
+                write_key_map(self.key_map, key_map_path(output_file))
                 self.queue.put(("progress", 100))
                 self.queue.put(("status", f"Complete! Output written to {output_file}"))
                 self.queue.put(("message", f"No duplicates found.\nOriginal file copied to {output_file}"))
@@ -338,6 +507,8 @@ class BibDedupGUI:
                     self.progress_value.set(data)
                 elif message == "show_duplicates":
                     self._show_duplicate_resolution()
+                elif message == "log":
+                    self.write(data)
                 elif message == "message":
                     messagebox.showinfo("Information", data)
                 elif message == "error":
@@ -354,69 +525,108 @@ class BibDedupGUI:
     def _show_duplicate_resolution(self):
         """Show the duplicate resolution interface."""
         self.dup_frame.pack(fill=tk.BOTH, expand=True, pady=5)
+        self.row_label_cache = {}
+        self.entry_view_cache = {}
         self._show_current_duplicate()
     
+    def _auto_resolve_group(self, group):
+        """Settle a group without the user if it is identical or a policy decides it."""
+        # Check if entries are identical
+        identical, best_idx = check_identical_entries(self.entries_info, group)
+        if identical:
+            # Automatically keep the best entry
+            print(f"Automatically selecting identical entry: {self.entries_info[best_idx]['citation_key']}")
+            self.entries_to_keep.append(self.entries_info[best_idx]['full_entry'])
+            self.key_map.update(group_key_map(self.entries_info, group, best_idx))
+            return True
+        
+        policy = self.resolution_policy.get()
+        if policy != "manual":
+            resolution = resolve_group(self.entries_info, group, parse_resolution_policies(policy))
+            if resolution:
+                print(f"Resolved by {resolution['policy']}: {self.entries_info[resolution['index']]['citation_key']}")
+                self.entries_to_keep.append(resolution['entry'])
+                self.key_map.update(group_key_map(self.entries_info, group, resolution['index']))
+                return True
+        
+        return False
+    
     def _show_current_duplicate(self):
         """Show the current duplicate group for resolution."""
+        # Skip over groups that settle themselves
+        while (self.current_duplicate_idx < len(self.duplicates)
+               and self._auto_resolve_group(self.duplicates[self.current_duplicate_idx])):
+            self.current_duplicate_idx += 1
+        
         if self.current_duplicate_idx >= len(self.duplicates):
             # All duplicates processed
             self._write_output_file()
             return
         
-        # Clear previous radio buttons
-        for widget in self.radio_frame.winfo_children():
-            widget.destroy()
-        
         # Update group label
         self.group_label.config(text=f"Group {self.current_duplicate_idx + 1} of {len(self.duplicates)}")
         
         # Get current duplicate group
         group = self.duplicates[self.current_duplicate_idx]
         
-        # Check if entries are identical
-        identical, best_idx = check_identical_entries(self.entries_info, group)
-        if identical:
-            # Automatically keep the best entry and move to next group
-            print(f"Automatically selecting identical entry: {self.entries_info[best_idx]['citation_key']}")
-            self.entries_to_keep.append(self.entries_info[best_idx]['full_entry'])
-            self.current_duplicate_idx += 1
-            self._show_current_duplicate()
-            return
-        
-        # Reset selection
-        self.selected_entry.set(0)
+        # Refill the list in one call; rows map back to positions in the group
+        self.group_rows = [pos for pos, entry_idx in enumerate(group) if self.entries_info[entry_idx] is not None]
+        self.entry_list.delete(0, tk.END)
+        self.entry_list.insert(tk.END, *(self._row_label(group[pos]) for pos in self.group_rows))
         
-        # Add a label indicating these are not identical
-        ttk.Label(
-            self.radio_frame,
-            text="These entries are similar but not identical:",
-            style="Header.TLabel"
-        ).grid(row=0, column=0, sticky=tk.W, pady=(0, 10))
+        # Initialize view with first entry
+        self.entry_list.selection_set(0)
+        self.entry_list.see(0)
+        self.selected_entry.set(self.group_rows[0] if self.group_rows else 0)
+        self._update_entry_view()
         
-        # Create radio buttons for each entry in the group
-        for idx, entry_idx in enumerate(group):
+        # Render the next group while the user reads this one
+        self.root.after_idle(self._prefetch_group, self.current_duplicate_idx + 1)
+    
+    def _row_label(self, entry_idx):
+        """List row text for an entry, cached."""
+        label = self.row_label_cache.get(entry_idx)
+        if label is None:
             entry = self.entries_info[entry_idx]
-            if entry is None:
-                continue
-                
-            citation_key = entry['citation_key']
             title = entry['title'][:40] + "..." if len(entry['title']) > 40 else entry['title']
-            year = entry['year']
-            
-            label_text = f"{citation_key} ({year}): {title}"
+            label = self.row_label_cache[entry_idx] = f"{entry['citation_key']} ({entry['year']}): {title}"
+        return label
+    
+    def _entry_view(self, entry_idx):
+        """Formatted entry view text for an entry, cached."""
+        text = self.entry_view_cache.get(entry_idx)
+        if text is None:
+            entry = self.entries_info[entry_idx]
             
-            radio = ttk.Radiobutton(
-                self.radio_frame,
-                text=label_text,
-                variable=self.selected_entry,
-                value=idx,
-                command=self._update_entry_view
-            )
-            radio.grid(row=idx+1, column=0, sticky=tk.W, pady=2)
-        
-        # Initialize view with first entry
-        self.selected_entry.set(0)
-        self._update_entry_view()
+            # Format the entry nicely
+            parts = [f"Citation Key: {entry['citation_key']}\n\n", f"Entry Type: {entry['type']}\n\n"]
+            if entry['title']:
+                parts.append(f"Title: {entry['title']}\n\n")
+            if entry['authors']:
+                parts.append(f"Authors: {entry['authors']}\n\n")
+            if entry['year']:
+                parts.append(f"Year: {entry['year']}\n\n")
+            if entry['doi']:
+                parts.append(f"DOI: {entry['doi']}\n\n")
+            parts.append("Full Entry:\n")
+            parts.append(entry['full_entry'])
+            text = self.entry_view_cache[entry_idx] = "".join(parts)
+        return text
+    
+    def _prefetch_group(self, group_idx):
+        """Render the rows and entry views of an upcoming group ahead of time."""
+        if group_idx < len(self.duplicates):
+            for entry_idx in self.duplicates[group_idx]:
+                if self.entries_info[entry_idx] is not None:
+                    self._row_label(entry_idx)
+                    self._entry_view(entry_idx)
+    
+    def _select_list_entry(self, event=None):
+        """Select the group entry of the clicked list row."""
+        selection = self.entry_list.curselection()
+        if selection:
+            self.selected_entry.set(self.group_rows[selection[0]])
+            self._update_entry_view()
     
     def _update_entry_view(self):
         """Update the entry view with the selected entry."""
@@ -425,30 +635,9 @@ class BibDedupGUI:
         
         if 0 <= selected_idx < len(group):
             entry_idx = group[selected_idx]
-            entry = self.entries_info[entry_idx]
-            
-            if entry is not None:
-                # Clear text
+            if self.entries_info[entry_idx] is not None:
                 self.entry_text.delete(1.0, tk.END)
-                
-                # Format the entry nicely
-                self.entry_text.insert(tk.END, f"Citation Key: {entry['citation_key']}\n\n")
-                self.entry_text.insert(tk.END, f"Entry Type: {entry['type']}\n\n")
-                
-                if entry['title']:
-                    self.entry_text.insert(tk.END, f"Title: {entry['title']}\n\n")
-                
-                if entry['authors']:
-                    self.entry_text.insert(tk.END, f"Authors: {entry['authors']}\n\n")
-                
-                if entry['year']:
-                    self.entry_text.insert(tk.END, f"Year: {entry['year']}\n\n")
-                
-                if entry['doi']:
-                    self.entry_text.insert(tk.END, f"DOI: {entry['doi']}\n\n")
-                
-                self.entry_text.insert(tk.END, "Full Entry:\n")
-                self.entry_text.insert(tk.END, entry['full_entry'])
+                self.entry_text.insert(tk.END, self._entry_view(entry_idx))
     
     def _keep_selected(self):
         """Keep the selected entry and move to next duplicate group."""
@@ -461,6 +650,7 @@ class BibDedupGUI:
             
             if entry is not None:
                 self.entries_to_keep.append(entry['full_entry'])
+                self.key_map.update(group_key_map(self.entries_info, group, entry_idx))
         
         self.current_duplicate_idx += 1
         self._show_current_duplicate()
@@ -491,6 +681,8 @@ class BibDedupGUI:
         
         try:
             write_output_file(self.entries_to_keep, output_file)
+            key_map_file = key_map_path(output_file)
+            write_key_map(self.key_map, key_map_file)
             self.progress_value.set(100)
             self.status.set("Complete!")
             
@@ -498,7 +690,8 @@ class BibDedupGUI:
                 f"Deduplication complete!\n\n"
                 f"Original entries: {len(self.entries)}\n"
                 f"Entries after deduplication: {len(self.entries_to_keep)}\n\n"
-                f"Output written to:\n{output_file}"
+                f"Output written to:\n{output_file}\n\n"
+                f"Map of {len(self.key_map)} replaced citation keys written to:\n{key_map_file}"
             )
             messagebox.showinfo("Deduplication Complete", message)
             
@@ -508,186 +701,1543 @@ class BibDedupGUI:
         except Exception as e:
             messagebox.showerror("Error", f"Error writing output file: {str(e)}")
             self.status.set("Error")
+    
+    def _review_in_progress(self):
+        """Whether duplicate groups are waiting for decisions."""
+        return bool(self.duplicates) and self.current_duplicate_idx < len(self.duplicates)
+    
+    def _save_session(self):
+        """Save the review so far to a session file. Returns True if it was saved."""
+        if not self._review_in_progress():
+            messagebox.showinfo("Information", "There is no review in progress to save.")
+            return False
+        
+        filename = filedialog.asksaveasfilename(
+            title="Save Review Session",
+            defaultextension=SESSION_EXTENSION,
+            initialfile=os.path.basename(os.path.splitext(self.output_file.get())[0] + SESSION_EXTENSION),
+            filetypes=[("Review Sessions", f"*{SESSION_EXTENSION}"), ("All Files", "*.*")]
+        )
+        if not filename:
+            return False
+        
+        try:
+            # Kept entries that are unchanged file entries are stored as their index
+            entry_indices = {entry: i for i, entry in enumerate(self.entries)}
+            blocking_settings = (self.blocking_method.get(), self.neighborhood_window.get(), self.year_tolerance.get())
+            write_review_session(filename, {
+                'input_file': self.input_file.get(),
+                'output_file': self.output_file.get(),
+                'settings': {
+                    'threshold': self.similarity_threshold.get(),
+                    'blocking': blocking_settings,
+                    'policy': self.resolution_policy.get(),
+                    'matching_stages': self.matching_stages
+                },
+                'graph_source': self.graph_source,
+                'entries_info': self.entries_info,
+                'unparsed': {i: entry for i, entry in enumerate(self.entries) if self.entries_info[i] is None},
+                'candidate_graph': self.candidate_graph,
+                'duplicates': self.duplicates,
+                'current_duplicate_idx': self.current_duplicate_idx,
+                'entries_to_keep': [entry_indices.get(entry, entry) for entry in self.entries_to_keep],
+                'key_map': self.key_map
+            })
+        except Exception as e:
+            messagebox.showerror("Error", f"Error saving session: {str(e)}")
+            return False
+        
+        self.status.set(f"Session saved at group {self.current_duplicate_idx + 1} of {len(self.duplicates)}")
+        print(f"Review session saved to {filename}")
+        return True
+    
+    def _open_session(self):
+        """Reopen a saved review session where it was left, without parsing or matching."""
+        if self._review_in_progress() and not messagebox.askyesno(
+                "Open Session", "Discard the review in progress and open a saved session?"):
+            return
+        
+        filename = filedialog.askopenfilename(
+            title="Open Review Session",
+            filetypes=[("Review Sessions", f"*{SESSION_EXTENSION}"), ("All Files", "*.*")]
+        )
+        if not filename:
+            return
+        
+        try:
+            session = read_review_session(filename)
+        except Exception as e:
+            messagebox.showerror("Error", f"Error opening session: {str(e)}")
+            return
+        
+        # A running analysis would replace the reopened review
+        if self.analysis_process is not None and self.analysis_process.is_alive():
+            self.stop_requested = True
+            self.analysis_process.terminate()
+        
+        self._restore_session(session)
+        print(f"Review session opened from {filename}")
+        self._show_duplicate_resolution()
+    
+    def _restore_session(self, session):
+        """Take over the state of a session read by read_review_session."""
+        settings = session['settings']
+        self.input_file.set(session['input_file'])
+        self.output_file.set(session['output_file'])
+        self.similarity_threshold.set(settings['threshold'])
+        method, window, year_tolerance = settings['blocking']
+        self.blocking_method.set(method)
+        self.neighborhood_window.set(window)
+        self.year_tolerance.set(year_tolerance)
+        self.resolution_policy.set(settings['policy'])
+        self.matching_stages = settings['matching_stages']
+        
+        self.entries_info = session['entries_info']
+        unparsed = session['unparsed']
+        self.entries = [unparsed[str(i)] if entry is None else entry['full_entry']
+                        for i, entry in enumerate(self.entries_info)]
+        self.candidate_graph = session['candidate_graph']
+        # The cached graph is reused if the same file is analyzed again
+        source = session['graph_source']
+        self.graph_source = (*source[:3], tuple(source[3])) if source else None
+        self.duplicates = session['duplicates']
+        self.current_duplicate_idx = session['current_duplicate_idx']
+        self.entries_to_keep = [self.entries[entry] if isinstance(entry, int) else entry
+                                for entry in session['entries_to_keep']]
+        self.key_map = session['key_map']
+        
+        self.progress_value.set(90)
+        self.status.set(f"Session reopened at group {self.current_duplicate_idx + 1} of {len(self.duplicates)}")
+    
+    def _close(self):
+        """Close the window, offering to save an unfinished review first."""
+        if self._review_in_progress():
+            answer = messagebox.askyesnocancel(
+                "Unfinished Review",
+                f"{len(self.duplicates) - self.current_duplicate_idx} duplicate groups are still to be reviewed.\n\n"
+                "Save the review session to continue it later?"
+            )
+            if answer is None or (answer and not self._save_session()):
+                return
+        if self.analysis_process is not None and self.analysis_process.is_alive():
+            self.analysis_process.terminate()
+        self.root.destroy()
 
 
 # BibTeX processing functions
 
-def check_identical_entries(entries_info, group):
+class PipeWriter:
+    """Stdout of the analysis process: printed text is sent to the GUI's console."""
+    
+    def __init__(self, conn):
+        self.conn = conn
+    
+    def write(self, text):
+        if text:
+            self.conn.send(("log", text))
+    
+    def flush(self):
+        pass
+
+def analysis_process_main(conn, input_file, threshold, matching_stages, blocking_settings):
+    """
+    Parse, extract and score a .bib file in the GUI's analysis process.
+    
+    Sends ("status", text), ("progress", percent) and ("log", text) events
+    over conn, then ("result", (entries_info, unparsed, candidate_graph)) or
+    ("error", message). Parsed entries travel once, as their full_entry;
+    unparsed maps the indices of the others to their text.
+    """
+    sys.stdout = PipeWriter(conn)
+    try:
+        conn.send(("status", "Parsing BibTeX file..."))
+        conn.send(("progress", 0))
+        
+        # Candidate pairs are scored once, down to the slider minimum. With
+        # year blocking each entry is scored as soon as it is parsed, so
+        # parsing, extraction and scoring run as one pipeline
+        method, window, year_tolerance = blocking_settings
+        stages, blocking = configure_blocking(matching_stages, method, window, year_tolerance)
+        score_floor = min(SCORE_FLOOR, threshold)
+        pipelined = blocking['method'] == 'year'
+        parse_share = 75 if pipelined else 40
+        graph = start_candidate_graph(score_floor, stages) if pipelined else None
+        entries_info = []
+        unparsed = {}
+        
+        def report_progress(bytes_read, total_bytes):
+            conn.send(("progress", parse_share * bytes_read / max(total_bytes, 1)))
+            conn.send(("status", f"Parsing BibTeX file... {len(entries_info)} entries "
+                                 f"({bytes_read / max(total_bytes, 1):.0%})"))
+        
+        for entry in iter_bib_entries(input_file, PARSE_CHUNK_SIZE, report_progress):
+            entries_info.append(extract_entry_info(entry))
+            if entries_info[-1] is None:
+                unparsed[len(entries_info) - 1] = entry
+            if pipelined:
+                add_to_candidate_graph(graph, entries_info, len(entries_info) - 1)
+        
+        valid_entries = len(entries_info) - len(unparsed)
+        conn.send(("status", f"Successfully parsed {valid_entries} of {len(entries_info)} entries."))
+        conn.send(("progress", parse_share))
+        
+        if pipelined:
+            graph = finish_candidate_graph(graph, entries_info)
+        else:
+            conn.send(("status", "Scoring candidate pairs..."))
+            graph = build_candidate_graph(entries_info, score_floor, stages, blocking)
+        conn.send(("result", (entries_info, unparsed, graph)))
+    except Exception as e:
+        conn.send(("error", str(e)))
+    finally:
+        conn.close()
+
+# Saved review sessions (Save Session / Open Session in the desktop app)
+SESSION_MAGIC = b'BIBDEDUP-SESSION'
+SESSION_VERSION = 2
+SESSION_EXTENSION = '.bibsession'
+
+def write_review_session(path, session):
+    """
+    Write a review session to a compact binary file.
+    
+    After the magic and format version comes one zlib stream: the JSON state
+    (parsed records, groups, decisions so far and settings), then the scored
+    edges of the candidate graph as packed arrays - entry indices as 32-bit
+    integers and both scores as doubles, so a reopened graph clusters
+    exactly as before. The file is written next to path and moved into place.
+    """
+    graph = session['candidate_graph']
+    state = dict(session, candidate_graph={key: value for key, value in graph.items() if key != 'edges'})
+    state_bytes = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    indices = array('I', (idx for edge in graph['edges'] for idx in edge[:2]))
+    scores = array('d', (score for edge in graph['edges'] for score in edge[2:]))
+    if sys.byteorder == 'big':
+        indices.byteswap()
+        scores.byteswap()
+    
+    compressor = zlib.compressobj()
+    partial_path = path + '.partial'
+    with open(partial_path, 'wb') as file:
+        file.write(SESSION_MAGIC + struct.pack('<H', SESSION_VERSION))
+        for part in (struct.pack('<QQ', len(state_bytes), len(graph['edges'])), state_bytes,
+                     indices.tobytes(), scores.tobytes()):
+            file.write(compressor.compress(part))
+        file.write(compressor.flush())
+    os.replace(partial_path, path)
+
+def read_review_session(path):
+    """Read a session written by write_review_session."""
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(SESSION_MAGIC):
+        raise ValueError(f"{path} is not a review session file")
+    (version,) = struct.unpack_from('<H', data, len(SESSION_MAGIC))
+    if version != SESSION_VERSION:
+        raise ValueError(f"{path} uses session format {version}; this version reads format {SESSION_VERSION}")
+    
+    payload = zlib.decompress(data[len(SESSION_MAGIC) + 2:])
+    state_size, edge_count = struct.unpack_from('<QQ', payload)
+    offset = struct.calcsize('<QQ')
+    session = json.loads(payload[offset:offset + state_size])
+    offset += state_size
+    indices = array('I')
+    indices.frombytes(payload[offset:offset + 2 * edge_count * indices.itemsize])
+    offset += 2 * edge_count * indices.itemsize
+    scores = array('d')
+    scores.frombytes(payload[offset:offset + 2 * edge_count * scores.itemsize])
+    if sys.byteorder == 'big':
+        indices.byteswap()
+        scores.byteswap()
+    
+    session['candidate_graph']['edges'] = list(zip(indices[0::2], indices[1::2], scores[0::2], scores[1::2]))
+    return session
+
+# Chunk size for the GUI's incremental parse, small enough for smooth progress
+PARSE_CHUNK_SIZE = 256 * 1024
+
+
+def write_output_file(entries, output_file):
+    """Write the output file with the selected entries."""
+    with open(output_file, 'w', encoding='utf-8') as file:
+        for entry in entries:
+            file.write(entry + "\n\n")
+
+
+def settle_duplicate_group(entries_info, group, policies):
+    """
+    Settle one duplicate group without user interaction.
+    Returns ('identical' | 'policy' | 'unresolved', entries to keep, index of
+    the kept entry); an unresolved group keeps all its entries so a human can
+    decide, and has no kept index.
+    """
+    # Check for identical entries
+    identical, best_idx = check_identical_entries(entries_info, group)
+    if identical:
+        print(f"Entries are identical. Automatically keeping: {entries_info[best_idx]['citation_key']}")
+        return 'identical', [entries_info[best_idx]['full_entry']], best_idx
+    
+    # List entries in this group
+    for j, entry_idx in enumerate(group):
+        entry = entries_info[entry_idx]
+        if entry is None:
+            continue
+        print(f"{j+1}. {entry['citation_key']} ({entry['year']}): {entry['title'][:60]}...")
+    
+    # Settle the group with the resolution policies
+    resolution = resolve_group(entries_info, group, policies)
+    if resolution:
+        print(f"Resolved by {resolution['policy']}: keeping {entries_info[resolution['index']]['citation_key']}")
+        return 'policy', [resolution['entry']], resolution['index']
+    
+    # Nothing settled it - keep every entry so a human can decide
+    print("No policy could settle this group. Keeping all entries for review.")
+    return 'unresolved', [entries_info[idx]['full_entry'] for idx in group if entries_info[idx] is not None], None
+
+# Citation key maps: which kept key replaces each key dropped by deduplication
+def key_map_path(output_file):
+    """Key map written next to an output file."""
+    return f"{os.path.splitext(output_file)[0]}.keymap.json"
+
+def write_key_map(key_map, path):
+    """Write an old key -> kept key map as JSON."""
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(dict(sorted(key_map.items())), file, indent=2, ensure_ascii=False)
+
+def load_key_map(path):
+    """Load a key map written by write_key_map."""
+    with open(path, encoding='utf-8') as file:
+        key_map = json.load(file)
+    if not isinstance(key_map, dict) or not all(isinstance(value, str) for value in key_map.values()):
+        raise ValueError(f"{path} is not a key map of old keys to kept keys")
+    return key_map
+
+
+def deduplicate_file(input_file, output_file, similarity_threshold=0.8, stages=None, blocking=None,
+                     policies=('first',), profiler=None, key_map_file=None):
     """
-    Check if entries in a group are identical (ignoring citation keys).
-    Returns:
-    - True and index of entry to keep if all entries are identical
-    - False and None if not all entries are identical
+    Deduplicate one .bib file without user interaction.
+    Non-identical groups are settled by the resolution policies; groups no
+    policy can settle keep all their entries and are listed for review.
+    The keys dropped from settled groups are mapped to the kept keys in
+    key_map_file (next to the output by default). With a MemoryProfiler,
+    the parse, extract, match and output stages are profiled. Returns a
+    summary dict.
     """
-    if not group or len(group) <= 1:
-        return False, None
+    start_time = time.perf_counter()
+    
+    with profile_stage(profiler, 'parse'):
+        print(f"Parsing BibTeX file: {input_file}")
+        entries = parse_bib_entries(input_file)
+    print(f"Found {len(entries)} entries.")
+    
+    with profile_stage(profiler, 'extract'):
+        print("Extracting information from entries...")
+        entries_info = []
+        for entry in entries:
+            entries_info.append(extract_entry_info(entry))
     
-    identical_entries = []
-    primary_idx = group[0]
-    primary_entry = entries_info[primary_idx]
+    valid_entries = sum(1 for e in entries_info if e is not None)
+    print(f"Successfully parsed {valid_entries} entries.")
     
-    # Extract the content we want to compare (everything except citation key)
-    primary_content = {
-        'title': primary_entry['title'].lower() if primary_entry['title'] else '',
-        'authors': primary_entry['authors'].lower() if primary_entry['authors'] else '',
-        'year': primary_entry['year'],
-        'doi': primary_entry['doi'].lower() if primary_entry['doi'] else '',
-        'type': primary_entry['type'].lower() if primary_entry['type'] else ''
+    print(f"Finding duplicate entries (threshold: {similarity_threshold})...")
+    with profile_stage(profiler, 'match'):
+        duplicates = find_duplicates(entries_info, similarity_threshold, stages, blocking)
+    print(f"Found {len(duplicates)} potential duplicate groups.")
+    
+    auto_resolved = 0
+    policy_resolved = 0
+    unresolved_groups = []
+    key_map = {}
+    with profile_stage(profiler, 'output'):
+        if not duplicates:
+            print("No duplicates found. Creating output file...")
+            entries_to_keep = [entry['full_entry'] for entry in entries_info if entry is not None]
+            
+            # Handle entries that couldn't be parsed
+            for i, entry in enumerate(entries):
+                if entries_info[i] is None:
+                    entries_to_keep.append(entry)
+            
+            write_output_file(entries_to_keep, output_file)
+            print(f"Complete! Output written to {output_file}")
+        else:
+            print("\nDuplicate groups found:")
+            entries_to_keep = []
+            grouped_indices = {i for group in duplicates for i in group}
+            
+            # Add entries that aren't in duplicate groups
+            for i, entry in enumerate(entries_info):
+                if entry is None:
+                    entries_to_keep.append(entries[i])
+                    continue
+                
+                if i not in grouped_indices:
+                    entries_to_keep.append(entry['full_entry'])
+            
+            # Process each duplicate group
+            for i, group in enumerate(duplicates):
+                print(f"\nGroup {i+1} of {len(duplicates)}:")
+                outcome, kept, kept_idx = settle_duplicate_group(entries_info, group, policies)
+                entries_to_keep.extend(kept)
+                if kept_idx is not None:
+                    key_map.update(group_key_map(entries_info, group, kept_idx))
+                if outcome == 'identical':
+                    auto_resolved += 1
+                elif outcome == 'policy':
+                    policy_resolved += 1
+                else:
+                    unresolved_groups.append([entries_info[idx]['citation_key'] for idx in group if entries_info[idx] is not None])
+            
+            # Write output file
+            print(f"\nWriting output file: {output_file}")
+            write_output_file(entries_to_keep, output_file)
+            print(f"Complete! {len(entries_to_keep)} entries saved.")
+            if unresolved_groups:
+                print(f"{len(unresolved_groups)} groups need manual review:")
+                for keys in unresolved_groups:
+                    print(f"  {', '.join(keys)}")
+        
+        key_map_file = key_map_file or key_map_path(output_file)
+        write_key_map(key_map, key_map_file)
+        print(f"Key map of {len(key_map)} replaced citation keys written to {key_map_file}")
+    
+    return {
+        'input': input_file,
+        'output': output_file,
+        'key_map': key_map_file,
+        'remapped_keys': len(key_map),
+        'entries': len(entries),
+        'valid_entries': valid_entries,
+        'duplicate_groups': len(duplicates),
+        'auto_resolved': auto_resolved,
+        'policy_resolved': policy_resolved,
+        'unresolved_groups': unresolved_groups,
+        'kept_entries': len(entries_to_keep),
+        'seconds': round(time.perf_counter() - start_time, 3)
     }
+
+def spill_entries(conn, input_file, blocking, batch_size=10000):
+    """
+    Extract the entries of a .bib file into the on-disk store in batches.
+    Returns (total entries, valid entries).
+    """
+    conn.executescript("""
+        CREATE TABLE entries (idx INTEGER PRIMARY KEY, block TEXT, info TEXT, raw TEXT);
+        CREATE TABLE identifiers (key TEXT, idx INTEGER);
+        CREATE TABLE identified (idx INTEGER PRIMARY KEY, root INTEGER);
+        CREATE TABLE sort_keys (field INTEGER, key TEXT, idx INTEGER);
+        CREATE TABLE ranks (field INTEGER, idx INTEGER, rank INTEGER, PRIMARY KEY (field, idx));
+        CREATE TABLE edges (i INTEGER, j INTEGER, forward REAL, backward REAL);
+        CREATE TABLE groups (group_id INTEGER, position INTEGER, idx INTEGER);
+    """)
     
-    # Check all entries against the primary
-    for idx in group[1:]:
-        entry = entries_info[idx]
-        entry_content = {
-            'title': entry['title'].lower() if entry['title'] else '',
-            'authors': entry['authors'].lower() if entry['authors'] else '',
-            'year': entry['year'],
-            'doi': entry['doi'].lower() if entry['doi'] else '',
-            'type': entry['type'].lower() if entry['type'] else ''
-        }
+    total = 0
+    valid = 0
+    rows = []
+    keys = []
+    identifiers = []
+    for idx, entry in enumerate(iter_bib_entries(input_file)):
+        total += 1
+        info = extract_entry_info(entry)
+        if info is None:
+            rows.append((idx, None, None, entry))
+        else:
+            valid += 1
+            rows.append((idx, info['year'], json.dumps(info), None))
+            identifiers.extend((key, idx) for key in identifier_keys(info))
+            if blocking['method'] == 'sorted_neighborhood':
+                keys.extend((field, blocking_key(info[MATCHING_KEYS.get(name, name)]), idx)
+                            for field, name in enumerate(blocking['keys']))
+        
+        if len(rows) >= batch_size:
+            conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?)", rows)
+            conn.executemany("INSERT INTO identifiers VALUES (?, ?)", identifiers)
+            conn.executemany("INSERT INTO sort_keys VALUES (?, ?, ?)", keys)
+            rows = []
+            keys = []
+            identifiers = []
+            print(f"Stored {total} entries...")
+    
+    conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?)", rows)
+    conn.executemany("INSERT INTO identifiers VALUES (?, ?)", identifiers)
+    conn.executemany("INSERT INTO sort_keys VALUES (?, ?, ?)", keys)
+    conn.executescript("""
+        CREATE INDEX entries_block ON entries (block);
+        CREATE INDEX sort_keys_order ON sort_keys (field, key, idx);
+    """)
+    conn.commit()
+    return total, valid
+
+def group_external_identifiers(conn):
+    """
+    Group the stored entries that share an exact identifier and take them
+    out of fuzzy matching: they leave the year blocks and the sort key
+    orders. Returns the number of entries grouped.
+    """
+    roots = union_identifier_keys(conn.execute("SELECT key, idx FROM identifiers"))
+    conn.executemany("INSERT INTO identified VALUES (?, ?)", roots.items())
+    conn.executescript("""
+        CREATE INDEX identified_root ON identified (root);
+        UPDATE entries SET block = NULL WHERE idx IN (SELECT idx FROM identified);
+        DELETE FROM sort_keys WHERE idx IN (SELECT idx FROM identified);
+    """)
+    conn.commit()
+    return len(roots)
+
+def load_block(conn, year):
+    """Load the valid entries of one year block as (index, info) pairs."""
+    return [(idx, json.loads(info)) for idx, info in
+            conn.execute("SELECT idx, info FROM entries WHERE block = ? ORDER BY idx", (year,))]
+
+def iter_external_year_pairs(conn, stages, cache):
+    """
+    Yield ((i, entry_i), (j, entry_j)) candidate pairs block by block.
+    At most two year blocks are in memory: a block and one partner year.
+    """
+    year_stage = get_stage(stages, 'year_window')
+    if year_stage is None:
+        raise ValueError("External mode needs a 'year_window' stage or sorted-neighborhood blocking")
+    
+    years = [year for (year,) in conn.execute(
+        "SELECT DISTINCT block FROM entries WHERE block IS NOT NULL ORDER BY block")]
+    known_years = set(years)
+    for year in years:
+        cache.clear()
+        block = load_block(conn, year)
+        print(f"Scoring year block '{year or 'no year'}' ({len(block)} entries)...")
+        
+        # Pairs within the block, each entry with the ones before it
+        for pos, right in enumerate(block):
+            for left in block[:pos]:
+                yield left, right
+        
+        # Pairs with later years inside the window, or with every other
+        # block for entries without a year if missing years are allowed
+        if year:
+            partner_years = [str(int(year) + offset) for offset in range(1, year_stage['window'] + 1)]
+        elif year_stage['allow_missing']:
+            partner_years = [other for other in years if other]
+        else:
+            partner_years = []
+        
+        for other_year in partner_years:
+            if other_year not in known_years:
+                continue
+            partners = load_block(conn, other_year)
+            for left in block:
+                for right in partners:
+                    yield (left, right) if left[0] < right[0] else (right, left)
+            del partners
+
+def iter_external_neighborhood_pairs(conn, stages, blocking, cache):
+    """
+    Yield ((i, entry_i), (j, entry_j)) sorted-neighborhood pairs, streaming
+    each key order from disk with only the last window - 1 entries in memory.
+    """
+    window = blocking['window']
+    for field in range(len(blocking['keys'])):
+        ordered = conn.execute("SELECT idx FROM sort_keys WHERE field = ? ORDER BY key, idx", (field,))
+        conn.executemany("INSERT INTO ranks VALUES (?, ?, ?)",
+                         ((field, idx, rank) for rank, (idx,) in enumerate(ordered)))
+    conn.commit()
+    
+    # Token sets are cached by entry id, so forget them when an entry leaves the window
+    cached_fields = {MATCHING_KEYS.get(name, name)
+                     for stage in stages if stage['stage'] == 'token_jaccard' for name in stage['fields']}
+    for field in range(len(blocking['keys'])):
+        print(f"Scoring sorted neighborhood on {blocking['keys'][field]}...")
+        
+        # Ranks under the earlier keys tell which pairs were already compared
+        earlier = range(field)
+        query = (
+            "SELECT r.idx, e.info" + "".join(f", r{k}.rank" for k in earlier) +
+            " FROM ranks r JOIN entries e ON e.idx = r.idx" +
+            "".join(f" JOIN ranks r{k} ON r{k}.field = {k} AND r{k}.idx = r.idx" for k in earlier) +
+            " WHERE r.field = ? ORDER BY r.rank"
+        )
+        neighbours = deque()
+        for idx, info, *ranks in conn.execute(query, (field,)):
+            entry = (idx, json.loads(info))
+            for other, other_ranks in neighbours:
+                if any(abs(rank - other_rank) < window for rank, other_rank in zip(ranks, other_ranks)):
+                    continue
+                yield (other, entry) if other[0] < idx else (entry, other)
+            
+            neighbours.append((entry, ranks))
+            if len(neighbours) >= window:
+                evicted = neighbours.popleft()[0][1]
+                for name in cached_fields:
+                    cache.pop((id(evicted), name), None)
+        cache.clear()
+
+def build_external_candidate_graph(conn, valid_entries, score_floor, stages, blocking, batch_size=10000):
+    """
+    Score candidate pairs block by block, writing edges to the on-disk store.
+    Returns the graph counters (no edges are held in memory).
+    """
+    stage_stats = [{'stage': stage['stage'], 'evaluated': 0, 'rejected': 0, 'accepted': 0}
+                   for stage in stages]
+    cache = {}
+    if blocking['method'] == 'sorted_neighborhood':
+        pairs = iter_external_neighborhood_pairs(conn, stages, blocking, cache)
+    else:
+        pairs = iter_external_year_pairs(conn, stages, cache)
+    
+    edges = []
+    edge_count = 0
+    candidate_pairs = 0
+    for (i, entry1), (j, entry2) in pairs:
+        candidate_pairs += 1
+        forward, backward = run_matching_cascade(entry1, entry2, stages, score_floor, stage_stats, cache)
+        if max(forward, backward) >= score_floor:
+            edges.append((i, j, forward, backward))
+            if len(edges) >= batch_size:
+                conn.executemany("INSERT INTO edges VALUES (?, ?, ?, ?)", edges)
+                edge_count += len(edges)
+                edges = []
+    
+    conn.executemany("INSERT INTO edges VALUES (?, ?, ?, ?)", edges)
+    edge_count += len(edges)
+    conn.executescript("""
+        CREATE INDEX edges_i ON edges (i, forward);
+        CREATE INDEX edges_j ON edges (j, backward);
+    """)
+    conn.commit()
+    
+    graph = {
+        'edges': edge_count,
+        'candidate_pairs': candidate_pairs,
+        'pruned_pairs': valid_entries * (valid_entries - 1) // 2 - candidate_pairs,
+        'stage_stats': stage_stats
+    }
+    print(f"Kept {edge_count} scored candidate pairs.")
+    print(format_stage_stats(graph))
+    return graph
+
+def cluster_external_graph(conn, size, similarity_threshold=0.8):
+    """
+    Group entries from the on-disk candidate graph, in the same order as
+    cluster_candidate_graph. Groups are written to the store; returns their count.
+    """
+    threshold = float(similarity_threshold)
+    processed = bytearray(size)
+    group_count = 0
+    for i, root in conn.execute(
+            "SELECT e.idx, d.root FROM entries e LEFT JOIN identified d ON d.idx = e.idx "
+            "WHERE e.info IS NOT NULL ORDER BY e.idx"):
+        if processed[i]:
+            continue
+        
+        if root is not None:
+            # Grouped by an exact identifier; i is the group's first entry
+            group = [j for (j,) in conn.execute(
+                "SELECT idx FROM identified WHERE root = ? ORDER BY idx", (root,))]
+        else:
+            # Identified entries took no part in scoring, so they have no edges
+            group = [i] + [j for (j,) in conn.execute(
+                "SELECT j FROM edges WHERE i = ? AND forward > ? "
+                "UNION SELECT i FROM edges WHERE j = ? AND backward > ? ORDER BY 1",
+                (i, threshold, i, threshold))
+                if not processed[j]]
         
-        # If any field doesn't match, entries are not identical
-        if primary_content != entry_content:
-            return False, None
+        if len(group) > 1:
+            conn.executemany("INSERT INTO groups VALUES (?, ?, ?)",
+                             [(group_count, position, idx) for position, idx in enumerate(group)])
+            group_count += 1
+            for idx in group:
+                processed[idx] = 1
+    
+    conn.commit()
+    return group_count
+
+def deduplicate_file_external(input_file, output_file, similarity_threshold=0.8, stages=None, blocking=None,
+                              policies=('first',), work_dir=None, key_map_file=None):
+    """
+    Deduplicate a .bib file too large for memory.
+    
+    Entries and blocking keys are spilled to an SQLite store in work_dir (a
+    temporary directory by default), candidate pairs are scored one block at
+    a time and clustering reads the scored edges back from disk, so peak
+    memory stays around one block (two with a year tolerance) whatever the
+    corpus size. The output and summary take the same form as
+    deduplicate_file's, and match it with year blocking (the default). With
+    sorted-neighborhood blocking the on-disk pass only compares entries
+    within the window of each key order: it skips the title containment
+    trie, so truncated or subtitled titles that sort far apart can be left
+    ungrouped (--verify reports these as blocking differences).
+    """
+    start_time = time.perf_counter()
+    stages = resolve_matching_stages(stages)
+    blocking = blocking or DEFAULT_BLOCKING
+    
+    with tempfile.TemporaryDirectory(dir=work_dir) as store_dir:
+        conn = sqlite3.connect(os.path.join(store_dir, 'entries.sqlite'))
+        try:
+            conn.execute("PRAGMA journal_mode = OFF")
+            conn.execute("PRAGMA synchronous = OFF")
+            
+            print(f"Spilling BibTeX file to disk: {input_file}")
+            total, valid_entries = spill_entries(conn, input_file, blocking)
+            print(f"Stored {total} entries ({valid_entries} parsed) in {store_dir}")
+            identified = group_external_identifiers(conn)
+            print(f"Grouped {identified} entries by exact identifiers.")
+            
+            score_floor = min(SCORE_FLOOR, similarity_threshold)
+            print(f"Finding duplicate entries (threshold: {similarity_threshold})...")
+            build_external_candidate_graph(conn, valid_entries, score_floor, stages, blocking)
+            group_count = cluster_external_graph(conn, total, similarity_threshold)
+            print(f"Found {group_count} potential duplicate groups.")
+            
+            auto_resolved = 0
+            policy_resolved = 0
+            unresolved_groups = []
+            key_map = {}
+            kept_entries = 0
+            with open(output_file, 'w', encoding='utf-8') as file:
+                # Entries outside duplicate groups, in file order. Without any
+                # groups unparsed entries go last, as in deduplicate_file
+                grouped = bytearray(total)
+                for (idx,) in conn.execute("SELECT idx FROM groups"):
+                    grouped[idx] = 1
+                unparsed_last = group_count == 0
+                query = ("SELECT idx, info, raw FROM entries ORDER BY info IS NULL, idx" if unparsed_last
+                         else "SELECT idx, info, raw FROM entries ORDER BY idx")
+                for idx, info, raw in conn.execute(query):
+                    if not grouped[idx]:
+                        file.write((json.loads(info)['full_entry'] if info is not None else raw) + "\n\n")
+                        kept_entries += 1
+                
+                # Then each duplicate group, loading only its own entries
+                for group_id in range(group_count):
+                    print(f"\nGroup {group_id+1} of {group_count}:")
+                    rows = conn.execute(
+                        "SELECT g.idx, e.info FROM groups g JOIN entries e ON e.idx = g.idx "
+                        "WHERE g.group_id = ? ORDER BY g.position", (group_id,)).fetchall()
+                    group = [idx for idx, _ in rows]
+                    entries_info = {idx: json.loads(info) for idx, info in rows}
+                    
+                    outcome, kept, kept_idx = settle_duplicate_group(entries_info, group, policies)
+                    for entry in kept:
+                        file.write(entry + "\n\n")
+                    kept_entries += len(kept)
+                    if kept_idx is not None:
+                        key_map.update(group_key_map(entries_info, group, kept_idx))
+                    if outcome == 'identical':
+                        auto_resolved += 1
+                    elif outcome == 'policy':
+                        policy_resolved += 1
+                    else:
+                        unresolved_groups.append([entries_info[idx]['citation_key'] for idx in group])
+        finally:
+            conn.close()
     
-    # All entries are identical - choose the one with the shortest citation key
-    best_idx = group[0]
-    best_key_len = len(entries_info[best_idx]['citation_key'])
+    print(f"Complete! {kept_entries} entries saved to {output_file}.")
+    if unresolved_groups:
+        print(f"{len(unresolved_groups)} groups need manual review:")
+        for keys in unresolved_groups:
+            print(f"  {', '.join(keys)}")
     
-    for idx in group[1:]:
-        key_len = len(entries_info[idx]['citation_key'])
-        if key_len < best_key_len:
-            best_idx = idx
-            best_key_len = key_len
+    key_map_file = key_map_file or key_map_path(output_file)
+    write_key_map(key_map, key_map_file)
+    print(f"Key map of {len(key_map)} replaced citation keys written to {key_map_file}")
     
-    return True, best_idx
+    return {
+        'input': input_file,
+        'output': output_file,
+        'key_map': key_map_file,
+        'remapped_keys': len(key_map),
+        'entries': total,
+        'valid_entries': valid_entries,
+        'duplicate_groups': group_count,
+        'auto_resolved': auto_resolved,
+        'policy_resolved': policy_resolved,
+        'unresolved_groups': unresolved_groups,
+        'kept_entries': kept_entries,
+        'seconds': round(time.perf_counter() - start_time, 3)
+    }
 
-def parse_bib_entries(bib_file_path):
-    """Parse a .bib file and extract individual entries."""
-    with open(bib_file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
+
+def check_against_library(input_file, query, index_path=None, limit=5, stages=None, similarity_threshold=0.8):
+    """Look up a citation in a library, (re)building its index first if it is stale."""
+    index_path = index_path or f"{input_file}.index"
+    if input_file and not library_index_is_current(index_path, input_file):
+        build_library_index(input_file, index_path)
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"No library index at {index_path}")
     
-    # Find all entries - anything between @ and the next @ or end of file
-    entry_pattern = r'@(.*?)((?=@)|$)'
-    entries = re.finditer(entry_pattern, content, re.DOTALL)
+    conn = sqlite3.connect(index_path)
+    try:
+        start_time = time.perf_counter()
+        matches = query_library_index(conn, query, limit, stages, similarity_threshold)
+        elapsed = (time.perf_counter() - start_time) * 1000
+    finally:
+        conn.close()
     
-    parsed_entries = []
-    for entry in entries:
-        entry_text = entry.group(0).strip()
-        if entry_text:  # Skip empty matches
-            parsed_entries.append(entry_text)
+    print(f"Top {len(matches)} candidate matches ({elapsed:.2f} ms):")
+    for match in matches:
+        flag = "duplicate" if match['duplicate'] else ""
+        print(f"  {match['score']:.3f}  {match['citation_key']} ({match['year']}): {match['title'][:60]}"
+              f"  [{', '.join(match['matched_on'])}] {flag}")
+    return matches
+
+# How often --watch checks the file for changes, in seconds
+WATCH_INTERVAL = 0.5
+
+def start_watch_index(stages=None, score_floor=SCORE_FLOOR):
+    """
+    Start an empty duplicate index for watch mode. Entries are added and
+    removed one at a time; scored edges are kept by entry id, with year
+    blocking, so an edit only rescores the entries it touched.
+    """
+    return {
+        'stages': resolve_matching_stages(stages),
+        'score_floor': score_floor,
+        'next_id': 0,
+        'ids_by_text': {},
+        'entries': {},
+        'year_index': {},
+        'neighbours': {},
+        'edges': {},
+        'cache': {}
+    }
+
+def add_watch_entry(index, text):
+    """Extract and score one new entry against the indexed entries in its year window."""
+    entry_id = index['next_id']
+    index['next_id'] += 1
+    info = extract_entry_info(text)
+    index['entries'][entry_id] = info
+    index['ids_by_text'].setdefault(text, []).append(entry_id)
+    if info is None:
+        return
     
-    return parsed_entries
+    stages = index['stages']
+    stage_stats = [{'stage': stage['stage'], 'evaluated': 0, 'rejected': 0, 'accepted': 0}
+                   for stage in stages]
+    pairs = iter_new_candidate_pairs(index['entries'], entry_id, get_stage(stages, 'year_window'), index['year_index'])
+    for other_id, _ in pairs:
+        forward, backward = run_matching_cascade(
+            index['entries'][other_id], info, stages, index['score_floor'], stage_stats, index['cache'])
+        if max(forward, backward) >= index['score_floor']:
+            index['edges'][(other_id, entry_id)] = (forward, backward)
+            index['neighbours'].setdefault(other_id, set()).add(entry_id)
+            index['neighbours'].setdefault(entry_id, set()).add(other_id)
 
-def extract_entry_info(entry):
-    """Extract key information from a BibTeX entry."""
-    # Extract entry type and citation key
-    match = re.match(r'@(\w+)\s*{\s*([^,]+)', entry)
-    if not match:
-        return None
+def remove_watch_entry(index, text):
+    """Drop one entry with this text and its scored edges from the index."""
+    ids = index['ids_by_text'][text]
+    entry_id = ids.pop()
+    if not ids:
+        del index['ids_by_text'][text]
     
-    entry_type = match.group(1).lower()
-    citation_key = match.group(2)
+    info = index['entries'].pop(entry_id)
+    if info is None:
+        return
+    index['year_index'][info['year']].remove(entry_id)
+    # Token sets are cached by entry id, which a later entry can reuse
+    for stage in index['stages']:
+        if stage['stage'] == 'token_jaccard':
+            for name in stage['fields']:
+                index['cache'].pop((id(info), MATCHING_KEYS.get(name, name)), None)
+    for other_id in index['neighbours'].pop(entry_id, ()):
+        index['neighbours'][other_id].discard(entry_id)
+        index['edges'].pop((min(entry_id, other_id), max(entry_id, other_id)))
+
+def update_watch_index(index, entries):
+    """
+    Bring the index in line with the file's current entries. Unchanged
+    entries keep their extracted info and scores; only added or removed
+    entry texts are processed. Returns (added, removed) counts.
+    """
+    wanted = {}
+    for text in entries:
+        wanted[text] = wanted.get(text, 0) + 1
     
-    # Extract title
-    title_match = re.search(r'title\s*=\s*[{"](.+?)[}"]', entry, re.IGNORECASE | re.DOTALL)
-    title = title_match.group(1).lower().replace('\n', ' ').replace('\t', ' ') if title_match else ""
-    title = re.sub(r'\s+', ' ', title).strip()  # Normalize whitespace
+    removed = 0
+    for text, ids in list(index['ids_by_text'].items()):
+        for _ in range(len(ids) - wanted.get(text, 0)):
+            remove_watch_entry(index, text)
+            removed += 1
     
-    # Extract authors
-    author_match = re.search(r'author\s*=\s*[{"](.+?)[}"]', entry, re.IGNORECASE | re.DOTALL)
-    authors = author_match.group(1) if author_match else ""
+    added = 0
+    for text, count in wanted.items():
+        for _ in range(count - len(index['ids_by_text'].get(text, ()))):
+            add_watch_entry(index, text)
+            added += 1
     
-    # Extract year
-    year_match = re.search(r'year\s*=\s*[{"]?(\d{4})[}"]?', entry, re.IGNORECASE)
-    year = year_match.group(1) if year_match else ""
+    return added, removed
+
+def watch_index_groups(index, entries, similarity_threshold=0.8):
+    """Cluster the indexed entries in file order, as find_duplicates would."""
+    order = []
+    used = {}
+    for text in entries:
+        occurrence = used.get(text, 0)
+        order.append(index['ids_by_text'][text][occurrence])
+        used[text] = occurrence + 1
     
-    # Extract DOI
-    doi_match = re.search(r'doi\s*=\s*[{"](.+?)[}"]', entry, re.IGNORECASE)
-    doi = doi_match.group(1) if doi_match else ""
+    position = {entry_id: pos for pos, entry_id in enumerate(order)}
+    entries_info = [index['entries'][entry_id] for entry_id in order]
+    edges = []
+    for (id1, id2), (forward, backward) in index['edges'].items():
+        if position[id1] < position[id2]:
+            edges.append((position[id1], position[id2], forward, backward))
+        else:
+            edges.append((position[id2], position[id1], backward, forward))
+    edges.sort()
+    
+    graph = {'edges': edges, 'identifier_groups': find_identifier_groups(entries_info)}
+    return cluster_candidate_graph(entries_info, graph, similarity_threshold), entries_info
+
+def describe_groups(entries_info, groups):
+    """Key duplicate groups by their sorted citation keys for reporting changes."""
+    return {tuple(sorted(entries_info[idx]['citation_key'] for idx in group)): group for group in groups}
+
+def watch_file(input_file, similarity_threshold=0.8, stages=None, interval=WATCH_INTERVAL, max_updates=None):
+    """
+    Watch a .bib file and report duplicate groups as it is edited.
+    The file is polled for changes; each change updates the duplicate index
+    incrementally and prints the groups that appeared or went away.
+    """
+    index = start_watch_index(stages, min(SCORE_FLOOR, similarity_threshold))
+    groups = {}
+    last_stat = None
+    updates = 0
+    print(f"Watching {input_file} for changes (threshold: {similarity_threshold}, Ctrl+C to stop)...")
+    try:
+        while max_updates is None or updates < max_updates:
+            try:
+                stat = os.stat(input_file)
+                if (stat.st_mtime_ns, stat.st_size) == last_stat:
+                    time.sleep(interval)
+                    continue
+                entries = parse_bib_entries(input_file)
+            except (OSError, UnicodeDecodeError) as e:
+                # The file may be missing or half-written while an editor saves it
+                print(f"Could not read {input_file}: {str(e)}")
+                time.sleep(interval)
+                continue
+            last_stat = (stat.st_mtime_ns, stat.st_size)
+            
+            start_time = time.perf_counter()
+            added, removed = update_watch_index(index, entries)
+            duplicates, entries_info = watch_index_groups(index, entries, similarity_threshold)
+            current = describe_groups(entries_info, duplicates)
+            elapsed = (time.perf_counter() - start_time) * 1000
+            
+            print(f"\n[{time.strftime('%H:%M:%S')}] {len(entries)} entries (+{added} -{removed}), "
+                  f"{len(current)} duplicate groups, updated in {elapsed:.0f} ms")
+            for keys, group in current.items():
+                if keys not in groups:
+                    print(f"  New duplicate group: {', '.join(keys)}")
+                    for idx in group:
+                        entry = entries_info[idx]
+                        print(f"    {entry['citation_key']} ({entry['year']}): {entry['title'][:60]}")
+            for keys in groups:
+                if keys not in current:
+                    print(f"  Resolved: {', '.join(keys)}")
+            
+            groups = current
+            updates += 1
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+    return groups
+
+# Differential verification: the matching engines against the original matcher
+VERIFY_ENGINES = ('year', 'sorted_neighborhood', 'incremental', 'watch', 'external')
+VERIFY_EXAMPLES = 20  # Unexplained pairs listed per engine
+CORPUS_WORDS = (
+    "learning deep neural networks graph attention transformer language model representation "
+    "contrastive self supervised training robust adversarial generative diffusion reinforcement "
+    "policy optimization stochastic gradient convergence bayesian inference variational sparse "
+    "efficient scalable retrieval vision image segmentation detection recognition speech "
+    "translation embedding knowledge reasoning benchmark dataset evaluation analysis survey"
+).split()
+CORPUS_SURNAMES = (
+    "Smith Chen Garcia Müller Nguyen Kumar Rossi Tanaka Kowalski Dubois Silva Novak Jensen "
+    "Ivanov Park O'Brien Schmidt Lopez Wang Fischer Costa Sato Hansen Moreau Rahman"
+).split()
+
+def reference_entry_info(entry):
+    """
+    Entry info as the original matcher saw it, for reference_find_duplicates:
+    the title lowercased with its whitespace collapsed, the author list as
+    written and the DOI as written, its only identifier. Fields are read
+    with bib_field_value, so nested braces do not cut them short.
+    """
+    match = re.match(r'@(\w+)\s*{\s*([^,]+)', entry)
+    if not match:
+        return None
     
+    year_match = re.search(r'year\s*=\s*[{"]?(\d{4})[}"]?', entry, re.IGNORECASE)
+    doi_match = re.search(r'doi\s*=\s*[{"](.+?)[}"]', entry, re.IGNORECASE)
     return {
-        'type': entry_type,
-        'citation_key': citation_key,
-        'title': title,
-        'authors': authors,
-        'year': year,
-        'doi': doi,
+        'type': match.group(1).lower(),
+        'citation_key': match.group(2),
+        'title': re.sub(r'\s+', ' ', bib_field_value(entry, 'title').lower()).strip(),
+        'authors': bib_field_value(entry, 'author'),
+        'year': year_match.group(1) if year_match else "",
+        'doi': doi_match.group(1) if doi_match else "",
         'full_entry': entry
     }
 
-def find_duplicates(entries_info, similarity_threshold=0.8):
-    """Find potential duplicate entries based on similarity."""
+def reference_pair_matches(entry1, entry2, similarity_threshold=0.8, fields=('title', 'authors')):
+    """
+    The original fuzzy rule, seen from entry1: the title or the author list
+    scores above the threshold. fields names the title and author keys.
+    """
+    for field in fields:
+        value1 = entry1[field]
+        value2 = entry2[field]
+        if value1 and value2:
+            # Quick pre-check to avoid expensive SequenceMatcher when possible
+            if abs(len(value1) - len(value2)) / max(len(value1), 1) < 0.3:
+                if SequenceMatcher(None, value1, value2).ratio() > similarity_threshold:
+                    return True
+    return False
+
+def reference_find_duplicates(entries_info, similarity_threshold=0.8):
+    """
+    The original matcher, kept as the reference for verify_engines: each
+    unprocessed entry collects the entries sharing its DOI or, failing that,
+    the same-year entries whose title or author list scores above the
+    threshold with SequenceMatcher. Expects reference_entry_info records.
+    """
     duplicates = []
     processed = set()
-    
-    print(f"Finding duplicates among {len(entries_info)} entries...")
-    print(f"Using similarity threshold: {similarity_threshold}")
-    
-    # Use a faster approach for large datasets
-    total_entries = len(entries_info)
     for i, entry1 in enumerate(entries_info):
-        if i % 10 == 0:  # Print progress every 10 entries
-            print(f"Processing entry {i}/{total_entries}...")
-        
-        if i in processed:
+        if i in processed or entry1 is None:
             continue
-            
-        # Skip entries with parsing issues
-        if entry1 is None:
-            continue
-            
-        group = [i]
         
-        # Create DOI lookup for faster matching
+        group = [i]
         if entry1['doi']:
             for j, entry2 in enumerate(entries_info):
                 if i == j or j in processed or entry2 is None:
                     continue
-                
                 if entry1['doi'] == entry2['doi']:
                     group.append(j)
         
-        # Only do the expensive similarity checks for entries without DOI matches
         if len(group) == 1:
-            # Only compare with entries that have the same year (much faster filtering)
-            same_year_indices = [j for j, entry2 in enumerate(entries_info) 
-                               if entry2 is not None and j != i and j not in processed 
-                               and entry2['year'] == entry1['year']]
+            same_year_indices = [j for j, entry2 in enumerate(entries_info)
+                                 if entry2 is not None and j != i and j not in processed
+                                 and entry2['year'] == entry1['year']]
             
-            for j in same_year_indices:
-                entry2 = entries_info[j]
-                
-                # High title similarity with matching year
-                if entry1['title'] and entry2['title']:
-                    # Quick pre-check to avoid expensive SequenceMatcher when possible
-                    if abs(len(entry1['title']) - len(entry2['title'])) / max(len(entry1['title']), 1) < 0.3:
-                        title_similarity = SequenceMatcher(None, entry1['title'], entry2['title']).ratio()
-                        if title_similarity > similarity_threshold:
-                            group.append(j)
-                            continue
-                
-                # Only check authors if title didn't match
-                if j not in group and entry1['authors'] and entry2['authors']:
-                    # Quick pre-check
-                    if abs(len(entry1['authors']) - len(entry2['authors'])) / max(len(entry1['authors']), 1) < 0.3:
-                        authors_similarity = SequenceMatcher(None, entry1['authors'], entry2['authors']).ratio()
-                        if authors_similarity > similarity_threshold:
-                            group.append(j)
-        
-        # Found duplicates
+            group.extend(j for j in same_year_indices
+                         if reference_pair_matches(entry1, entries_info[j], similarity_threshold))
+        
         if len(group) > 1:
-            # Add group and mark all entries as processed
             duplicates.append(group)
             processed.update(group)
     
     return duplicates
 
-def write_output_file(entries, output_file):
-    """Write the output file with the selected entries."""
+def generate_corpus(output_file, count=1000, duplicate_rate=0.2, seed=1):
+    """
+    Write a synthetic .bib file of count entries with known kinds of
+    duplicates: exact copies, typos, case and markup changes, abbreviated
+    authors, truncated titles, titles with a short suffix, preprints and
+    DOI-only matches, shuffled.
+    """
+    rng = random.Random(seed)
+    entries = []
+    
+    def write_entry(kind, title, authors, year, extra):
+        fields = [('title', title), ('author', authors), ('year', str(year))] + extra
+        body = ",\n".join(f"  {name} = {{{value}}}" for name, value in fields)
+        entries.append(f"@{kind}{{key{len(entries)},\n{body}\n}}")
+    
+    for number in range(count):
+        words = [rng.choice(CORPUS_WORDS) for _ in range(rng.randint(4, 9))]
+        title = " ".join(words).capitalize()
+        if rng.random() < 0.3:
+            title += ": " + " ".join(rng.choice(CORPUS_WORDS) for _ in range(rng.randint(3, 6)))
+        names = [(rng.choice(string.ascii_uppercase), rng.choice(CORPUS_SURNAMES)) for _ in range(rng.randint(1, 4))]
+        authors = " and ".join(f"{surname}, {initial}ichael" for initial, surname in names)
+        year = rng.randint(1990, 2024)
+        doi = f"10.{rng.randint(1000, 9999)}/corpus.{number}" if rng.random() < 0.5 else None
+        extra = [('journal', "Journal of " + rng.choice(CORPUS_WORDS).capitalize())]
+        write_entry('article', title, authors, year, extra + ([('doi', doi)] if doi else []))
+        
+        if rng.random() >= duplicate_rate:
+            continue
+        for _ in range(rng.randint(1, 2)):
+            variant = rng.choice(('copy', 'typo', 'case', 'initials', 'truncated', 'suffix', 'preprint', 'doi'))
+            copy_title, copy_authors, copy_extra = title, authors, list(extra)
+            if doi and variant != 'preprint':
+                copy_extra.append(('doi', doi))
+            if variant == 'typo':
+                pos = rng.randrange(len(title) - 1)
+                copy_title = title[:pos] + title[pos + 1] + title[pos] + title[pos + 2:]
+            elif variant == 'case':
+                copy_title = "{" + title.title() + "}"
+            elif variant == 'initials':
+                copy_authors = " and ".join(f"{initial}. {surname}" for initial, surname in names)
+            elif variant == 'truncated' and ": " in title:
+                copy_title = title.split(": ")[0]
+            elif variant == 'suffix':
+                # Contains the original title and nearly equals it, with the last author abbreviated
+                copy_title = f"{title} {rng.choice(('II', 'Extended'))}"
+                copy_authors = " and ".join(f"{surname}, {initial}ichael" for initial, surname in names[:-1])
+                copy_authors += f"{' and ' if len(names) > 1 else ''}{names[-1][1]}, {names[-1][0]}."
+            elif variant == 'preprint':
+                copy_extra = [('journal', f"arXiv preprint arXiv:{2000 + number % 100}.{number:05d}")]
+            elif variant == 'doi' and doi:
+                copy_title = " ".join(rng.choice(CORPUS_WORDS) for _ in range(6)).capitalize()
+            write_entry('article', copy_title, copy_authors, year, copy_extra)
+    
+    rng.shuffle(entries)
     with open(output_file, 'w', encoding='utf-8') as file:
-        for entry in entries:
-            file.write(entry + "\n\n")
+        file.write("\n\n".join(entries) + "\n")
+    return len(entries)
+
+def run_external_engine(input_file, similarity_threshold, stages, blocking):
+    """Duplicate groups found by the out-of-core engine, read back from its store."""
+    with tempfile.TemporaryDirectory() as store_dir:
+        conn = sqlite3.connect(os.path.join(store_dir, 'entries.sqlite'))
+        try:
+            total, valid_entries = spill_entries(conn, input_file, blocking)
+            group_external_identifiers(conn)
+            build_external_candidate_graph(
+                conn, valid_entries, min(SCORE_FLOOR, similarity_threshold), stages, blocking)
+            cluster_external_graph(conn, total, similarity_threshold)
+            groups = {}
+            for group_id, idx in conn.execute("SELECT group_id, idx FROM groups ORDER BY group_id, position"):
+                groups.setdefault(group_id, []).append(idx)
+            return list(groups.values())
+        finally:
+            conn.close()
+
+def run_verify_engine(engine, input_file, entries, entries_info, similarity_threshold, stages, blocking):
+    """Run one engine on a parsed corpus; returns its duplicate groups."""
+    if engine == 'year':
+        return find_duplicates(entries_info, similarity_threshold, stages)
+    if engine == 'sorted_neighborhood':
+        return find_duplicates(entries_info, similarity_threshold, stages, blocking)
+    if engine == 'incremental':
+        graph = start_candidate_graph(min(SCORE_FLOOR, similarity_threshold), stages)
+        for j in range(len(entries_info)):
+            add_to_candidate_graph(graph, entries_info, j)
+        return cluster_candidate_graph(entries_info, finish_candidate_graph(graph, entries_info), similarity_threshold)
+    if engine == 'watch':
+        index = start_watch_index(stages, min(SCORE_FLOOR, similarity_threshold))
+        update_watch_index(index, entries)
+        return watch_index_groups(index, entries, similarity_threshold)[0]
+    if engine == 'external':
+        return run_external_engine(input_file, similarity_threshold, stages, blocking)
+    raise ValueError(f"Unknown engine: {engine}")
+
+def grouped_pairs(groups):
+    """Every (i, j) pair, i < j, that shares a duplicate group."""
+    return {(min(i, j), max(i, j)) for group in groups for pos, i in enumerate(group) for j in group[pos + 1:]}
+
+def explain_pair_differences(entries_info, reference_info, groups, reference_groups, missed, extra, stages,
+                             similarity_threshold=0.8, candidates=None):
+    """
+    Attribute each pair grouped by only one side to a documented difference
+    of the engines from the original matcher:
+    
+    - identifier: the entries share an identifier, possibly through others,
+      or one of them is grouped by its identifiers and so takes no part in
+      fuzzy matching (the original only matched DOIs as written, from a
+      group's first entry)
+    - year_window: a year tolerance or missing year let differing years match
+    - title_containment: a truncated or subtitled title
+    - normalization: the original rule matches the canonical titles or
+      authors but not the fields as the original read them (a pair it no
+      longer matches is not explained)
+    - direction: SequenceMatcher ratios are not quite symmetric, and the
+      original scored a pair from the group's first entry where the engines
+      score it once, from the earlier entry in the file
+    - blocking: sorted-neighborhood blocking never compared the pair
+    - cascade: an entry of the pair moved group for one of the reasons
+      above. Either the side that grouped the pair only reached it through
+      the group's first entry, which matched one of the two for such a
+      reason, or the side that split the pair had already put one of the
+      two in a group it joined for such a reason. The greedy grouping then
+      shifts after it, and a pair explained by a cascade can start another
+    
+    Pairs matching none of these are 'unexplained'. Returns {pair: reason}.
+    """
+    roots = union_identifier_keys(
+        (key, i) for i, entry in enumerate(entries_info) if entry is not None for key in identifier_keys(entry))
+    containment_stage = get_stage(stages, 'title_containment')
+    
+    def rule_matches(infos, i, j, fields=('title', 'authors')):
+        return (reference_pair_matches(infos[i], infos[j], similarity_threshold, fields),
+                reference_pair_matches(infos[j], infos[i], similarity_threshold, fields))
+    
+    reasons = {}
+    for pair in missed | extra:
+        i, j = pair
+        entry1, entry2 = entries_info[i], entries_info[j]
+        canonical = rule_matches(entries_info, i, j, ('title_key', 'authors_key'))
+        original = rule_matches(reference_info, i, j)
+        if i in roots or j in roots:
+            reasons[pair] = 'identifier'
+        elif pair in extra and entry1['year'] != entry2['year']:
+            reasons[pair] = 'year_window'
+        elif pair in extra and containment_stage is not None and \
+                match_title_containment(entry1, entry2, containment_stage, 0.0, {}) is not None:
+            reasons[pair] = 'title_containment'
+        elif pair in extra and any(canonical) and not any(original):
+            reasons[pair] = 'normalization'
+        elif canonical[0] != canonical[1] or original[0] != original[1]:
+            reasons[pair] = 'direction'
+        elif pair in missed and candidates is not None and pair not in candidates:
+            reasons[pair] = 'blocking'
+    
+    engine_group = {i: group for group in groups for i in group}
+    reference_group = {i: group for group in reference_groups for i in group}
+    
+    def cascades(pair):
+        # The reference grouped a missed pair and the engine split it; an extra pair the other way round
+        grouped, split = (reference_group, engine_group) if pair in missed else (engine_group, reference_group)
+        first = grouped[pair[0]][0]
+        joined = any((min(first, i), max(first, i)) in reasons for i in pair if i != first)
+        claimed = any((min(i, j), max(i, j)) in reasons for i in pair for j in split.get(i, ()) if j != i)
+        return joined or claimed
+    
+    # A shifted group can shift the next one in turn, so follow the cascade until it stops
+    pending = sorted((missed | extra) - set(reasons))
+    while True:
+        cascaded = [pair for pair in pending if cascades(pair)]
+        if not cascaded:
+            break
+        for pair in cascaded:
+            reasons[pair] = 'cascade'
+        pending = [pair for pair in pending if pair not in reasons]
+    
+    for pair in pending:
+        reasons[pair] = 'unexplained'
+    return reasons
+
+def verify_corpus(input_file, similarity_threshold=0.8, stages=None, window=DEFAULT_BLOCKING['window'],
+                  year_tolerance=None, engines=VERIFY_ENGINES):
+    """
+    Compare the engines with reference_find_duplicates on one corpus, pair
+    by pair. The reference reads the entries with reference_entry_info, so
+    changes to extract_entry_info show up as differences too. The external
+    engine uses sorted-neighborhood blocking, like the sorted_neighborhood
+    one; the others year blocking. Engine times cover matching and
+    clustering of the parsed entries (plus spilling to disk for the external
+    engine); the speedup is relative to the reference.
+    """
+    year_stages, _ = configure_blocking(stages, 'year', window, year_tolerance)
+    neighborhood_stages, blocking = configure_blocking(stages, 'sorted_neighborhood', window, year_tolerance)
+    entries = parse_bib_entries(input_file)
+    entries_info = [extract_entry_info(entry) for entry in entries]
+    reference_info = [reference_entry_info(entry) for entry in entries]
+    
+    start_time = time.perf_counter()
+    reference_groups = reference_find_duplicates(reference_info, similarity_threshold)
+    reference_seconds = time.perf_counter() - start_time
+    reference_pairs = grouped_pairs(reference_groups)
+    reference_sets = {frozenset(group) for group in reference_groups}
+    
+    result = {
+        'corpus': input_file,
+        'entries': len(entries),
+        'reference': {
+            'groups': len(reference_groups),
+            'grouped_pairs': len(reference_pairs),
+            'seconds': round(reference_seconds, 3)
+        },
+        'engines': []
+    }
+    for engine in engines:
+        if engine in ('sorted_neighborhood', 'external'):
+            engine_stages, engine_blocking = neighborhood_stages, blocking
+        else:
+            engine_stages, engine_blocking = year_stages, None
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            groups = run_verify_engine(engine, input_file, entries, entries_info,
+                                       similarity_threshold, engine_stages, engine_blocking)
+        seconds = time.perf_counter() - start_time
+        
+        pairs = grouped_pairs(groups)
+        missed = reference_pairs - pairs
+        extra = pairs - reference_pairs
+        candidates = None
+        if engine_blocking is not None:
+            identified = {i for group in find_identifier_groups(entries_info) for i in group}
+            candidates = set(iter_candidate_pairs(entries_info, engine_stages, engine_blocking, identified))
+        reasons = explain_pair_differences(entries_info, reference_info, groups, reference_groups, missed, extra,
+                                           engine_stages, similarity_threshold, candidates)
+        
+        differences = {}
+        for reason in reasons.values():
+            differences[reason] = differences.get(reason, 0) + 1
+        unexplained = sorted(pair for pair, reason in reasons.items() if reason == 'unexplained')
+        result['engines'].append({
+            'engine': engine,
+            'groups': len(groups),
+            'identical_groups': sum(1 for group in groups if frozenset(group) in reference_sets),
+            'grouped_pairs': len(pairs),
+            'missed_pairs': len(missed),
+            'extra_pairs': len(extra),
+            'differences': differences,
+            'unexplained': [
+                {'keys': [entries_info[i]['citation_key'], entries_info[j]['citation_key']],
+                 'side': 'missed' if (i, j) in missed else 'extra'}
+                for i, j in unexplained[:VERIFY_EXAMPLES]
+            ],
+            'seconds': round(seconds, 3),
+            'speedup': round(reference_seconds / seconds, 2) if seconds else None
+        })
+    return result
+
+def verify_engines(input_files, generate=0, similarity_threshold=0.8, stages=None,
+                   window=DEFAULT_BLOCKING['window'], year_tolerance=None, engines=VERIFY_ENGINES, report_file=None):
+    """
+    Differential check of the matching engines against the original matcher
+    on real corpora and a generated one of the given size. Prints a table
+    per corpus and optionally writes a JSON report; an engine passes when
+    every pair it groups differently is explained by a documented difference.
+    """
+    report = {'threshold': similarity_threshold, 'window': window, 'year_tolerance': year_tolerance, 'corpora': []}
+    
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        corpora = list(input_files)
+        if generate:
+            generated_file = os.path.join(corpus_dir, f"generated-{generate}.bib")
+            generate_corpus(generated_file, generate)
+            corpora.append(generated_file)
+        
+        for input_file in corpora:
+            print(f"Verifying engines on {input_file}...")
+            result = verify_corpus(input_file, similarity_threshold, stages, window, year_tolerance, engines)
+            report['corpora'].append(result)
+            
+            reference = result['reference']
+            print(f"  {result['entries']} entries; reference: {reference['groups']} groups, "
+                  f"{reference['grouped_pairs']} grouped pairs in {reference['seconds']:.2f}s")
+            print(f"  {'engine':<20}{'groups':>8}{'same':>8}{'missed':>8}{'extra':>8}"
+                  f"{'unexpl.':>9}{'seconds':>9}{'speedup':>9}")
+            for engine in result['engines']:
+                speedup = f"{engine['speedup']:.1f}x" if engine['speedup'] is not None else "-"
+                print(f"  {engine['engine']:<20}{engine['groups']:>8}{engine['identical_groups']:>8}"
+                      f"{engine['missed_pairs']:>8}{engine['extra_pairs']:>8}"
+                      f"{engine['differences'].get('unexplained', 0):>9}{engine['seconds']:>9.2f}{speedup:>9}")
+                explained = {reason: n for reason, n in engine['differences'].items() if reason != 'unexplained'}
+                if explained:
+                    print(f"    documented differences: "
+                          f"{', '.join(f'{reason} {n}' for reason, n in sorted(explained.items()))}")
+                for example in engine['unexplained']:
+                    print(f"    unexplained {example['side']} pair: {', '.join(example['keys'])}")
+    
+    failed = [f"{os.path.basename(result['corpus'])}/{engine['engine']}"
+              for result in report['corpora'] for engine in result['engines']
+              if engine['differences'].get('unexplained')]
+    report['passed'] = not failed
+    print("All engines agree with the reference up to documented differences." if not failed
+          else f"Unexplained differences in: {', '.join(failed)}")
+    
+    if report_file:
+        with open(report_file, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {report_file}")
+    return report
+
+def is_batch_input(path):
+    """Check whether a CLI input names a directory or a glob pattern."""
+    return os.path.isdir(path) or glob.has_magic(path)
+
+def find_batch_inputs(path):
+    """List the .bib files in a directory or matching a glob, skipping earlier outputs."""
+    pattern = os.path.join(path, '*.bib') if os.path.isdir(path) else path
+    return sorted(
+        file for file in glob.glob(pattern, recursive=True)
+        if os.path.isfile(file) and not file.endswith('_deduplicated.bib')
+    )
+
+def batch_output_path(input_file):
+    """Output file written next to a batch input."""
+    return f"{os.path.splitext(input_file)[0]}_deduplicated.bib"
+
+def deduplicate_batch_worker(input_file, similarity_threshold, stages, blocking, policies):
+    """Deduplicate one batch file in a worker process, capturing its log."""
+    output_file = batch_output_path(input_file)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return deduplicate_file(input_file, output_file, similarity_threshold, stages, blocking, policies)
+    except Exception as e:
+        return {'input': input_file, 'output': output_file, 'error': str(e)}
+
+def deduplicate_batch(input_files, similarity_threshold=0.8, stages=None, blocking=None,
+                      policies=('first',), jobs=None, report_file=None):
+    """
+    Deduplicate many .bib files in parallel worker processes.
+    Outputs are written next to the inputs and one JSON report covers every file.
+    """
+    start_time = time.perf_counter()
+    jobs = jobs or os.cpu_count() or 1
+    print(f"Deduplicating {len(input_files)} files with {jobs} worker processes...")
+    
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(deduplicate_batch_worker, input_file, similarity_threshold, stages, blocking, policies)
+            for input_file in input_files
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if 'error' in result:
+                print(f"[{len(results)}/{len(input_files)}] {result['input']}: Error: {result['error']}")
+            else:
+                print(f"[{len(results)}/{len(input_files)}] {result['input']}: "
+                      f"{result['entries']} -> {result['kept_entries']} entries "
+                      f"({result['duplicate_groups']} groups, {result['seconds']:.2f}s)")
+    
+    results.sort(key=lambda result: result['input'])
+    succeeded = [result for result in results if 'error' not in result]
+    report = {
+        'threshold': similarity_threshold,
+        'policies': list(policies),
+        'jobs': jobs,
+        'files': results,
+        'totals': {
+            'files': len(results),
+            'failed': len(results) - len(succeeded),
+            'entries': sum(result['entries'] for result in succeeded),
+            'kept_entries': sum(result['kept_entries'] for result in succeeded),
+            'duplicate_groups': sum(result['duplicate_groups'] for result in succeeded),
+            'unresolved_groups': sum(len(result['unresolved_groups']) for result in succeeded),
+            'remapped_keys': sum(result['remapped_keys'] for result in succeeded),
+            'seconds': round(time.perf_counter() - start_time, 3)
+        }
+    }
+    
+    if report_file:
+        with open(report_file, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {report_file}")
+    
+    totals = report['totals']
+    print(f"Complete! {totals['files']} files, {totals['entries']} -> {totals['kept_entries']} entries "
+          f"in {totals['seconds']:.2f}s ({totals['failed']} failed)")
+    return report
+
+# Rewriting citation keys in LaTeX sources with a key map (--rewrite-citations)
+LATEX_EXTENSIONS = ('.tex', '.ltx')
+# A citation command (\cite, \citep, \parencite, \textcites, ...) with its
+# optional arguments and key groups; multicite commands take several groups
+CITE_COMMAND_PATTERN = re.compile(
+    r'\\([A-Za-z]*[Cc]ite[A-Za-z]*)\*?'
+    r'(?:\s*\([^()]*\)){0,2}'
+    r'(?:(?:\s*\[[^\[\]]*\]){0,2}\s*\{[^{}]*\})+'
+)
+# Within a matched command: an optional argument, or a key group
+CITE_ARGUMENT_PATTERN = re.compile(r'\([^()]*\)|\[[^\[\]]*\]|\{([^{}]*)\}')
+
+def find_latex_sources(path):
+    """List the LaTeX files in a project directory (recursively), a glob, or a single file."""
+    if os.path.isfile(path):
+        return [path]
+    if glob.has_magic(path):
+        return sorted(file for file in glob.glob(path, recursive=True) if os.path.isfile(file))
+    
+    sources = []
+    for directory, subdirectories, files in os.walk(path):
+        # Skip version control and other hidden directories
+        subdirectories[:] = [name for name in subdirectories if not name.startswith('.')]
+        sources.extend(os.path.join(directory, name) for name in files
+                       if name.lower().endswith(LATEX_EXTENSIONS))
+    return sorted(sources)
+
+def rewrite_citations(text, key_map):
+    """
+    Replace mapped keys in every citation command of a LaTeX source.
+    
+    One regex pass finds the citation commands and each key in their key
+    groups is looked up in the map, so the cost is linear in the text
+    whatever the number of keys. Spacing around keys and everything outside
+    the key groups is left as it is. Returns (text, replacements).
+    """
+    if 'cite' not in text and 'Cite' not in text:
+        return text, 0
+    
+    replacements = 0
+    
+    def rewrite_command(match):
+        nonlocal replacements
+        # Only multicite commands (\cites, \parencites, ...) take more than
+        # one key group; a brace group after any other command is text
+        key_groups = float('inf') if match.group(1).lower().endswith('cites') else 1
+        
+        def rewrite_keys(argument):
+            nonlocal replacements, key_groups
+            if argument.group(1) is None or not key_groups:
+                return argument.group(0)
+            key_groups -= 1
+            keys = argument.group(1).split(',')
+            for i, key in enumerate(keys):
+                stripped = key.strip()
+                if stripped in key_map:
+                    keys[i] = key.replace(stripped, key_map[stripped], 1)
+                    replacements += 1
+            return '{' + ','.join(keys) + '}'
+        
+        name_end = match.end(1) - match.start()
+        command = match.group(0)
+        return command[:name_end] + CITE_ARGUMENT_PATTERN.sub(rewrite_keys, command[name_end:])
+    
+    return CITE_COMMAND_PATTERN.sub(rewrite_command, text), replacements
+
+def rewrite_latex_file(path, key_map, dry_run=False):
+    """Rewrite the citation keys of one LaTeX file in place, unless dry_run."""
+    try:
+        # Undecodable bytes and line endings are written back unchanged
+        with open(path, encoding='utf-8', errors='surrogateescape', newline='') as file:
+            text = file.read()
+        rewritten, replacements = rewrite_citations(text, key_map)
+        if replacements and not dry_run:
+            partial_path = path + '.partial'
+            with open(partial_path, 'w', encoding='utf-8', errors='surrogateescape', newline='') as file:
+                file.write(rewritten)
+            os.replace(partial_path, path)
+        return {'file': path, 'replacements': replacements}
+    except Exception as e:
+        return {'file': path, 'error': str(e)}
+
+def rewrite_latex_sources(paths, key_map, jobs=None, dry_run=False):
+    """
+    Rewrite citation keys across LaTeX files with a key map, in parallel
+    worker processes. Files without a mapped key are left untouched.
+    """
+    start_time = time.perf_counter()
+    jobs = jobs or os.cpu_count() or 1
+    action = "Checking" if dry_run else "Rewriting"
+    print(f"{action} citations in {len(paths)} files with {len(key_map)} mapped keys...")
+    
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # Files are sent in chunks so the key map is not pickled once per file
+        chunk_size = max(1, len(paths) // (jobs * 4))
+        for result in executor.map(rewrite_latex_file, paths, [key_map] * len(paths), [dry_run] * len(paths),
+                                   chunksize=chunk_size):
+            results.append(result)
+            if 'error' in result:
+                print(f"{result['file']}: Error: {result['error']}")
+            elif result['replacements']:
+                print(f"{result['file']}: {result['replacements']} citations")
+    
+    changed = [result for result in results if result.get('replacements')]
+    failed = [result for result in results if 'error' in result]
+    summary = {
+        'files': len(results),
+        'changed_files': len(changed),
+        'replacements': sum(result['replacements'] for result in changed),
+        'failed': len(failed),
+        'dry_run': dry_run,
+        'seconds': round(time.perf_counter() - start_time, 3)
+    }
+    verb = "would be rewritten" if dry_run else "rewritten"
+    print(f"Complete! {summary['replacements']} citations {verb} in {summary['changed_files']} "
+          f"of {summary['files']} files in {summary['seconds']:.2f}s ({summary['failed']} failed)")
+    return summary
 
 
 def main():
@@ -695,90 +2245,168 @@ def main():
     # Parse command line arguments
     print("Started arg parser")
     parser = argparse.ArgumentParser(description="BibTeX Deduplicator")
-    parser.add_argument("-i", "--input", help="Input BibTeX file")
+    parser.add_argument("-i", "--input", help="Input BibTeX file, or a directory or glob of files (CLI batch mode)")
     parser.add_argument("-o", "--output", help="Output BibTeX file")
     parser.add_argument("-t", "--threshold", type=float, default=0.8,
                         help="Similarity threshold (default: 0.8)")
     parser.add_argument("--cli", action="store_true", 
                         help="Run in command line mode (no GUI)")
+    parser.add_argument("--stages",
+                        help="JSON file listing the matching cascade stages and their settings")
+    parser.add_argument("--blocking", choices=["year", "sorted_neighborhood"], default="year",
+                        help="Candidate blocking method (default: year)")
+    parser.add_argument("--window", type=int, default=DEFAULT_BLOCKING['window'],
+                        help=f"Sorted-neighborhood window size (default: {DEFAULT_BLOCKING['window']})")
+    parser.add_argument("--year-tolerance", type=int,
+                        help="Match entries up to this many years apart (default: 0)")
+    parser.add_argument("--policy",
+                        help="Comma-separated resolution policy chain for non-identical groups: "
+                             f"{', '.join(RESOLUTION_POLICIES)} (default: first)")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Worker processes for batch mode and --rewrite-citations (default: number of CPUs)")
+    parser.add_argument("--report",
+                        help="JSON report written in batch mode (default: deduplication_report.json) "
+                             "or by --verify")
+    parser.add_argument("--external", action="store_true",
+                        help="Out-of-core mode for corpora too large for memory: spill entries to disk "
+                             "and compare one block at a time")
+    parser.add_argument("--watch", action="store_true",
+                        help="Watch the input file and report duplicate groups as it changes")
+    parser.add_argument("--query",
+                        help="Check one citation (a BibTeX entry or a title) against the library given by "
+                             "--input, using its persistent index")
+    parser.add_argument("--index",
+                        help="Library index file for --query (default: <input>.index, rebuilt when stale)")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check the matching engines against the original matcher on the --input "
+                             "corpora (files, a directory or a glob) and a generated one, pair by pair")
+    parser.add_argument("--generate", type=int,
+                        help="Entries in the generated corpus for --verify (default: 1000 without --input, "
+                             "else none)")
+    parser.add_argument("--engines",
+                        help=f"Comma-separated engines for --verify: {', '.join(VERIFY_ENGINES)} (default: all)")
+    parser.add_argument("--profile-memory", nargs="?", const="memory_profile.json", metavar="REPORT",
+                        help="Profile peak RSS and the top allocation sites of each pipeline stage in CLI mode "
+                             "and write a JSON report (default: memory_profile.json)")
+    parser.add_argument("--key-map",
+                        help="JSON map of dropped citation keys to kept keys: written in CLI mode (default: "
+                             "<output>.keymap.json) and read by --rewrite-citations")
+    parser.add_argument("--rewrite-citations", metavar="PATH",
+                        help="Replace dropped citation keys with kept keys from --key-map in every \\cite "
+                             "command of a LaTeX project (a directory, a glob or a .tex file)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="With --rewrite-citations, count the replacements without changing any file")
+    parser.add_argument("--work-dir",
+                        help="Directory for the on-disk store in external mode (default: system temp directory)")
     args = parser.parse_args()
     
+    try:
+        stages = load_matching_stages(args.stages) if args.stages else None
+    except (OSError, ValueError) as e:
+        print(f"Error: could not load matching stages: {str(e)}")
+        return 1
+    
+    # Differential check of the engines against the original matcher, each
+    # with its own blocking
+    if args.verify:
+        input_files = []
+        if args.input:
+            input_files = find_batch_inputs(args.input) if is_batch_input(args.input) else [args.input]
+        engines = [engine.strip() for engine in args.engines.split(",")] if args.engines else VERIFY_ENGINES
+        unknown = [engine for engine in engines if engine not in VERIFY_ENGINES]
+        if unknown:
+            print(f"Error: unknown engines: {', '.join(unknown)}")
+            return 1
+        generate = args.generate if args.generate is not None else (0 if input_files else 1000)
+        report = verify_engines(input_files, generate, args.threshold, stages, args.window, args.year_tolerance,
+                                engines, args.report)
+        return 0 if report['passed'] else 1
+    
+    # Citation rewriting: apply a key map to LaTeX sources
+    if args.rewrite_citations:
+        if not args.key_map:
+            print("Error: --rewrite-citations needs the --key-map written by deduplication")
+            return 1
+        try:
+            key_map = load_key_map(args.key_map)
+        except (OSError, ValueError) as e:
+            print(f"Error: could not load key map: {str(e)}")
+            return 1
+        sources = find_latex_sources(args.rewrite_citations)
+        if not sources:
+            print(f"Error: no LaTeX files found for {args.rewrite_citations}")
+            return 1
+        summary = rewrite_latex_sources(sources, key_map, args.jobs, args.dry_run)
+        return 1 if summary['failed'] else 0
+    
+    stages, blocking = configure_blocking(stages, args.blocking, args.window, args.year_tolerance)
+    
+    try:
+        policies = parse_resolution_policies(args.policy or "first")
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 1
+    
+    # Library lookup: check one citation against an indexed .bib file
+    if args.query:
+        if not args.input and not args.index:
+            print("Error: --query needs the library as --input or an existing --index")
+            return 1
+        try:
+            check_against_library(args.input, args.query, args.index, stages=stages,
+                                  similarity_threshold=args.threshold)
+            return 0
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            return 1
+    
+    # Watch mode: re-check the input file whenever it changes
+    if args.watch:
+        if not args.input or not os.path.isfile(args.input):
+            print("Error: --watch needs an existing --input file")
+            return 1
+        if args.blocking != 'year':
+            print("Note: watch mode scores edits with year blocking")
+        watch_file(args.input, args.threshold, stages)
+        return 0
+    
     # Command-line mode
     if args.cli:
+        # Batch mode: a directory or glob of .bib files
+        if args.input and is_batch_input(args.input):
+            input_files = find_batch_inputs(args.input)
+            if not input_files:
+                print(f"Error: no .bib files found for {args.input}")
+                return 1
+            
+            report = deduplicate_batch(
+                input_files, args.threshold, stages, blocking, policies, args.jobs,
+                args.report or "deduplication_report.json")
+            return 1 if any('error' in result for result in report['files']) else 0
+        
         if not args.input or not args.output:
             print("Error: --input and --output are required in CLI mode")
             parser.print_help()
             return 1
         
         try:
-            print(f"Parsing BibTeX file: {args.input}")
-            entries = parse_bib_entries(args.input)
-            print(f"Found {len(entries)} entries.")
-            
-            print("Extracting information from entries...")
-            entries_info = []
-            for entry in entries:
-                entries_info.append(extract_entry_info(entry))
-            
-            valid_entries = sum(1 for e in entries_info if e is not None)
-            print(f"Successfully parsed {valid_entries} entries.")
-            
-            print(f"Finding duplicate entries (threshold: {args.threshold})...")
-            duplicates = find_duplicates(entries_info, args.threshold)
-            print(f"Found {len(duplicates)} potential duplicate groups.")
-            
-            if not duplicates:
-                print("No duplicates found. Creating output file...")
-                entries_to_keep = [entry['full_entry'] for entry in entries_info if entry is not None]
-                
-                # Handle entries that couldn't be parsed
-                for i, entry in enumerate(entries):
-                    if entries_info[i] is None:
-                        entries_to_keep.append(entry)
-                
-                write_output_file(entries_to_keep, args.output)
-                print(f"Complete! Output written to {args.output}")
+            if args.external:
+                if args.profile_memory:
+                    print("Note: --profile-memory profiles the in-memory mode only")
+                deduplicate_file_external(args.input, args.output, args.threshold, stages, blocking, policies,
+                                          args.work_dir, args.key_map)
             else:
-                print("\nDuplicate groups found:")
-                entries_to_keep = []
-                
-                # Add entries that aren't in duplicate groups
-                for i, entry in enumerate(entries_info):
-                    if entry is None:
-                        entries_to_keep.append(entries[i])
-                        continue
-                    
-                    if not any(i in group for group in duplicates):
-                        entries_to_keep.append(entry['full_entry'])
-                
-                # Process each duplicate group
-                for i, group in enumerate(duplicates):
-                    print(f"\nGroup {i+1} of {len(duplicates)}:")
-                    
-                    # Check for identical entries
-                    identical, best_idx = check_identical_entries(entries_info, group)
-                    if identical:
-                        print(f"Entries are identical. Automatically keeping: {entries_info[best_idx]['citation_key']}")
-                        entries_to_keep.append(entries_info[best_idx]['full_entry'])
-                        continue
-                    
-                    # List entries in this group
-                    for j, entry_idx in enumerate(group):
-                        entry = entries_info[entry_idx]
-                        if entry is None:
-                            continue
-                        print(f"{j+1}. {entry['citation_key']} ({entry['year']}): {entry['title'][:60]}...")
-                    
-                    # In CLI mode, we'll just keep the first entry in each group
-                    print("Keeping first entry in CLI mode.")
-                    entry_idx = group[0]
-                    entries_to_keep.append(entries_info[entry_idx]['full_entry'])
-                
-                # Write output file
-                print(f"\nWriting output file: {args.output}")
-                write_output_file(entries_to_keep, args.output)
-                print(f"Complete! {len(entries_to_keep)} entries saved.")
-            
+                profiler = MemoryProfiler() if args.profile_memory else None
+                summary = deduplicate_file(args.input, args.output, args.threshold, stages, blocking, policies,
+                                           profiler, args.key_map)
+                if profiler is not None:
+                    report = profiler.report(input=args.input, input_bytes=os.path.getsize(args.input),
+                                             entries=summary['entries'], threshold=args.threshold,
+                                             blocking=blocking['method'])
+                    print(f"\nMemory profile:\n{format_memory_profile(report)}")
+                    with open(args.profile_memory, 'w', encoding='utf-8') as file:
+                        json.dump(report, file, indent=2)
+                    print(f"Memory profile written to {args.profile_memory}")
             return 0
         
         except Exception as e:
@@ -797,10 +2425,19 @@ def main():
             app.output_file.set(args.output)
         if args.threshold:
             app.similarity_threshold.set(args.threshold)
+        app.matching_stages = stages
+        if args.policy:
+            app.resolution_policy.set(args.policy)
+        app.blocking_method.set(args.blocking)
+        app.neighborhood_window.set(args.window)
+        if args.year_tolerance is not None:
+            app.year_tolerance.set(args.year_tolerance)
         
         root.mainloop()
         return 0
 
 
 if __name__ == "__main__":
+    # Needed for batch worker processes in the frozen executable
+    multiprocessing.freeze_support()
     sys.exit(main())
\ No newline at end of file
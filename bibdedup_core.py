@@ -0,0 +1,1394 @@
+"""
+BibTeX Deduplicator - matching engine
+
+Parsing, normalization, duplicate matching and clustering, resolution
+policies, memory profiling and the library index, shared by the desktop
+application (bib_deduplicator.py) and the web application (app.py).
+"""
+
+import re
+import os
+import sys
+from difflib import SequenceMatcher
+import json
+import string
+import functools
+import unicodedata
+import time
+import contextlib
+import random
+import sqlite3
+import zlib
+import tracemalloc
+try:
+    import resource  # Peak RSS for memory profiles; not available on Windows
+except ImportError:
+    resource = None
+
+def check_identical_entries(entries_info, group):
+    """
+    Check if entries in a group are identical (ignoring citation keys).
+    Returns:
+    - True and index of entry to keep if all entries are identical
+    - False and None if not all entries are identical
+    """
+    if not group or len(group) <= 1:
+        return False, None
+    
+    identical_entries = []
+    primary_idx = group[0]
+    primary_entry = entries_info[primary_idx]
+    
+    # Extract the content we want to compare (everything except citation key)
+    primary_content = {
+        'title': primary_entry['title'].lower() if primary_entry['title'] else '',
+        'authors': primary_entry['authors'].lower() if primary_entry['authors'] else '',
+        'year': primary_entry['year'],
+        'doi': primary_entry['doi'].lower() if primary_entry['doi'] else '',
+        'type': primary_entry['type'].lower() if primary_entry['type'] else ''
+    }
+    
+    # Check all entries against the primary
+    for idx in group[1:]:
+        entry = entries_info[idx]
+        entry_content = {
+            'title': entry['title'].lower() if entry['title'] else '',
+            'authors': entry['authors'].lower() if entry['authors'] else '',
+            'year': entry['year'],
+            'doi': entry['doi'].lower() if entry['doi'] else '',
+            'type': entry['type'].lower() if entry['type'] else ''
+        }
+        
+        # If any field doesn't match, entries are not identical
+        if primary_content != entry_content:
+            return False, None
+    
+    # All entries are identical - choose the one with the shortest citation key
+    best_idx = group[0]
+    best_key_len = len(entries_info[best_idx]['citation_key'])
+    
+    for idx in group[1:]:
+        key_len = len(entries_info[idx]['citation_key'])
+        if key_len < best_key_len:
+            best_idx = idx
+            best_key_len = key_len
+    
+    return True, best_idx
+
+BIB_FIELD_NAME = re.compile(r'\s*,?\s*([\w\-:.]+)\s*=\s*')
+
+def scan_bib_value(entry, pos):
+    """Return the end of the field value starting at pos: the next top-level comma or the closing brace."""
+    depth = 0
+    in_quotes = False
+    length = len(entry)
+    while pos < length:
+        char = entry[pos]
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            if depth == 0:
+                break
+            depth -= 1
+        elif char == '"' and depth == 0:
+            in_quotes = not in_quotes
+        elif char == ',' and depth == 0 and not in_quotes:
+            break
+        pos += 1
+    return pos
+
+def parse_bib_fields(entry):
+    """
+    Split a BibTeX entry into an ordered dict of field name -> raw value.
+    Values keep their delimiters ({...}, "..." or bare), so they can be
+    written back unchanged.
+    """
+    fields = {}
+    header = re.match(r'@\w+\s*{\s*[^,]*,', entry)
+    if not header:
+        return fields
+    
+    pos = header.end()
+    length = len(entry)
+    while pos < length:
+        name_match = BIB_FIELD_NAME.match(entry, pos)
+        if not name_match:
+            break
+        
+        start = name_match.end()
+        pos = scan_bib_value(entry, start)
+        fields[name_match.group(1).lower()] = entry[start:pos].strip()
+    
+    return fields
+
+def format_bib_entry(entry_type, citation_key, fields):
+    """Write an entry back out from its type, key and raw field values."""
+    lines = [f"@{entry_type}{{{citation_key},"]
+    lines.extend(f"  {name} = {value}," for name, value in fields.items())
+    lines.append("}")
+    return "\n".join(lines)
+
+def field_is_empty(value):
+    """Check whether a raw field value holds no content."""
+    return not value.strip('{}" \t\n')
+
+def count_filled_fields(entry):
+    """Number of non-empty fields in an entry."""
+    if entry['full_entry'] is None:
+        return entry['filled_fields']  # Counted in the browser for fingerprint uploads
+    return sum(1 for value in parse_bib_fields(entry['full_entry']).values() if not field_is_empty(value))
+
+def is_preprint(entry):
+    """Check whether an entry looks like a preprint rather than a published version."""
+    if entry['type'] in ('misc', 'unpublished', 'techreport'):
+        return True
+    if entry['full_entry'] is None:
+        return entry['preprint']  # Checked in the browser for fingerprint uploads
+    fields = parse_bib_fields(entry['full_entry'])
+    venue = (fields.get('journal', '') + ' ' + fields.get('publisher', '')).lower()
+    return any(marker in venue for marker in ('arxiv', 'biorxiv', 'medrxiv', 'preprint', 'ssrn'))
+
+def prefer_doi(entries_info, candidates):
+    """Keep the candidates that have a DOI."""
+    return [idx for idx in candidates if entries_info[idx]['doi']]
+
+def prefer_journal(entries_info, candidates):
+    """Keep the candidates that are published versions rather than preprints."""
+    return [idx for idx in candidates if not is_preprint(entries_info[idx])]
+
+def most_complete(entries_info, candidates):
+    """Keep the candidates with the most filled-in fields."""
+    counts = {idx: count_filled_fields(entries_info[idx]) for idx in candidates}
+    best = max(counts.values())
+    return [idx for idx in candidates if counts[idx] == best]
+
+# Policies narrowing the candidates of a group; 'first' and 'merge' always settle it
+RESOLUTION_FILTERS = {
+    'prefer_doi': prefer_doi,
+    'prefer_journal': prefer_journal,
+    'most_complete': most_complete,
+}
+RESOLUTION_POLICIES = list(RESOLUTION_FILTERS) + ['first', 'merge']
+
+def parse_resolution_policies(policy_text):
+    """Parse a comma-separated policy chain such as 'prefer_doi,most_complete,merge'."""
+    policies = [name.strip() for name in policy_text.split(',') if name.strip()]
+    for name in policies:
+        if name not in RESOLUTION_POLICIES:
+            raise ValueError(f"Unknown resolution policy: {name} (choose from {', '.join(RESOLUTION_POLICIES)})")
+    return policies
+
+def merge_group_entries(entries_info, base_idx, group):
+    """
+    Merge a duplicate group into the base entry: fields missing or empty in
+    the base are filled from the other entries, in group order.
+    """
+    base = entries_info[base_idx]
+    fields = parse_bib_fields(base['full_entry'])
+    added = False
+    for idx in group:
+        entry = entries_info[idx]
+        if idx == base_idx or entry is None:
+            continue
+        for name, value in parse_bib_fields(entry['full_entry']).items():
+            if field_is_empty(value):
+                continue
+            if name not in fields or field_is_empty(fields[name]):
+                fields[name] = value
+                added = True
+    
+    # Keep the original formatting when there is nothing to merge
+    if not added:
+        return base['full_entry']
+    return format_bib_entry(base['type'], base['citation_key'], fields)
+
+def resolve_group(entries_info, group, policies):
+    """
+    Settle a duplicate group with a chain of resolution policies.
+    
+    Filters narrow the candidates in order until one is left; 'first' keeps
+    the first remaining candidate and 'merge' merges the group into it.
+    Returns {'index', 'entry', 'policy'} or None if the chain cannot settle
+    the group, which then needs a human decision.
+    """
+    candidates = [idx for idx in group if entries_info[idx] is not None]
+    if not candidates:
+        return None
+    
+    settled_by = None
+    for name in policies:
+        if name in ('first', 'merge'):
+            settled_by = name
+            break
+        # A filter matching no candidate tells us nothing
+        candidates = RESOLUTION_FILTERS[name](entries_info, candidates) or candidates
+        if len(candidates) == 1:
+            settled_by = name
+            break
+    
+    if settled_by is None:
+        return None
+    
+    kept_idx = candidates[0]
+    if 'merge' in policies:
+        entry_text = merge_group_entries(entries_info, kept_idx, group)
+        settled_by = 'merge' if settled_by == 'merge' else f"{settled_by}+merge"
+    else:
+        entry_text = entries_info[kept_idx]['full_entry']
+    
+    return {'index': kept_idx, 'entry': entry_text, 'policy': settled_by}
+
+def parse_bib_entries(bib_file_path):
+    """Parse a .bib file and extract individual entries."""
+    with open(bib_file_path, 'r', encoding='utf-8') as file:
+        return parse_bib_text(file.read())
+
+def parse_bib_text(content):
+    """Split BibTeX content into individual entries."""
+    # Find all entries - anything between @ and the next @ or end of file
+    entry_pattern = r'@(.*?)((?=@)|$)'
+    entries = re.finditer(entry_pattern, content, re.DOTALL)
+    
+    parsed_entries = []
+    for entry in entries:
+        entry_text = entry.group(0).strip()
+        if entry_text:  # Skip empty matches
+            parsed_entries.append(entry_text)
+    
+    return parsed_entries
+
+# LaTeX accent commands and the Unicode combining marks they stand for
+LATEX_ACCENT_MARKS = {
+    '"': '\u0308', "'": '\u0301', '`': '\u0300', '^': '\u0302', '~': '\u0303',
+    '=': '\u0304', '.': '\u0307', 'u': '\u0306', 'v': '\u030c', 'H': '\u030b',
+    'c': '\u0327', 'k': '\u0328', 'r': '\u030a', 'd': '\u0323', 'b': '\u0331',
+}
+LATEX_ACCENT = re.compile(r'\\([\'"`^~=.]|[uvHckrdb](?![a-zA-Z]))\s*(?:\{\s*\\?([a-zA-Z])\s*\}|\\?([a-zA-Z]))')
+
+# LaTeX letters and escaped characters
+LATEX_SYMBOLS = {
+    'ss': '\u00df', 'ae': '\u00e6', 'AE': '\u00c6', 'oe': '\u0153', 'OE': '\u0152',
+    'aa': '\u00e5', 'AA': '\u00c5', 'o': '\u00f8', 'O': '\u00d8', 'l': '\u0142',
+    'L': '\u0141', 'i': 'i', 'j': 'j',
+}
+LATEX_SYMBOL = re.compile(r'\\(ss|ae|AE|oe|OE|aa|AA|o|O|l|L|i|j)(?![a-zA-Z])\s*')
+LATEX_ESCAPE = re.compile(r'\\([&%$#_])')
+LATEX_COMMAND = re.compile(r'\\([a-zA-Z]+)\*?\s*|\\[^a-zA-Z]')
+
+# Font, spacing and grouping commands only style their argument and are
+# dropped; any other command, such as \alpha or \LaTeX, keeps its name
+LATEX_STYLE_COMMANDS = frozenset((
+    'textbf', 'textit', 'textsc', 'textrm', 'textsf', 'texttt', 'textsl', 'textup', 'textnormal',
+    'emph', 'em', 'bf', 'it', 'sc', 'rm', 'sf', 'tt', 'sl', 'mbox', 'hbox', 'text', 'ensuremath',
+    'mathrm', 'mathbf', 'mathit', 'mathsf', 'mathtt', 'mathcal', 'mathbb', 'mathfrak', 'mathnormal',
+    'boldsymbol', 'bm', 'operatorname', 'protect', 'relax', 'noopsort', 'left', 'right',
+))
+
+# Braces, math shifts and ties are dropped; punctuation (including Unicode
+# dashes and quotes) becomes a space. Author lists keep their commas.
+FOLDED_PUNCTUATION = string.punctuation + '\u2010\u2011\u2012\u2013\u2014\u2015\u2018\u2019\u201a\u201b\u201c\u201d\u201e\u201f\u2026\u00ab\u00bb\u00b7\u2022'
+LATEX_MARKUP_TABLE = str.maketrans({'{': None, '}': None, '$': None, '~': ' '})
+TITLE_FOLD_TABLE = str.maketrans({char: ' ' for char in FOLDED_PUNCTUATION})
+AUTHOR_FOLD_TABLE = str.maketrans({char: ' ' for char in FOLDED_PUNCTUATION if char != ','})
+
+def latex_to_unicode(text):
+    """
+    Replace LaTeX accents, letters and escapes with Unicode, spell out other
+    commands by name and drop the remaining markup.
+    """
+    if '\\' in text:
+        text = LATEX_ACCENT.sub(
+            lambda match: (match.group(2) or match.group(3)) + LATEX_ACCENT_MARKS[match.group(1)], text)
+        text = LATEX_SYMBOL.sub(lambda match: LATEX_SYMBOLS[match.group(1)], text)
+        text = LATEX_ESCAPE.sub(r'\1', text)
+        text = LATEX_COMMAND.sub(
+            lambda match: ' ' if match.group(1) is None or match.group(1) in LATEX_STYLE_COMMANDS
+            else f' {match.group(1)} ', text)
+    return unicodedata.normalize('NFKC', text.translate(LATEX_MARKUP_TABLE))
+
+def title_author_fields(title, authors):
+    """
+    The title and author fields of entry info from the raw field values.
+    title and authors are for display and check_identical_entries: the title
+    lowercased with its whitespace collapsed and the authors as written.
+    title_key and authors_key are their canonical forms, which matching,
+    blocking and the library index compare.
+    """
+    return {
+        'title': ' '.join(title.lower().split()),
+        'authors': authors,
+        'title_key': canonical_title(title),
+        'authors_key': canonical_authors(authors)
+    }
+
+@functools.lru_cache(maxsize=65536)
+def canonical_title(title):
+    """
+    Canonical form of a title for matching: LaTeX decoded, NFKC normalized,
+    case folded, punctuation folded to spaces and whitespace collapsed.
+    Memoized, since large libraries repeat the same strings.
+    """
+    return ' '.join(latex_to_unicode(title).casefold().translate(TITLE_FOLD_TABLE).split())
+
+@functools.lru_cache(maxsize=65536)
+def canonical_authors(authors):
+    """Canonical form of an author list, like canonical_title but keeping commas."""
+    text = latex_to_unicode(authors).casefold().translate(AUTHOR_FOLD_TABLE)
+    return ' '.join(text.replace(',', ', ').split()).replace(' ,', ',')
+
+# Exact identifiers: entries sharing any of them are grouped before fuzzy
+# matching. An ISBN names a whole book, which the chapters and papers inside
+# it share, so it only counts for entries that are the whole book. A URL
+# is weaker and only groups entries whose titles agree (see identifier_keys).
+IDENTIFIER_FIELDS = ('doi', 'eprint', 'pmid', 'isbn', 'url')
+IDENTIFIER_SOURCE_FIELDS = ('eprint', 'archiveprefix', 'eprinttype', 'isbn', 'url', 'pmid', 'journal')
+ISBN_ENTRY_TYPES = ('book', 'booklet', 'manual', 'proceedings')
+DOI_PREFIX = re.compile(r'^\s*(?:https?://(?:dx\.)?doi\.org/|doi:\s*)', re.IGNORECASE)
+ARXIV_ID = r'(\d{4}\.\d{4,5}|[a-z\-]+(?:\.[a-z]{2})?/\d{7})(?:v\d+)?'
+ARXIV_EPRINT = re.compile(r'(?:arxiv:)?' + ARXIV_ID, re.IGNORECASE)
+ARXIV_REFERENCE = re.compile(r'arxiv(?:\.org/(?:abs|pdf)/|:\s*|\s+)' + ARXIV_ID, re.IGNORECASE)
+URL_PREFIX = re.compile(r'^(?:https?://)?(?:www\.)?', re.IGNORECASE)
+
+# Fields read for matching; the lookbehind keeps 'title' from matching booktitle
+BIB_FIELD_PATTERNS = {
+    name: re.compile(r'(?<![\w\-:.])' + name + r'\s*=\s*', re.IGNORECASE)
+    for name in ('title', 'author') + IDENTIFIER_SOURCE_FIELDS
+}
+
+def bib_field_value(entry, name):
+    """Return a field's value without its outer braces or quotes, or '' if it is missing."""
+    match = BIB_FIELD_PATTERNS[name].search(entry)
+    if not match:
+        return ""
+    
+    value = entry[match.end():scan_bib_value(entry, match.end())].strip()
+    if len(value) >= 2 and (value[0], value[-1]) in (('{', '}'), ('"', '"')):
+        value = value[1:-1]
+    return value
+
+def normalize_isbn(value):
+    """ISBN-13 of the first ISBN in a field (ISBN-10s are converted), or '' if there is none."""
+    match = re.search(r'[\dXx][\d\-\s]{8,15}[\dXx]', value)
+    digits = re.sub(r'[^\dXx]', '', match.group(0)).upper() if match else ''
+    if len(digits) == 10:
+        digits = '978' + digits[:9]
+        check = sum(int(digit) * (3 if pos % 2 else 1) for pos, digit in enumerate(digits))
+        return digits + str(-check % 10)
+    return digits if len(digits) == 13 and digits.isdigit() else ''
+
+def normalize_identifiers(entry_type, doi, fields):
+    """
+    Normalized exact identifiers of an entry from its raw DOI and the values
+    of IDENTIFIER_SOURCE_FIELDS. Missing identifiers are ''.
+    """
+    doi = DOI_PREFIX.sub('', doi).strip().lower()
+    url = fields.get('url', '').strip()
+    
+    # arXiv IDs come from eprint fields, arXiv URLs or "arXiv:..." journal fields
+    eprint = ''
+    raw_eprint = fields.get('eprint', '').strip()
+    archive = (fields.get('archiveprefix') or fields.get('eprinttype') or '').strip().lower()
+    if raw_eprint:
+        match = ARXIV_EPRINT.fullmatch(raw_eprint)
+        if match and archive in ('', 'arxiv'):
+            eprint = 'arxiv:' + match.group(1).lower()
+        elif archive:
+            eprint = f"{archive}:{raw_eprint.lower()}"
+    if not eprint:
+        match = ARXIV_REFERENCE.search(url) or ARXIV_REFERENCE.search(fields.get('journal', ''))
+        if match:
+            eprint = 'arxiv:' + match.group(1).lower()
+    
+    # DOI and arXiv links are already covered by those identifiers
+    doi_link = DOI_PREFIX.match(url)
+    if doi_link:
+        doi = doi or url[doi_link.end():].strip().lower()
+        url = ''
+    elif ARXIV_REFERENCE.search(url):
+        url = ''
+    else:
+        url = URL_PREFIX.sub('', url.split('#')[0]).rstrip('/').lower()
+        # A bare site, such as a publisher's or proceedings' home page, names no one work
+        if not re.search(r'[/?]', url):
+            url = ''
+    
+    return {
+        'doi': doi,
+        'eprint': eprint,
+        'pmid': re.sub(r'\D', '', fields.get('pmid', '')),
+        'isbn': normalize_isbn(fields.get('isbn', '')) if entry_type in ISBN_ENTRY_TYPES else '',
+        'url': url
+    }
+
+def iter_bib_entries(bib_file_path, chunk_size=1024 * 1024, progress=None):
+    """
+    Read a .bib file in chunks and yield its entries as parse_bib_entries splits them.
+    progress, if given, is called with (bytes read, file size) after each chunk.
+    """
+    total_bytes = os.path.getsize(bib_file_path)
+    with open(bib_file_path, 'r', encoding='utf-8') as file:
+        pending = None  # Text of the current entry after its '@'
+        for chunk in iter(lambda: file.read(chunk_size), ''):
+            parts = chunk.split('@')
+            if pending is not None:
+                pending += parts[0]
+            for part in parts[1:]:
+                if pending is not None:
+                    yield ('@' + pending).strip()
+                pending = part
+            if progress:
+                progress(file.buffer.tell(), total_bytes)
+        if pending is not None:
+            yield ('@' + pending).strip()
+
+def extract_entry_info(entry):
+    """Extract key information from a BibTeX entry."""
+    # Extract entry type and citation key
+    match = re.match(r'@(\w+)\s*{\s*([^,]+)', entry)
+    if not match:
+        return None
+    
+    entry_type = match.group(1).lower()
+    citation_key = match.group(2)
+    
+    # Extract year
+    year_match = re.search(r'year\s*=\s*[{"]?(\d{4})[}"]?', entry, re.IGNORECASE)
+    year = year_match.group(1) if year_match else ""
+    
+    # Extract DOI and the other exact identifiers in normalized form
+    doi_match = re.search(r'doi\s*=\s*[{"](.+?)[}"]', entry, re.IGNORECASE)
+    doi = doi_match.group(1) if doi_match else ""
+    identifiers = normalize_identifiers(
+        entry_type, doi, {name: bib_field_value(entry, name) for name in IDENTIFIER_SOURCE_FIELDS})
+    
+    return {
+        'type': entry_type,
+        'citation_key': citation_key,
+        **title_author_fields(bib_field_value(entry, 'title'), bib_field_value(entry, 'author')),
+        'year': year,
+        **identifiers,
+        'full_entry': entry
+    }
+
+# Lowest threshold the slider allows - candidate pairs are scored down to this
+SCORE_FLOOR = 0.6
+
+# Matching cascade, cheapest stages first. Every stage can settle a pair
+# early; a pair that reaches the end of the cascade unscored is rejected.
+# The defaults follow the original DOI / same year / title / author rules,
+# and add exact identifiers and truncated or subtitled titles.
+DEFAULT_MATCHING_STAGES = [
+    {'stage': 'exact_keys', 'fields': ['doi', 'eprint', 'pmid', 'isbn'], 'reject_on_conflict': False},
+    {'stage': 'year_window', 'window': 0, 'allow_missing': False},
+    {'stage': 'token_jaccard', 'fields': ['title'], 'min_jaccard': 0.1},
+    {'stage': 'title_containment', 'min_tokens': 3, 'min_author_similarity': 0.8, 'score': 0.9},
+    {'stage': 'length_bounds', 'fields': ['title', 'authors'], 'max_difference': 0.3},
+    {'stage': 'similarity', 'weights': {'title': 1.0, 'authors': 1.0}, 'combine': 'max'},
+]
+
+# Stages and blocking name the title and authors; they compare the
+# canonical forms extract_entry_info keeps under these keys
+MATCHING_KEYS = {'title': 'title_key', 'authors': 'authors_key'}
+
+# Candidate generation: 'year' compares entries in the same year block (or
+# within the year window), 'sorted_neighborhood' sorts entries by each key
+# and compares every entry with the next window - 1 entries only
+DEFAULT_BLOCKING = {'method': 'year', 'window': 20, 'keys': ['title', 'authors']}
+
+def resolve_matching_stages(configured_stages=None):
+    """
+    Fill in default settings for a list of configured matching stages.
+    Stages run in the order given; unknown stages raise a ValueError.
+    """
+    if configured_stages is None:
+        configured_stages = DEFAULT_MATCHING_STAGES
+    
+    defaults = {stage['stage']: stage for stage in DEFAULT_MATCHING_STAGES}
+    stages = []
+    for stage in configured_stages:
+        name = stage.get('stage')
+        if name not in defaults:
+            raise ValueError(f"Unknown matching stage: {name}")
+        stages.append({**defaults[name], **stage})
+    
+    if not any(stage['stage'] == 'similarity' for stage in stages):
+        raise ValueError("The matching cascade needs a 'similarity' stage")
+    
+    return stages
+
+def load_matching_stages(config_path):
+    """Load a matching cascade from a JSON file containing a list of stages."""
+    with open(config_path, 'r', encoding='utf-8') as file:
+        return resolve_matching_stages(json.load(file))
+
+def configure_blocking(stages=None, method='year', window=20, year_tolerance=None):
+    """
+    Return (stages, blocking) for a blocking method and year tolerance.
+    Sorted-neighborhood blocking lets entries without a year pair with any
+    year, since the window already bounds how many pairs they join.
+    """
+    stages = resolve_matching_stages(stages)
+    year_stage = get_stage(stages, 'year_window')
+    if year_stage is not None:
+        if year_tolerance is not None:
+            year_stage['window'] = year_tolerance
+        if method == 'sorted_neighborhood':
+            year_stage['allow_missing'] = True
+    
+    blocking = {**DEFAULT_BLOCKING, 'method': method, 'window': window}
+    return stages, blocking
+
+def get_stage(stages, name):
+    """Return the first stage with the given name, or None."""
+    for stage in stages:
+        if stage['stage'] == name:
+            return stage
+    return None
+
+def match_exact_keys(entry1, entry2, stage, score_floor, context):
+    """Accept pairs sharing an exact key; optionally reject conflicting keys."""
+    for field in stage['fields']:
+        value1 = entry1.get(field)
+        value2 = entry2.get(field)
+        if value1 and value2:
+            if value1 == value2:
+                return 1.0, 1.0
+            if stage['reject_on_conflict']:
+                return 0.0, 0.0
+    return None
+
+def match_year_window(entry1, entry2, stage, score_floor, context):
+    """Reject pairs whose years are further apart than the window."""
+    year1 = entry1['year']
+    year2 = entry2['year']
+    if year1 and year2:
+        if abs(int(year1) - int(year2)) > stage['window']:
+            return 0.0, 0.0
+    elif (year1 or year2) and not stage['allow_missing']:
+        return 0.0, 0.0
+    return None
+
+def match_token_jaccard(entry1, entry2, stage, score_floor, context):
+    """
+    Skip fields whose word sets overlap less than min_jaccard, like
+    length_bounds. A skipped field is not scored, so a pair left with no
+    field is rejected by the later stages; the other fields still count.
+    """
+    if stage['min_jaccard'] <= 0:
+        return None
+    
+    cache = context['cache']
+    directions = context['directions']
+    for field in stage['fields']:
+        key_field = MATCHING_KEYS.get(field, field)
+        if not entry1[key_field] or not entry2[key_field]:
+            continue
+        
+        tokens = []
+        for entry in (entry1, entry2):
+            key = (id(entry), key_field)
+            if key not in cache:
+                cache[key] = frozenset(re.findall(r'\w+', entry[key_field].lower()))
+            tokens.append(cache[key])
+        
+        union = len(tokens[0] | tokens[1])
+        if not union or len(tokens[0] & tokens[1]) / union < stage['min_jaccard']:
+            directions[field] = (False, False)
+    return None
+
+def match_title_containment(entry1, entry2, stage, score_floor, context):
+    """
+    Accept a truncated or subtitled title: one title's words appear as a run
+    in the other's (at least min_tokens of them), and the authors agree.
+    Such pairs fail length_bounds, so this stage has to run before it. The
+    pair scores the best of the stage's score and the title and author
+    similarities, so a near-identical title keeps its full ratio.
+    """
+    title1 = entry1['title_key']
+    title2 = entry2['title_key']
+    if not title1 or not title2 or len(title1) == len(title2):
+        return None
+    
+    shorter, longer = sorted((title1, title2), key=len)
+    if len(shorter.split()) < stage['min_tokens'] or f" {shorter} " not in f" {longer} ":
+        return None
+    
+    authors1 = entry1['authors_key']
+    authors2 = entry2['authors_key']
+    if not authors1 or not authors2:
+        return None
+    author_similarity = SequenceMatcher(None, authors1, authors2).ratio()
+    if author_similarity < stage['min_author_similarity']:
+        return None
+    
+    # Never lower than the similarity stage would score the title or authors
+    title_similarity = SequenceMatcher(None, title1, title2).ratio()
+    score = max(stage['score'], author_similarity, title_similarity)
+    return score, score
+
+def match_length_bounds(entry1, entry2, stage, score_floor, context):
+    """
+    Quick pre-check to avoid expensive SequenceMatcher when possible.
+    The difference is relative to the first value, so a field can pass in
+    one direction only; reject the pair if no field passes either way.
+    """
+    max_difference = stage['max_difference']
+    directions = context['directions']
+    for field in stage['fields']:
+        value1 = entry1[MATCHING_KEYS.get(field, field)]
+        value2 = entry2[MATCHING_KEYS.get(field, field)]
+        if value1 and value2:
+            difference = abs(len(value1) - len(value2))
+            forward_ok, backward_ok = directions.get(field, (True, True))
+            directions[field] = (
+                forward_ok and difference / max(len(value1), 1) < max_difference,
+                backward_ok and difference / max(len(value2), 1) < max_difference
+            )
+    
+    if not any(forward or backward for forward, backward in directions.values()):
+        return 0.0, 0.0
+    return None
+
+def match_similarity(entry1, entry2, stage, score_floor, context):
+    """
+    Score the pair with SequenceMatcher over the weighted fields.
+    
+    'max' combines fields by their best weighted ratio, which is the original
+    title-or-authors rule; 'mean' takes the weighted mean. The cheap
+    SequenceMatcher upper bounds skip ratio() where it cannot matter.
+    Candidate pairs come grouped by their second entry, so the matcher of
+    each field keeps that entry's value and only the first is swapped in.
+    """
+    directions = context['directions']
+    cache = context['cache']
+    use_max = stage['combine'] == 'max'
+    forward_scores = []
+    backward_scores = []
+    total_weight = 0.0
+    best = 0.0
+    
+    for field, weight in stage['weights'].items():
+        value1 = entry1[MATCHING_KEYS.get(field, field)]
+        value2 = entry2[MATCHING_KEYS.get(field, field)]
+        if not value1 or not value2 or weight <= 0:
+            continue
+        total_weight += weight
+        
+        forward_ok, backward_ok = directions.get(field, (True, True))
+        if not (forward_ok or backward_ok):
+            continue
+        
+        matcher = cache.get(('matcher', field))
+        if matcher is None or matcher.b != value2:
+            matcher = cache[('matcher', field)] = SequenceMatcher(None, value1, value2)
+        else:
+            matcher.set_seq1(value1)
+        if use_max:
+            # A field only matters if it can beat the floor and the fields so far
+            needed = max(score_floor, best) / weight
+            if matcher.real_quick_ratio() < needed or matcher.quick_ratio() < needed:
+                continue
+        
+        similarity = matcher.ratio() * weight
+        forward_scores.append(similarity if forward_ok else 0.0)
+        backward_scores.append(similarity if backward_ok else 0.0)
+        best = max(best, min(forward_scores[-1], backward_scores[-1]))
+    
+    if not forward_scores:
+        return 0.0, 0.0
+    
+    if use_max:
+        return min(1.0, max(forward_scores)), min(1.0, max(backward_scores))
+    return sum(forward_scores) / total_weight, sum(backward_scores) / total_weight
+
+MATCHING_STAGE_FUNCTIONS = {
+    'exact_keys': match_exact_keys,
+    'year_window': match_year_window,
+    'token_jaccard': match_token_jaccard,
+    'title_containment': match_title_containment,
+    'length_bounds': match_length_bounds,
+    'similarity': match_similarity,
+}
+
+def run_matching_cascade(entry1, entry2, stages, score_floor, stage_stats, cache):
+    """
+    Run a candidate pair through the matching stages in order.
+    
+    Returns (forward, backward) scores, seen from entry1 and from entry2. The
+    first stage to return scores settles the pair and is credited in
+    stage_stats with an acceptance or a rejection.
+    """
+    context = {'directions': {}, 'cache': cache}
+    for stage, stats in zip(stages, stage_stats):
+        stats['evaluated'] += 1
+        scores = MATCHING_STAGE_FUNCTIONS[stage['stage']](entry1, entry2, stage, score_floor, context)
+        if scores is not None:
+            if max(scores) >= score_floor:
+                stats['accepted'] += 1
+            else:
+                stats['rejected'] += 1
+            return scores
+    return 0.0, 0.0
+
+def blocking_key(value):
+    """Normalized sort key for sorted-neighborhood blocking."""
+    return re.sub(r'[\W_]', '', value.lower())
+
+def build_title_trie(entries_info, indices, min_tokens):
+    """Token trie of the titles with at least min_tokens words; None keys list the entries ending there."""
+    trie = {}
+    for i in indices:
+        tokens = entries_info[i]['title_key'].split()
+        if len(tokens) < min_tokens:
+            continue
+        node = trie
+        for token in tokens:
+            node = node.setdefault(token, {})
+        node.setdefault(None, []).append(i)
+    return trie
+
+def iter_contained_title_pairs(entries_info, valid_indices, min_tokens):
+    """
+    Yield (i, j) pairs where one title's words appear as a run in the other's.
+    Each title walks the trie from every word position and stops at the first
+    word no shorter title continues with, so only real containments are
+    visited - never all pairs.
+    """
+    trie = build_title_trie(entries_info, valid_indices, min_tokens)
+    for j in valid_indices:
+        tokens = entries_info[j]['title_key'].split()
+        for start in range(len(tokens) - min_tokens + 1):
+            node = trie
+            for end in range(start, len(tokens)):
+                node = node.get(tokens[end])
+                if node is None:
+                    break
+                if None in node and end - start + 1 < len(tokens):
+                    for i in node[None]:
+                        yield min(i, j), max(i, j)
+
+def iter_sorted_neighborhood_pairs(entries_info, valid_indices, blocking, containment_stage=None):
+    """
+    Yield (i, j) pairs of entries close together in sorted key order.
+    Each key is one pass over the entries, so comparisons stay O(n*w).
+    With a title_containment stage, truncated and subtitled titles are also
+    paired with their full versions, which need not sort nearby.
+    """
+    window = blocking['window']
+    seen = set()
+    for field in blocking['keys']:
+        field = MATCHING_KEYS.get(field, field)
+        ordered = sorted(valid_indices, key=lambda i: (blocking_key(entries_info[i][field]), i))
+        for pos, i in enumerate(ordered):
+            for j in ordered[pos + 1:pos + window]:
+                pair = (min(i, j), max(i, j))
+                if pair not in seen:
+                    seen.add(pair)
+                    yield pair
+    
+    if containment_stage is not None:
+        for pair in iter_contained_title_pairs(entries_info, valid_indices, containment_stage['min_tokens']):
+            if pair not in seen:
+                seen.add(pair)
+                yield pair
+
+def iter_candidate_pairs(entries_info, stages, blocking=None, exclude=()):
+    """
+    Yield (i, j) candidate pairs with i < j, blocked on the year window or
+    by sorted neighborhood. Without a year_window stage and with year
+    blocking every pair of valid entries is a candidate. Entries in
+    exclude are left out.
+    """
+    blocking = blocking or DEFAULT_BLOCKING
+    year_stage = get_stage(stages, 'year_window')
+    valid_indices = [i for i, entry in enumerate(entries_info) if entry is not None and i not in exclude]
+    if blocking['method'] == 'sorted_neighborhood':
+        yield from iter_sorted_neighborhood_pairs(
+            entries_info, valid_indices, blocking, get_stage(stages, 'title_containment'))
+        return
+    
+    if year_stage is None:
+        for pos, i in enumerate(valid_indices):
+            for j in valid_indices[pos + 1:]:
+                yield i, j
+        return
+    
+    year_index = {}
+    for i in valid_indices:
+        year_index.setdefault(entries_info[i]['year'], []).append(i)
+    
+    for year, indices in year_index.items():
+        # Pairs within the block, each entry with the ones before it
+        for pos, j in enumerate(indices):
+            for i in indices[:pos]:
+                yield i, j
+        
+        # Pairs with later years inside the window, or with every other
+        # block for entries without a year if missing years are allowed
+        if year:
+            partner_years = [str(int(year) + offset) for offset in range(1, year_stage['window'] + 1)]
+        elif year_stage['allow_missing']:
+            partner_years = [other for other in year_index if other]
+        else:
+            partner_years = []
+        
+        for other_year in partner_years:
+            for i in indices:
+                for j in year_index.get(other_year, ()):
+                    yield min(i, j), max(i, j)
+
+def format_stage_stats(graph):
+    """Format the per-stage counters of a candidate graph for printing."""
+    lines = [f"Candidate pairs: {graph['candidate_pairs']} "
+             f"(pruned by blocking: {graph['pruned_pairs']})"]
+    for stats in graph['stage_stats']:
+        lines.append(f"  {stats['stage']:<14} evaluated {stats['evaluated']:>9}  "
+                     f"rejected {stats['rejected']:>9}  accepted {stats['accepted']:>9}")
+    return "\n".join(lines)
+
+def identifier_keys(entry):
+    """
+    'field:value' keys of an entry's exact identifiers. Unrelated papers can
+    link to the same page, so a URL only counts for an entry with no other
+    identifier, and is keyed together with the title: it groups copies of
+    one work, and never joins groups found by the other identifiers.
+    """
+    keys = [f"{field}:{entry[field]}" for field in IDENTIFIER_FIELDS if field != 'url' and entry.get(field)]
+    if not keys and entry.get('url') and entry['title_key']:
+        keys.append(f"url:{entry['url']} {entry['title_key']}")
+    return keys
+
+def union_identifier_keys(keyed_indices):
+    """
+    Union the entries that share an identifier, from (key, index) pairs.
+    Returns {index: root} for the entries in groups of two or more; the
+    root is the group's first index.
+    """
+    parent = {}
+    first_by_key = {}
+    
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    for key, i in keyed_indices:
+        parent.setdefault(i, i)
+        root1 = find(i)
+        root2 = find(first_by_key.setdefault(key, i))
+        if root1 != root2:
+            parent[max(root1, root2)] = min(root1, root2)
+    
+    roots = {i: find(i) for i in parent}
+    sizes = {}
+    for root in roots.values():
+        sizes[root] = sizes.get(root, 0) + 1
+    return {i: root for i, root in roots.items() if sizes[root] > 1}
+
+def find_identifier_groups(entries_info):
+    """Groups of entries sharing an exact identifier, each in file order, ordered by first entry."""
+    roots = union_identifier_keys(
+        (key, i) for i, entry in enumerate(entries_info) if entry is not None for key in identifier_keys(entry))
+    groups = {}
+    for i in sorted(roots):
+        groups.setdefault(roots[i], []).append(i)
+    return list(groups.values())
+
+def build_candidate_graph(entries_info, score_floor=SCORE_FLOOR, stages=None, blocking=None, verbose=True):
+    """
+    Score every candidate pair once and return the weighted pair graph.
+    
+    Entries sharing an exact identifier (DOI, arXiv ID, PMID, ISBN, or URL
+    and title) are grouped outright and left out of fuzzy matching. The
+    other candidate pairs are run through the matching cascade (the default
+    stages follow the original matching rules). Every score at or above
+    score_floor is kept, so the graph can be re-clustered at any threshold
+    above the floor without running SequenceMatcher again. Progress and the
+    per-stage counters are printed unless verbose is False (the web app).
+    """
+    stages = resolve_matching_stages(stages)
+    identifier_groups = find_identifier_groups(entries_info)
+    identified = {i for group in identifier_groups for i in group}
+    if verbose:
+        print(f"Grouped {len(identified)} entries into {len(identifier_groups)} groups by exact identifiers.")
+        print(f"Scoring candidate pairs among {len(entries_info)} entries (floor: {score_floor})...")
+    
+    stage_stats = [{'stage': stage['stage'], 'evaluated': 0, 'rejected': 0, 'accepted': 0}
+                   for stage in stages]
+    cache = {}
+    edges = []
+    candidate_pairs = 0
+    for i, j in iter_candidate_pairs(entries_info, stages, blocking, identified):
+        if verbose and candidate_pairs % 10000 == 0:  # Print progress every 10000 pairs
+            print(f"Scored {candidate_pairs} candidate pairs...")
+        candidate_pairs += 1
+        
+        forward, backward = run_matching_cascade(
+            entries_info[i], entries_info[j], stages, score_floor, stage_stats, cache)
+        if max(forward, backward) >= score_floor:
+            edges.append((i, j, forward, backward))
+    
+    edges.sort()
+    valid_entries = sum(1 for entry in entries_info if entry is not None)
+    
+    graph = {
+        'size': len(entries_info),
+        'score_floor': score_floor,
+        'identifier_groups': identifier_groups,
+        'edges': edges,
+        'candidate_pairs': candidate_pairs,
+        'pruned_pairs': valid_entries * (valid_entries - 1) // 2 - candidate_pairs,
+        'stage_stats': stage_stats
+    }
+    if verbose:
+        print(f"Kept {len(edges)} scored candidate pairs.")
+        print(format_stage_stats(graph))
+    return graph
+
+def start_candidate_graph(score_floor=SCORE_FLOOR, stages=None):
+    """
+    Start an empty candidate graph that entries are added to as they are
+    parsed, with year blocking. See add_to_candidate_graph.
+    """
+    stages = resolve_matching_stages(stages)
+    return {
+        'size': 0,
+        'score_floor': score_floor,
+        'identifier_groups': [],
+        'edges': [],
+        'candidate_pairs': 0,
+        'pruned_pairs': 0,
+        'stage_stats': [{'stage': stage['stage'], 'evaluated': 0, 'rejected': 0, 'accepted': 0}
+                        for stage in stages],
+        # Working state, dropped by finish_candidate_graph
+        'stages': stages,
+        'year_index': {},
+        'cache': {},
+        'identifier_index': {},
+        'identified': set()
+    }
+
+def iter_new_candidate_pairs(entries_info, j, year_stage, year_index):
+    """
+    Yield (i, j) pairs of entry j with the earlier entries in its year window
+    and add j to year_index. Adding every entry in order gives the same pairs
+    as iter_candidate_pairs with year blocking.
+    """
+    year = entries_info[j]['year']
+    if year_stage is None:
+        partner_years = list(year_index)
+    elif year:
+        window = year_stage['window']
+        partner_years = [year] + [str(int(year) + offset) for offset in range(-window, window + 1) if offset]
+        if year_stage['allow_missing']:
+            partner_years.append('')
+    elif year_stage['allow_missing']:
+        partner_years = list(year_index)
+    else:
+        partner_years = ['']
+    
+    for partner_year in partner_years:
+        for i in year_index.get(partner_year, ()):
+            yield i, j
+    year_index.setdefault(year, []).append(j)
+
+def add_to_candidate_graph(graph, entries_info, j):
+    """Score a newly parsed entry j against the earlier entries it is blocked with."""
+    entry = entries_info[j]
+    if entry is None:
+        return
+    
+    # An entry sharing an exact identifier with an earlier one is grouped with it
+    keys = identifier_keys(entry)
+    shared = [graph['identifier_index'][key] for key in keys if key in graph['identifier_index']]
+    for key in keys:
+        graph['identifier_index'].setdefault(key, j)
+    if shared:
+        graph['identified'].add(j)
+        graph['identified'].update(shared)
+        return
+    
+    stages = graph['stages']
+    score_floor = graph['score_floor']
+    for i, j in iter_new_candidate_pairs(entries_info, j, get_stage(stages, 'year_window'), graph['year_index']):
+        if i in graph['identified']:
+            continue
+        graph['candidate_pairs'] += 1
+        forward, backward = run_matching_cascade(
+            entries_info[i], entry, stages, score_floor, graph['stage_stats'], graph['cache'])
+        if max(forward, backward) >= score_floor:
+            graph['edges'].append((i, j, forward, backward))
+
+def finish_candidate_graph(graph, entries_info):
+    """Complete an incrementally built graph so it matches build_candidate_graph."""
+    # Entries grouped by an identifier after they were scored keep no edges
+    identified = graph['identified']
+    graph['edges'] = sorted(edge for edge in graph['edges'] if edge[0] not in identified and edge[1] not in identified)
+    graph['identifier_groups'] = find_identifier_groups(entries_info)
+    for key in ('stages', 'year_index', 'cache', 'identifier_index', 'identified'):
+        del graph[key]
+    
+    graph['size'] = len(entries_info)
+    valid_entries = sum(1 for entry in entries_info if entry is not None)
+    graph['pruned_pairs'] = valid_entries * (valid_entries - 1) // 2 - graph['candidate_pairs']
+    print(f"Kept {len(graph['edges'])} scored candidate pairs.")
+    print(format_stage_stats(graph))
+    return graph
+
+def cluster_candidate_graph(entries_info, graph, similarity_threshold=0.8):
+    """
+    Group entries from a scored candidate graph at the given threshold.
+    
+    Groups of entries sharing an exact identifier are formed first. Every
+    other unprocessed entry, in file order, collects the unprocessed
+    neighbours scoring above the threshold that are not in such a group.
+    """
+    threshold = float(similarity_threshold)
+    identified = {i: group for group in graph['identifier_groups'] for i in group}
+    
+    # Edges are scored from both ends; i < j always holds
+    neighbours = {}
+    for i, j, forward, backward in graph['edges']:
+        if forward > threshold:
+            neighbours.setdefault(i, []).append(j)
+        if backward > threshold:
+            neighbours.setdefault(j, []).append(i)
+    
+    duplicates = []
+    processed = set()
+    for i, entry in enumerate(entries_info):
+        if i in processed or entry is None:
+            continue
+        
+        if i in identified:
+            group = list(identified[i])  # i is the group's first entry
+        else:
+            group = [i] + [j for j in sorted(neighbours.get(i, ()))
+                           if j not in processed and j not in identified]
+        
+        if len(group) > 1:
+            duplicates.append(group)
+            processed.update(group)
+    
+    return duplicates
+
+def find_duplicates(entries_info, similarity_threshold=0.8, stages=None, blocking=None):
+    """Find potential duplicate entries based on similarity."""
+    print(f"Finding duplicates among {len(entries_info)} entries...")
+    print(f"Using similarity threshold: {similarity_threshold}")
+    
+    graph = build_candidate_graph(entries_info, min(SCORE_FLOOR, similarity_threshold), stages, blocking)
+    return cluster_candidate_graph(entries_info, graph, similarity_threshold)
+
+def group_key_map(entries_info, group, kept_idx):
+    """Map the citation keys dropped from a settled group to the key kept in their place."""
+    kept_key = entries_info[kept_idx]['citation_key']
+    return {
+        entries_info[idx]['citation_key']: kept_key for idx in group
+        if entries_info[idx] is not None and entries_info[idx]['citation_key'] != kept_key
+    }
+
+# Memory profiling of the pipeline stages (--profile-memory)
+MEMORY_PROFILE_VERSION = 1
+MEMORY_PROFILE_TOP = 10  # Allocation sites listed per stage
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None where it is not available (Windows)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes on Linux
+
+def current_rss():
+    """Current resident set size of this process in bytes, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class MemoryProfiler:
+    """
+    Record the memory use of each pipeline stage: the process's peak and
+    current RSS after it, the peak and net Python allocations traced during
+    it, and the source lines that allocated the most. Tracing with
+    tracemalloc slows the run down several times, so timings are only
+    comparable between profiled runs.
+    """
+    
+    def __init__(self, top=MEMORY_PROFILE_TOP):
+        self.top = top
+        self.stages = []
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            traced, traced_peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            own_frames = [tracemalloc.Filter(False, tracemalloc.__file__)]
+            sites = after.filter_traces(own_frames).compare_to(before.filter_traces(own_frames), 'lineno')
+            self.stages.append({
+                'stage': name,
+                'seconds': round(seconds, 3),
+                'peak_rss': peak_rss(),
+                'rss': current_rss(),
+                'traced_peak': traced_peak - traced_before,
+                'traced_net': traced - traced_before,
+                'top_allocations': [
+                    {'site': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                     'size': stat.size_diff, 'count': stat.count_diff}
+                    for stat in sites[:self.top] if stat.size_diff > 0
+                ]
+            })
+    
+    def report(self, **details):
+        """Stop tracing and return the report, with any details (input, entries, ...) added."""
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return {
+            'version': MEMORY_PROFILE_VERSION,
+            'python': sys.version.split()[0],
+            'platform': sys.platform,
+            **details,
+            'peak_rss': peak_rss(),
+            'stages': self.stages
+        }
+
+def profile_stage(profiler, name):
+    """The profiler's context for a stage, or a no-op without a profiler."""
+    return profiler.stage(name) if profiler is not None else contextlib.nullcontext()
+
+def format_memory_profile(report):
+    """Format a memory profile report as a table of stages and their top allocation sites."""
+    def megabytes(size):
+        return f"{size / (1024 * 1024):.1f}" if size is not None else "-"
+    
+    lines = [f"{'stage':<12}{'seconds':>9}{'peak RSS':>10}{'RSS':>9}{'traced peak':>13}{'traced net':>12}  (MB)"]
+    for stage in report['stages']:
+        lines.append(f"{stage['stage']:<12}{stage['seconds']:>9.2f}{megabytes(stage['peak_rss']):>10}"
+                     f"{megabytes(stage['rss']):>9}{megabytes(stage['traced_peak']):>13}"
+                     f"{megabytes(stage['traced_net']):>12}")
+        for site in stage['top_allocations'][:3]:
+            lines.append(f"    {megabytes(site['size']):>7} MB  {site['count']:>8} blocks  {site['site']}")
+    return "\n".join(lines)
+
+# Persistent library index: lookup keys for checking single citations
+# against a library without running the whole pipeline
+LIBRARY_INDEX_VERSION = 5
+NGRAM_SIZE = 3
+SIGNATURE_BANDS = 8  # MinHash bands of SIGNATURE_ROWS hashes each
+SIGNATURE_ROWS = 2
+MIN_SIGNATURE_BANDS = 2  # Bands a title-only candidate must share
+SIGNATURE_PRIME = 2147483647
+
+def signature_seeds(count, seed=1):
+    """Fixed (a, b) pairs for the MinHash permutations (a * x + b) mod prime."""
+    rng = random.Random(seed)
+    return [(rng.randrange(1, SIGNATURE_PRIME), rng.randrange(SIGNATURE_PRIME)) for _ in range(count)]
+
+SIGNATURE_SEEDS = signature_seeds(SIGNATURE_BANDS * SIGNATURE_ROWS)
+
+def author_surnames(authors):
+    """Normalized surnames from a BibTeX author list ('Last, First' or 'First Last')."""
+    surnames = []
+    for name in re.split(r'\s+and\s+', authors):
+        name = name.strip()
+        if not name:
+            continue
+        surname = name.split(',')[0] if ',' in name else name.split()[-1]
+        surname = blocking_key(surname)
+        if surname:
+            surnames.append(surname)
+    return surnames
+
+def title_signature(title):
+    """
+    MinHash band values of a title's character n-grams.
+    Titles sharing any band are likely to have similar n-gram sets.
+    """
+    key = blocking_key(title)
+    grams = {zlib.crc32(key[pos:pos + NGRAM_SIZE].encode('utf-8'))
+             for pos in range(len(key) - NGRAM_SIZE + 1)}
+    if not grams:
+        return []
+    
+    hashes = [min((a * gram + b) % SIGNATURE_PRIME for gram in grams) for a, b in SIGNATURE_SEEDS]
+    return [(band, hashes[band * SIGNATURE_ROWS] << 31 | hashes[band * SIGNATURE_ROWS + 1])
+            for band in range(SIGNATURE_BANDS)]
+
+def library_index_keys(entry):
+    """Lookup keys of an entry: exact identifiers, title key, year/surname keys and n-gram signature."""
+    return {
+        'identifiers': identifier_keys(entry),
+        'title': blocking_key(entry['title_key']),
+        'surnames': [f"{entry['year']}:{surname}" for surname in author_surnames(entry['authors_key'])],
+        'signature': title_signature(entry['title_key'])
+    }
+
+def build_library_index(input_file, index_path, batch_size=10000):
+    """
+    Build a persistent SQLite index of a .bib file for single-entry lookups.
+    The index is written next to index_path and moved into place when complete.
+    """
+    start_time = time.perf_counter()
+    print(f"Indexing BibTeX file: {input_file}")
+    partial_path = index_path + '.partial'
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    
+    conn = sqlite3.connect(partial_path)
+    try:
+        conn.executescript("""
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE entries (idx INTEGER PRIMARY KEY, info TEXT);
+            CREATE TABLE identifier_keys (key TEXT, idx INTEGER);
+            CREATE TABLE title_keys (key TEXT, idx INTEGER);
+            CREATE TABLE surname_keys (key TEXT, idx INTEGER);
+            CREATE TABLE signature_keys (band INTEGER, value INTEGER, idx INTEGER);
+        """)
+        
+        rows = {table: [] for table in ('entries', 'identifier_keys', 'title_keys', 'surname_keys', 'signature_keys')}
+        indexed = 0
+        for idx, entry in enumerate(iter_bib_entries(input_file)):
+            info = extract_entry_info(entry)
+            if info is None:
+                continue
+            indexed += 1
+            
+            keys = library_index_keys(info)
+            rows['entries'].append((idx, json.dumps(info)))
+            rows['identifier_keys'].extend((key, idx) for key in keys['identifiers'])
+            if keys['title']:
+                rows['title_keys'].append((keys['title'], idx))
+            rows['surname_keys'].extend((key, idx) for key in keys['surnames'])
+            rows['signature_keys'].extend((band, value, idx) for band, value in keys['signature'])
+            
+            if len(rows['entries']) >= batch_size:
+                write_library_index_rows(conn, rows)
+                print(f"Indexed {indexed} entries...")
+        
+        write_library_index_rows(conn, rows)
+        conn.executescript("""
+            CREATE INDEX identifier_keys_key ON identifier_keys (key);
+            CREATE INDEX title_keys_key ON title_keys (key);
+            CREATE INDEX surname_keys_key ON surname_keys (key);
+            CREATE INDEX signature_keys_band ON signature_keys (band, value);
+        """)
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ('version', str(LIBRARY_INDEX_VERSION)),
+            ('source', os.path.abspath(input_file)),
+            ('source_mtime', str(os.path.getmtime(input_file))),
+            ('entries', str(indexed))
+        ])
+        conn.commit()
+    finally:
+        conn.close()
+    
+    os.replace(partial_path, index_path)
+    print(f"Indexed {indexed} entries in {time.perf_counter() - start_time:.2f}s: {index_path}")
+    return indexed
+
+def write_library_index_rows(conn, rows):
+    """Flush batched index rows to their tables."""
+    for table, table_rows in rows.items():
+        if table_rows:
+            placeholders = ', '.join('?' * len(table_rows[0]))
+            conn.executemany(f"INSERT INTO {table} VALUES ({placeholders})", table_rows)
+            table_rows.clear()
+
+def library_index_is_current(index_path, input_file):
+    """Check that an index exists, has this version and is newer than its source."""
+    if not os.path.exists(index_path):
+        return False
+    try:
+        conn = sqlite3.connect(index_path)
+        try:
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    return (meta.get('version') == str(LIBRARY_INDEX_VERSION) and
+            float(meta.get('source_mtime', 0)) >= os.path.getmtime(input_file))
+
+def parse_query_entry(query):
+    """Turn a lookup query - a BibTeX entry or a bare title - into entry info."""
+    query = query.strip()
+    if query.startswith('@'):
+        entry = extract_entry_info(query)
+        if entry is None:
+            raise ValueError("Could not parse the BibTeX entry to check")
+        return entry
+    
+    # A bare title has no identifiers, but the fields are there as in extract_entry_info
+    return {'type': '', 'citation_key': '', **title_author_fields(query, ''), 'year': '',
+            **dict.fromkeys(IDENTIFIER_FIELDS, ''), 'full_entry': query}
+
+def query_library_index(conn, query, limit=5, stages=None, similarity_threshold=0.8, max_candidates=20):
+    """
+    Look up one citation in a library index.
+    
+    Candidates sharing a DOI, title key, year/surname key or n-gram band are
+    scored with the matching cascade. Returns up to limit matches scoring at
+    least SCORE_FLOOR, best first, as dicts with the entry fields, score,
+    duplicate flag and the keys that found them.
+    """
+    entry = parse_query_entry(query)
+    stages = resolve_matching_stages(stages)
+    year_stage = get_stage(stages, 'year_window')
+    if year_stage is not None:
+        # A query without a year should still find its match
+        year_stage['allow_missing'] = True
+    
+    keys = library_index_keys(entry)
+    hits = {}
+    lookups = [('identifier', "SELECT idx FROM identifier_keys WHERE key = ?", keys['identifiers']),
+               ('title', "SELECT idx FROM title_keys WHERE key = ?", [keys['title']] if keys['title'] else []),
+               ('surname', "SELECT idx FROM surname_keys WHERE key = ?", keys['surnames'] if entry['year'] else [])]
+    for name, sql, values in lookups:
+        for value in values:
+            for (idx,) in conn.execute(sql, (value,)):
+                hits.setdefault(idx, set()).add(name)
+    bands = {}
+    for band, value in keys['signature']:
+        for (idx,) in conn.execute("SELECT idx FROM signature_keys WHERE band = ? AND value = ?", (band, value)):
+            hits.setdefault(idx, set()).add('ngram')
+            bands[idx] = bands.get(idx, 0) + 1
+    
+    # A single shared n-gram band is weak evidence on its own. Score the
+    # candidates found by the most keys and bands first
+    candidates = [idx for idx in hits if hits[idx] != {'ngram'} or bands[idx] >= MIN_SIGNATURE_BANDS]
+    candidates = sorted(candidates, key=lambda idx: (-len(hits[idx]), -bands.get(idx, 0), idx))[:max_candidates]
+    stage_stats = [{'stage': stage['stage'], 'evaluated': 0, 'rejected': 0, 'accepted': 0}
+                   for stage in stages]
+    cache = {}
+    matches = []
+    for idx in candidates:
+        (info,) = conn.execute("SELECT info FROM entries WHERE idx = ?", (idx,)).fetchone()
+        candidate = json.loads(info)
+        score = max(run_matching_cascade(entry, candidate, stages, SCORE_FLOOR, stage_stats, cache))
+        if score >= SCORE_FLOOR:
+            matches.append({
+                'citation_key': candidate['citation_key'],
+                'title': candidate['title'],
+                'year': candidate['year'],
+                'doi': candidate['doi'],
+                'score': round(score, 4),
+                'duplicate': score > similarity_threshold,
+                'matched_on': sorted(hits[idx])
+            })
+    
+    matches.sort(key=lambda match: -match['score'])
+    return matches[:limit]